@@ -1,11 +1,15 @@
 package com.example.android.terminalTexting;
 
+import android.app.Activity;
 import android.app.IntentService;
+import android.app.PendingIntent;
 import android.bluetooth.BluetoothAdapter;
 import android.bluetooth.BluetoothDevice;
 import android.bluetooth.BluetoothSocket;
+import android.content.BroadcastReceiver;
 import android.content.Intent;
 import android.content.Context;
+import android.content.IntentFilter;
 import android.os.Binder;
 import android.os.IBinder;
 import android.support.annotation.Nullable;
@@ -13,10 +17,17 @@ import android.support.v4.content.LocalBroadcastManager;
 import android.telephony.SmsManager;
 import android.util.Log;
 
+import java.io.DataInputStream;
 import java.io.IOException;
 import java.io.InputStream;
 import java.io.OutputStream;
+import java.nio.ByteBuffer;
+import java.util.Arrays;
+import java.util.HashMap;
+import java.util.Map;
 import java.util.UUID;
+import java.util.concurrent.locks.ReentrantLock;
+import java.util.zip.DataFormatException;
 
 /**
  * An {@link IntentService} subclass for handling asynchronous task requests in
@@ -37,6 +48,34 @@ public class BluetoothService extends IntentService {
     private static final String DEVICE_ADDRESS =
             "com.example.android.terminalTexting.extra.DEVICE_ADDRESS";
 
+    // Framing of the bluetooth stream
+    private static final int MAX_FRAME_SIZE = 1 << 20;
+    private static final byte TEXT_MESSAGE = (byte) 255;
+    private static final byte IDENTIFIED = (byte) 251;
+    private static final byte SPECIAL = 0;
+
+    // Operations of a SPECIAL frame, the byte after the type
+    private static final byte HELLO = 1;
+    private static final byte ACK = 2;
+    private static final byte SMS_RESULT = 3;
+    private static final byte SYNC_REQUEST = 4;
+    private static final byte SYNC_CREDIT = 7;
+    private static final byte TRANSFER_STATUS = 8;
+    private static final byte MESSAGE_ACK = 9;
+    private static final byte MESSAGE_RESULT = 10;
+    private static final byte PROTOCOL_VERSION = 1;
+    private static final int FEATURE_ACKS = 1;
+    private static final int FEATURE_ZLIB = 2;
+    private static final int FEATURE_SYNC = 4;
+    private static final int FEATURE_CHUNKS = 8;
+    private static final int FEATURE_IDS = 16;
+
+    // Broadcast when an SMS sent for the terminal has gone out, or not
+    private static final String SMS_SENT_ACTION =
+            "com.example.android.terminalTexting.action.SMS_SENT";
+    private static final String EXTRA_SEQUENCE =
+            "com.example.android.terminalTexting.extra.SEQUENCE";
+
     // Unique UUID for this application
     private static final UUID MY_UUID =
             UUID.fromString("56abddf0-d4d2-45c7-9b2b-7837582d436f");
@@ -406,10 +445,29 @@ public class BluetoothService extends IntentService {
      * Thread forked from the connection thread made for listening for
      * incoming messages from the connected device.
      */
-    private class ListenerThread extends Thread {
+    private class ListenerThread extends Thread implements SentMessages.ResultWriter {
         private final BluetoothSocket mmSocket;
         private final InputStream mmInStream;
         private final OutputStream mmOutStream;
+        private final BroadcastReceiver mmSentReceiver;
+        // Frames received from the terminal, not counting SPECIAL frames.
+        // The terminal numbers its frames the same way.
+        private int mmReceived = 0;
+        // The terminal said HELLO, so it wants acknowledgements
+        private boolean mmAcking = false;
+        // The terminal's HELLO had FEATURE_IDS, so results go by message id
+        private boolean mmIdentifying = false;
+        // The terminal's HELLO had FEATURE_ZLIB, so frames can be compressed
+        private volatile boolean mmCompressing = false;
+        // The terminal's HELLO had FEATURE_CHUNKS, so large payloads can
+        // be sent as transfers
+        private volatile boolean mmChunking = false;
+        // History being streamed to the terminal, if any
+        private HistorySync mmHistorySync = null;
+        // Sends the transfers of this connection
+        private final Transfer.Sender mmTransfers;
+        // Fair, so a frame waiting to be written goes before the next chunk
+        private final ReentrantLock mmWriteLock = new ReentrantLock(true);
 
         ListenerThread(BluetoothSocket socket) {
             Log.d(LOG_TAG, "create ConnectedThread");
@@ -433,24 +491,49 @@ public class BluetoothService extends IntentService {
             mSMSHandler = new SMSHandler(BluetoothService.this) {
                 @Override
                 public void callback(MessagePackage msg) {
-                    ListenerThread.this.write(msg.getBytes());
+                    send(msg.getBytes());
+                }
+            };
+
+            // Report the outcome of every SMS sent for the terminal
+            mmSentReceiver = new BroadcastReceiver() {
+                @Override
+                public void onReceive(Context context, Intent intent) {
+                    int sequence = intent.getIntExtra(EXTRA_SEQUENCE, 0);
+                    int result = getResultCode() == Activity.RESULT_OK ? 0
+                            : Math.max(1, Math.min(getResultCode(), 255));
+                    write(ByteBuffer.allocate(7).put(SPECIAL).put(SMS_RESULT)
+                            .putInt(sequence).put((byte) result).array());
                 }
             };
+            registerReceiver(mmSentReceiver, new IntentFilter(SMS_SENT_ACTION));
+
+            mmTransfers = new Transfer.Sender(new HistorySync.FrameWriter() {
+                @Override
+                public void write(byte[] payload) {
+                    ListenerThread.this.write(payload);
+                }
+            });
         }
 
         public void run() {
             Log.i(LOG_TAG, "BEGIN mListenerThread");
-            byte[] buffer = new byte[1024];
-            int bytes;
+            mmTransfers.start();
+            DataInputStream in = new DataInputStream(mmInStream);
+            byte[] frame;
             SMSHandler.MessagePackage msgPack;
 
             // Keep listening to the InputStream while connected
             while (mState == Constants.STATE_CONNECTED) {
                 try {
-                    bytes = mmInStream.read(buffer);
-                    if (bytes <= 13) {
-                        throw new IOException("Incoming message was too short.");
+                    // Every frame starts with its length, the terminal may
+                    // send several frames in a single write.
+                    int length = in.readInt();
+                    if (length < 1 || length > MAX_FRAME_SIZE) {
+                        throw new IOException("Invalid frame length " + length);
                     }
+                    frame = new byte[length];
+                    in.readFully(frame);
                 } catch (IOException e) {
                     Log.i(LOG_TAG, "disconnected\n" + e.toString());
                     try {
@@ -462,9 +545,42 @@ public class BluetoothService extends IntentService {
                     connectionLost();
                     break;
                 }
-                Log.d(LOG_TAG, "buffer: " + new String(buffer));
+                if (frame[0] == SPECIAL) {
+                    handleSpecial(frame);
+                    continue;
+                }
+                mmReceived++;
+                Long messageID = null;
+                if (frame[0] == IDENTIFIED && frame.length > 9) {
+                    messageID = ByteBuffer.wrap(frame, 1, 8).getLong();
+                    frame = Arrays.copyOfRange(frame, 9, frame.length);
+                    write(ByteBuffer.allocate(10).put(SPECIAL).put(MESSAGE_ACK)
+                            .putLong(messageID).array());
+                    if (SentMessages.wasSent(messageID)) {
+                        // Sent again after a lost connection, only acknowledged
+                        Log.i(LOG_TAG, "Message " + messageID + " was already sent");
+                        SentMessages.sentAgain(messageID);
+                        continue;
+                    }
+                } else if (mmAcking) {
+                    write(ByteBuffer.allocate(6).put(SPECIAL).put(ACK)
+                            .putInt(mmReceived).array());
+                }
+                if (frame[0] == Compression.COMPRESSED) {
+                    try {
+                        frame = Compression.inflate(frame);
+                    } catch (DataFormatException e) {
+                        Log.e(LOG_TAG, "Could not inflate a compressed frame", e);
+                        continue;
+                    }
+                }
+                if (frame[0] != TEXT_MESSAGE) {
+                    // Other frame types are reserved
+                    continue;
+                }
                 try {
-                    msgPack = new SMSHandler.MessagePackage(buffer);
+                    msgPack = new SMSHandler.MessagePackage(
+                            Arrays.copyOfRange(frame, 1, frame.length));
                 } catch (Exception e) {
                     Log.i(LOG_TAG, "disconnecting due to read error\n" + e.toString());
                     try {
@@ -476,22 +592,171 @@ public class BluetoothService extends IntentService {
                     connectionLost();
                     break;
                 }
+                PendingIntent sentIntent = null;
+                if (messageID != null) {
+                    sentIntent = SentMessages.sending(BluetoothService.this, messageID);
+                } else if (mmAcking) {
+                    Intent intent = new Intent(SMS_SENT_ACTION);
+                    intent.putExtra(EXTRA_SEQUENCE, mmReceived);
+                    sentIntent = PendingIntent.getBroadcast(BluetoothService.this,
+                            mmReceived, intent, PendingIntent.FLAG_UPDATE_CURRENT);
+                }
                 SmsManager smsManager = SmsManager.getDefault();
                 smsManager.sendTextMessage(msgPack.number, null, msgPack.message,
-                        null, null);
+                        sentIntent, null);
             }
             Log.d(LOG_TAG, "ListenerThread is finishing");
+            if (mmHistorySync != null) {
+                mmHistorySync.cancel();
+            }
+            mmTransfers.cancel();
             mSMSHandler.close();
+            unregisterReceiver(mmSentReceiver);
+            SentMessages.removeWriter(this);
         }
 
-        void write(byte[] buffer) {
+        /**
+         * Answers the terminal's HELLO, after which every frame received is
+         * acknowledged with its sequence number, or its id when it has one.
+         * A message that comes again with an id that was already sent is
+         * only acknowledged. Results of the SMS of messages with ids are
+         * sent from then on, held ones first. If the
+         * terminal can take compressed frames, long messages are compressed
+         * from then on.
+         * Starts and paces history syncs and carries on with transfers
+         * from where the terminal says. Other operations are ignored.
+         * @param frame - payload of a SPECIAL frame
+         */
+        private void handleSpecial(byte[] frame) {
+            if (frame.length < 2) {
+                return;
+            }
+            if (frame[1] == SYNC_REQUEST && frame.length >= 28) {
+                startHistorySync(frame);
+                return;
+            }
+            if (frame[1] == SYNC_CREDIT && frame.length >= 8) {
+                ByteBuffer fields = ByteBuffer.wrap(frame, 2, 6);
+                int syncID = fields.getInt();
+                int pages = fields.getShort() & 0xffff;
+                if (mmHistorySync != null && mmHistorySync.getSyncID() == syncID) {
+                    mmHistorySync.credit(pages);
+                }
+                return;
+            }
+            if (frame[1] == TRANSFER_STATUS && frame.length >= 4) {
+                resumeTransfers(frame);
+                return;
+            }
+            if (frame[1] != HELLO) {
+                return;
+            }
+            mmAcking = true;
+            int features = frame.length >= 7
+                    ? ByteBuffer.wrap(frame, 3, 4).getInt() : 0;
+            mmCompressing = (features & FEATURE_ZLIB) != 0;
+            mmChunking = (features & FEATURE_CHUNKS) != 0;
+            mmIdentifying = (features & FEATURE_IDS) != 0;
+            write(ByteBuffer.allocate(7).put(SPECIAL).put(HELLO)
+                    .put(PROTOCOL_VERSION)
+                    .putInt(FEATURE_ACKS | FEATURE_ZLIB | FEATURE_SYNC | FEATURE_IDS)
+                    .array());
+            if (mmIdentifying) {
+                // Along with the results that came while disconnected
+                SentMessages.setWriter(this);
+            }
+        }
+
+        /**
+         * Streams the history a SYNC_REQUEST asks for, in place of any
+         * sync still running.
+         * @param frame - the SYNC_REQUEST
+         */
+        private void startHistorySync(byte[] frame) {
+            ByteBuffer fields = ByteBuffer.wrap(frame, 2, 26);
+            int syncID = fields.getInt();
+            long since = fields.getLong();
+            int credit = fields.getShort() & 0xffff;
+            String number = new String(frame, 16, 12).replace("\0", "");
+            if (mmHistorySync != null) {
+                mmHistorySync.cancel();
+            }
+            mmHistorySync = new HistorySync(BluetoothService.this,
+                    new HistorySync.FrameWriter() {
+                        @Override
+                        public void write(byte[] payload) {
+                            send(payload);
+                        }
+                    }, syncID, since, credit, number);
+            mmHistorySync.start();
+        }
+
+        /**
+         * Carries on with the transfers listed in a TRANSFER_STATUS.
+         * @param frame - count and then a transfer id and its next chunk
+         *              for every transfer the terminal has part of
+         */
+        private void resumeTransfers(byte[] frame) {
+            ByteBuffer fields = ByteBuffer.wrap(frame, 2, frame.length - 2);
+            int count = fields.getShort() & 0xffff;
+            if (fields.remaining() < count * 8) {
+                return;
+            }
+            Map<Integer, Integer> status = new HashMap<>();
+            for (int i = 0; i < count; i++) {
+                status.put(fields.getInt(), fields.getInt());
+            }
+            mmTransfers.resume(status);
+        }
+
+        /**
+         * Sends a message to the terminal, compressed if it can take
+         * that and as a transfer if it is too large for a single frame.
+         * @param payload - payload of the frame
+         */
+        void send(byte[] payload) {
+            // The terminal inflates a payload in memory, one larger than a
+            // frame is kept on its disk as it is
+            if (mmCompressing && payload.length <= MAX_FRAME_SIZE) {
+                payload = Compression.deflate(payload);
+            }
+            if (mmChunking && payload.length > Transfer.CHUNK_SIZE) {
+                mmTransfers.send(payload);
+            } else {
+                write(payload);
+            }
+        }
+
+        /**
+         * Writes a single frame. Every frame is prefixed with its length
+         * so the terminal can split frames back out of the stream. Called
+         * from the listener thread, the broadcast receivers and the
+         * transfer sender.
+         * @param buffer - payload of the frame
+         * @return false if it could not be written
+         */
+        boolean write(byte[] buffer) {
+            mmWriteLock.lock();
             try {
-                mmOutStream.write(buffer);
+                ByteBuffer frame = ByteBuffer.allocate(4 + buffer.length);
+                frame.putInt(buffer.length);
+                frame.put(buffer);
+                mmOutStream.write(frame.array());
+                return true;
             } catch (IOException e) {
                 Log.e(LOG_TAG, "Exception during write", e);
+                return false;
+            } finally {
+                mmWriteLock.unlock();
             }
         }
 
+        @Override
+        public boolean writeResult(long messageID, int result) {
+            return write(ByteBuffer.allocate(11).put(SPECIAL).put(MESSAGE_RESULT)
+                    .putLong(messageID).put((byte) result).array());
+        }
+
         void cancel() {
             try {
                 mmSocket.close();
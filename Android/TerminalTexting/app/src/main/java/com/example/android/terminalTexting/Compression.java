@@ -0,0 +1,116 @@
+package com.example.android.terminalTexting;
+
+import java.io.ByteArrayOutputStream;
+import java.nio.charset.Charset;
+import java.util.zip.DataFormatException;
+import java.util.zip.Deflater;
+import java.util.zip.Inflater;
+
+/**
+ * COMPRESSED frames, used once the HELLOs of both ends have FEATURE_ZLIB.
+ * A compressed frame is its type, the id of the preset dictionary and the
+ * zlib stream of the original payload. The terminal's side is
+ * src/compression.py, the dictionary must match it byte for byte.
+ */
+final class Compression {
+    static final byte COMPRESSED = (byte) 254;
+    static final byte SMS_DICTIONARY_ID = 1;
+
+    // Payloads smaller than this are never worth compressing
+    private static final int THRESHOLD = 96;
+    private static final int MAX_SIZE = 1 << 20;
+
+    // Words and phrases that come up in text messages, the most common
+    // ones last
+    private static final byte[] SMS_DICTIONARY = (
+            "appointment tomorrow morning afternoon evening weekend Monday " +
+            "Tuesday Wednesday Thursday Friday Saturday Sunday birthday " +
+            "congratulations happy anniversary dinner lunch breakfast coffee " +
+            "meeting office work school home traffic parking station airport " +
+            "flight train bus car pick up drop off on my way running late " +
+            "be there in 5 minutes 10 minutes half an hour an hour " +
+            "sounds good no problem don't worry take care talk to you later " +
+            "let me know what do you think what time where are you " +
+            "call me when you can can you call me I'll call you back " +
+            "did you get my message I just saw this sorry I missed your call " +
+            "thank you so much thanks love you miss you see you soon " +
+            "see you tomorrow have a good day good night good morning " +
+            "how are you I'm fine okay ok yes no maybe tonight today " +
+            "because about would could should really please just " +
+            "that this with have what when will your from they there " +
+            "the and you for are not but can all "
+            ).getBytes(Charset.forName("US-ASCII"));
+
+    private Compression() {
+    }
+
+    /**
+     * @param payload - payload of a frame
+     * @return the payload as a COMPRESSED frame, or the payload itself
+     * when compressing it does not save at least an eighth of it
+     */
+    static byte[] deflate(byte[] payload) {
+        if (payload.length < THRESHOLD) {
+            return payload;
+        }
+        Deflater deflater = new Deflater(Deflater.BEST_COMPRESSION);
+        ByteArrayOutputStream out = new ByteArrayOutputStream(payload.length);
+        try {
+            deflater.setDictionary(SMS_DICTIONARY);
+            deflater.setInput(payload);
+            deflater.finish();
+            out.write(COMPRESSED);
+            out.write(SMS_DICTIONARY_ID);
+            byte[] chunk = new byte[1024];
+            while (!deflater.finished()) {
+                int count = deflater.deflate(chunk);
+                out.write(chunk, 0, count);
+            }
+        } finally {
+            deflater.end();
+        }
+        if (out.size() > payload.length - payload.length / 8) {
+            return payload;
+        }
+        return out.toByteArray();
+    }
+
+    /**
+     * @param frame - a COMPRESSED frame
+     * @return the original payload
+     * @throws DataFormatException if the frame is corrupt, truncated, too
+     * large or uses a dictionary that is not known
+     */
+    static byte[] inflate(byte[] frame) throws DataFormatException {
+        if (frame.length < 2 || frame[0] != COMPRESSED) {
+            throw new DataFormatException("Not a compressed frame");
+        }
+        if (frame[1] != 0 && frame[1] != SMS_DICTIONARY_ID) {
+            throw new DataFormatException("Unknown dictionary " + frame[1]);
+        }
+        Inflater inflater = new Inflater();
+        try {
+            inflater.setInput(frame, 2, frame.length - 2);
+            ByteArrayOutputStream out = new ByteArrayOutputStream(frame.length * 4);
+            byte[] chunk = new byte[4096];
+            while (!inflater.finished()) {
+                int count = inflater.inflate(chunk);
+                if (count == 0) {
+                    if (inflater.needsDictionary()) {
+                        inflater.setDictionary(SMS_DICTIONARY);
+                    } else if (inflater.needsInput()) {
+                        throw new DataFormatException("Compressed frame is truncated");
+                    }
+                    continue;
+                }
+                out.write(chunk, 0, count);
+                if (out.size() > MAX_SIZE) {
+                    throw new DataFormatException("Compressed frame is too large");
+                }
+            }
+            return out.toByteArray();
+        } finally {
+            inflater.end();
+        }
+    }
+}
@@ -0,0 +1,187 @@
+package com.example.android.terminalTexting;
+
+import android.content.Context;
+import android.database.Cursor;
+import android.net.Uri;
+import android.util.Log;
+
+import java.io.ByteArrayOutputStream;
+import java.nio.ByteBuffer;
+import java.util.HashMap;
+import java.util.Map;
+
+/**
+ * Streams the SMS history asked for by a SYNC_REQUEST to the terminal.
+ * Messages are read from the SMS provider in the order of their ids and
+ * sent in pages. Only as many pages are sent as the terminal has given
+ * credit for, it gives more as it stores them, so a long history never
+ * piles up in memory on either side.
+ *
+ * Format of a page is:
+ * 1 byte SPECIAL, 1 byte SYNC_PAGE, 4 bytes sync id, 2 bytes record count
+ * and then for every record:
+ * 8 bytes the message's id in the SMS provider
+ * 8 bytes its date in milliseconds
+ * 1 byte 0 if it was received and 1 if it was sent
+ * the message as a MessagePackage, without its type byte
+ */
+class HistorySync extends Thread {
+    private static final String LOG_TAG = "TermTexting.HistorySync";
+
+    private static final byte SPECIAL = 0;
+    private static final byte SYNC_PAGE = 5;
+    private static final byte SYNC_END = 6;
+
+    // Limits of a single page
+    private static final int PAGE_RECORDS = 200;
+    private static final int PAGE_BYTES = 32 * 1024;
+
+    private static final Uri SMS_URI = Uri.parse("content://sms");
+    // Message types of the SMS provider
+    private static final int TYPE_SENT = 2;
+
+    /**
+     * Sends the frames of the sync to the terminal.
+     */
+    interface FrameWriter {
+        void write(byte[] payload);
+    }
+
+    private final Context mContext;
+    private final FrameWriter mWriter;
+    private final int mSyncID;
+    private final long mSince;
+    private final String mNumber;
+    private final Map<String, String> mContacts = new HashMap<>();
+    private int mCredit;
+    private boolean mCanceled = false;
+
+    /**
+     * @param syncID - id of the request, every frame carries it
+     * @param since - only messages with a larger id are sent
+     * @param credit - pages that can be sent before more credit comes
+     * @param number - only the conversation with number, or every
+     *               conversation when empty
+     */
+    HistorySync(Context context, FrameWriter writer, int syncID, long since,
+                int credit, String number) {
+        mContext = context;
+        mWriter = writer;
+        mSyncID = syncID;
+        mSince = since;
+        mCredit = credit;
+        mNumber = number;
+    }
+
+    int getSyncID() {
+        return mSyncID;
+    }
+
+    synchronized void credit(int pages) {
+        mCredit += pages;
+        notifyAll();
+    }
+
+    synchronized void cancel() {
+        mCanceled = true;
+        notifyAll();
+    }
+
+    public void run() {
+        String selection = "_id > ? AND type IN (1, 2)";
+        String[] selectionArgs;
+        if (mNumber.isEmpty()) {
+            selectionArgs = new String[]{Long.toString(mSince)};
+        } else {
+            selection += " AND PHONE_NUMBERS_EQUAL(address, ?)";
+            selectionArgs = new String[]{Long.toString(mSince), mNumber};
+        }
+        long watermark = mSince;
+        byte result = 0;
+        try (Cursor cursor = mContext.getContentResolver().query(SMS_URI,
+                new String[]{"_id", "date", "type", "address", "body"},
+                selection, selectionArgs, "_id ASC")) {
+            ByteArrayOutputStream records = new ByteArrayOutputStream();
+            int count = 0;
+            while (cursor != null && cursor.moveToNext()) {
+                byte[] record = record(cursor);
+                if (record != null) {
+                    records.write(record, 0, record.length);
+                    count++;
+                }
+                if (count >= PAGE_RECORDS || records.size() >= PAGE_BYTES) {
+                    if (!sendPage(records, count)) {
+                        return;
+                    }
+                    records.reset();
+                    count = 0;
+                }
+                watermark = cursor.getLong(0);
+            }
+            if (count > 0 && !sendPage(records, count)) {
+                return;
+            }
+        } catch (RuntimeException e) {
+            // Without the READ_SMS permission
+            Log.e(LOG_TAG, "Could not read the SMS history", e);
+            result = 1;
+        }
+        mWriter.write(ByteBuffer.allocate(15).put(SPECIAL).put(SYNC_END)
+                .putInt(mSyncID).putLong(watermark).put(result).array());
+        Log.d(LOG_TAG, "Sync " + mSyncID + " done up to " + watermark);
+    }
+
+    /**
+     * @return the record of the cursor's message, null if it has no
+     * number the terminal understands
+     */
+    private byte[] record(Cursor cursor) {
+        String address = cursor.getString(3);
+        String body = cursor.getString(4);
+        if (address == null || body == null) {
+            return null;
+        }
+        String contactName = mContacts.get(address);
+        if (contactName == null) {
+            contactName = SMSHandler.lookupContactName(mContext, address);
+            mContacts.put(address, contactName);
+        }
+        SMSHandler.MessagePackage message =
+                new SMSHandler.MessagePackage(address, contactName, body);
+        if (message.number == null) {
+            return null;
+        }
+        byte[] text = message.getBytes();
+        return ByteBuffer.allocate(17 + text.length - 1)
+                .putLong(cursor.getLong(0))
+                .putLong(cursor.getLong(1))
+                .put((byte) (cursor.getInt(2) == TYPE_SENT ? 1 : 0))
+                .put(text, 1, text.length - 1)
+                .array();
+    }
+
+    /**
+     * Waits for credit and sends a page.
+     * @return false if the sync was canceled
+     */
+    private boolean sendPage(ByteArrayOutputStream records, int count) {
+        synchronized (this) {
+            while (mCredit == 0 && !mCanceled) {
+                try {
+                    wait();
+                } catch (InterruptedException e) {
+                    return false;
+                }
+            }
+            if (mCanceled) {
+                return false;
+            }
+            mCredit--;
+        }
+        byte[] body = records.toByteArray();
+        mWriter.write(ByteBuffer.allocate(8 + body.length).put(SPECIAL)
+                .put(SYNC_PAGE).putInt(mSyncID).putShort((short) count)
+                .put(body).array());
+        return true;
+    }
+}
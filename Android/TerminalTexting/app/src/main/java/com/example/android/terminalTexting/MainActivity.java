@@ -74,6 +74,7 @@ public class MainActivity extends AppCompatActivity {
                 new String[]{Manifest.permission.READ_CONTACTS,
                              Manifest.permission.SEND_SMS,
                              Manifest.permission.RECEIVE_SMS,
+                             Manifest.permission.READ_SMS,
                              Manifest.permission.ACCESS_COARSE_LOCATION},
                 MY_PERMISSIONS_REQUEST_EVERYTHING);
 
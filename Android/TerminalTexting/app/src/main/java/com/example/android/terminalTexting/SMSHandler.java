@@ -18,6 +18,7 @@ import android.util.Log;
 import java.io.ByteArrayInputStream;
 import java.io.ByteArrayOutputStream;
 import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
 import java.util.Objects;
 
 /**
@@ -117,18 +118,45 @@ abstract class SMSHandler {
             byte type = (byte) 255;
             out.write(type);
             out.write(number.getBytes(), 0, 12);
-            out.write(contactName.length());
-            out.write(contactName.getBytes(), 0, contactName.length());
-            Log.d("TERMTEXT.getBytes", Integer.toString(message.length()));
-            int mLength = message.length();
+            // Lengths are in encoded bytes, not characters
+            byte[] contactBytes = contactName.getBytes(StandardCharsets.UTF_8);
+            int cLength = Math.min(contactBytes.length, 255);
+            out.write(cLength);
+            out.write(contactBytes, 0, cLength);
+            byte[] messageBytes = message.getBytes(StandardCharsets.UTF_8);
+            int mLength = messageBytes.length;
+            Log.d("TERMTEXT.getBytes", Integer.toString(mLength));
             ByteBuffer buf = ByteBuffer.allocate(4);
             buf.putInt(mLength);
             out.write(buf.array(), 0, 4);
-            out.write(message.getBytes(), 0, message.length());
+            out.write(messageBytes, 0, mLength);
             return out.toByteArray();
         }
     }
 
+    /**
+     * Looks up the name of a number in the contacts.
+     * @param context - context to query the contacts with
+     * @param number - phone number as the SMS has it
+     * @return the contact's name, or "Unknown Number"
+     */
+    static String lookupContactName(Context context, String number) {
+        Uri uri = Uri.withAppendedPath(ContactsContract.PhoneLookup.CONTENT_FILTER_URI,
+                Uri.encode(number));
+        ContentResolver resolver = context.getContentResolver();
+        try (Cursor cursor = resolver.query(uri, new String[]{
+                        ContactsContract.PhoneLookup.DISPLAY_NAME},
+                null, null, null)) {
+            if (cursor != null && cursor.moveToFirst()) {
+                return cursor.getString(
+                        cursor.getColumnIndex(ContactsContract.Data.DISPLAY_NAME));
+            }
+        } catch (Exception e) {
+            Log.d("SMSHandler", "Contact lookup failed", e);
+        }
+        return "Unknown Number";
+    }
+
     /**
      * close() should be called to unregister the SMS broadcast receiver
      */
@@ -164,7 +192,7 @@ abstract class SMSHandler {
                 // Fill msgs array.
                 SmsMessage[] msgs;
                 msgs = new SmsMessage[pdus.length];
-                String number, contactName = "Unknown Number";
+                String number, contactName;
                 StringBuilder fullMessage = new StringBuilder();
                 for (int i = 0; i < msgs.length; i++) {
                     // Check Android version and use appropriate createFromPdu.
@@ -182,26 +210,7 @@ abstract class SMSHandler {
                     // Pass strMessage to the callback method
                 }
                 number = msgs[0].getOriginatingAddress();
-                // Look up contact name
-                Uri uri = Uri.withAppendedPath(ContactsContract.PhoneLookup.CONTENT_FILTER_URI,
-                        Uri.encode(number));
-                ContentResolver resolver = receiverContext.getContentResolver();
-                Log.d(LOG_TAG, "Hi there!");
-                try (Cursor cursor = resolver.query(uri, new String[]{
-                                ContactsContract.PhoneLookup.DISPLAY_NAME},
-                        null, null, null)) {
-                    Log.d(LOG_TAG, cursor.toString());
-                    if (cursor.getCount() > 0) {
-                        cursor.moveToFirst();
-                        Log.d(LOG_TAG, "fingers crossed");
-                        contactName = cursor.getString(
-                                cursor.getColumnIndex(ContactsContract.Data.DISPLAY_NAME));
-                        Log.d(LOG_TAG, contactName);
-                    }
-                } catch (Exception e) {
-
-                    contactName = "Unknown Number";
-                }
+                contactName = lookupContactName(receiverContext, number);
                 Log.d(LOG_TAG, fullMessage.toString());
                 MessagePackage msgPackage = new MessagePackage(
                         number,
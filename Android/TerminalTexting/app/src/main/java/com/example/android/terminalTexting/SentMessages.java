@@ -0,0 +1,156 @@
+package com.example.android.terminalTexting;
+
+import android.app.Activity;
+import android.app.PendingIntent;
+import android.content.BroadcastReceiver;
+import android.content.Context;
+import android.content.Intent;
+import android.content.IntentFilter;
+
+import java.util.ArrayList;
+import java.util.LinkedHashMap;
+import java.util.LinkedHashSet;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+
+/**
+ * The messages the terminal sent in IDENTIFIED frames, once its HELLO has
+ * FEATURE_IDS, and what became of their SMS. The terminal's side is
+ * src/bluetoothManager.py.
+ *
+ * A message the terminal sends again after a lost connection is known by
+ * its id and not sent as an SMS twice. The result of every SMS is held
+ * until a connection to the terminal has taken it as a MESSAGE_RESULT, so
+ * a result that comes in between connections is not lost. Kept for the
+ * life of the process, the BluetoothService comes and goes with them.
+ */
+final class SentMessages {
+    // Result of an SMS that has not gone out yet
+    static final int PENDING = -1;
+
+    // Most messages remembered, the oldest are forgotten first
+    private static final int MAX_MESSAGES = 1024;
+
+    private static final String SMS_SENT_ACTION =
+            "com.example.android.terminalTexting.action.MESSAGE_SMS_SENT";
+    private static final String EXTRA_MESSAGE_ID =
+            "com.example.android.terminalTexting.extra.MESSAGE_ID";
+
+    /**
+     * Sends a MESSAGE_RESULT to the terminal.
+     */
+    interface ResultWriter {
+        /**
+         * @return false if it could not be written
+         */
+        boolean writeResult(long messageID, int result);
+    }
+
+    // messageID -> result, PENDING until the SMS has gone out or failed
+    private static final Map<Long, Integer> sResults =
+            new LinkedHashMap<Long, Integer>() {
+                @Override
+                protected boolean removeEldestEntry(Map.Entry<Long, Integer> eldest) {
+                    return size() > MAX_MESSAGES;
+                }
+            };
+    // Results the terminal has not taken yet
+    private static final Set<Long> sUnreported = new LinkedHashSet<>();
+    private static ResultWriter sWriter = null;
+    private static BroadcastReceiver sReceiver = null;
+    // Every PendingIntent gets its own, so none replaces another
+    private static int sNextRequestCode = 0;
+
+    private SentMessages() {
+    }
+
+    /**
+     * @return true if the SMS of messageID was sent already
+     */
+    static synchronized boolean wasSent(long messageID) {
+        return sResults.containsKey(messageID);
+    }
+
+    /**
+     * Remembers that the SMS of messageID is being sent.
+     * @return the sentIntent to send it with
+     */
+    static synchronized PendingIntent sending(Context context, long messageID) {
+        context = context.getApplicationContext();
+        if (sReceiver == null) {
+            sReceiver = new BroadcastReceiver() {
+                @Override
+                public void onReceive(Context context, Intent intent) {
+                    int result = getResultCode() == Activity.RESULT_OK ? 0
+                            : Math.max(1, Math.min(getResultCode(), 255));
+                    sent(intent.getLongExtra(EXTRA_MESSAGE_ID, 0), result);
+                }
+            };
+            context.registerReceiver(sReceiver, new IntentFilter(SMS_SENT_ACTION));
+        }
+        sResults.put(messageID, PENDING);
+        Intent intent = new Intent(SMS_SENT_ACTION)
+                .putExtra(EXTRA_MESSAGE_ID, messageID);
+        return PendingIntent.getBroadcast(context, sNextRequestCode++, intent,
+                PendingIntent.FLAG_ONE_SHOT);
+    }
+
+    /**
+     * The terminal sent messageID again, its result goes to the terminal
+     * again once known in case the last one was lost with the connection.
+     */
+    static synchronized void sentAgain(long messageID) {
+        Integer result = sResults.get(messageID);
+        if (result != null && result != PENDING) {
+            sUnreported.add(messageID);
+            report();
+        }
+    }
+
+    /**
+     * Results from now on go to writer, starting with every one held.
+     * @param writer - of the connection, null when there is none
+     */
+    static synchronized void setWriter(ResultWriter writer) {
+        sWriter = writer;
+        report();
+    }
+
+    /**
+     * Stops results going to writer, if they still do.
+     */
+    static synchronized void removeWriter(ResultWriter writer) {
+        if (sWriter == writer) {
+            sWriter = null;
+        }
+    }
+
+    private static synchronized void sent(long messageID, int result) {
+        if (!sResults.containsKey(messageID)) {
+            return;
+        }
+        sResults.put(messageID, result);
+        sUnreported.add(messageID);
+        report();
+    }
+
+    private static void report() {
+        if (sWriter == null) {
+            return;
+        }
+        List<Long> reported = new ArrayList<>();
+        for (long messageID : sUnreported) {
+            Integer result = sResults.get(messageID);
+            if (result == null) {
+                // Forgotten, too many messages came after it
+                reported.add(messageID);
+            } else if (sWriter.writeResult(messageID, result)) {
+                reported.add(messageID);
+            } else {
+                break;
+            }
+        }
+        sUnreported.removeAll(reported);
+    }
+}
@@ -0,0 +1,160 @@
+package com.example.android.terminalTexting;
+
+import java.nio.ByteBuffer;
+import java.util.ArrayDeque;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.Map;
+import java.util.Random;
+import java.util.concurrent.atomic.AtomicInteger;
+import java.util.zip.CRC32;
+
+/**
+ * A payload too large for one frame, sent as CHUNK frames once the
+ * terminal's HELLO has FEATURE_CHUNKS. The terminal's side is
+ * src/transfer.py.
+ *
+ * Format of a chunk is:
+ * 1 byte CHUNK, 4 bytes transfer id, 4 bytes chunk index, 8 bytes size of
+ * the whole payload, 4 bytes CRC-32 of the chunk's data and then
+ * CHUNK_SIZE bytes of the payload, the last chunk may be shorter
+ */
+final class Transfer {
+    static final byte CHUNK = (byte) 253;
+    static final int CHUNK_SIZE = 16 * 1024;
+    private static final int HEADER_SIZE = 21;
+
+    // Most transfers kept for the next connection after one is lost
+    private static final int MAX_PARKED = 8;
+
+    // Ids carry on over connections, the terminal may still have part
+    // of a transfer from the last one
+    private static final AtomicInteger sNextID =
+            new AtomicInteger(new Random().nextInt());
+    private static final List<Transfer> sParked = new ArrayList<>();
+
+    final int id;
+    private final byte[] mPayload;
+    private int mNext = 0;
+
+    Transfer(byte[] payload) {
+        id = sNextID.getAndIncrement();
+        mPayload = payload;
+    }
+
+    boolean isDone() {
+        return mNext >= chunkCount();
+    }
+
+    private int chunkCount() {
+        return (mPayload.length + CHUNK_SIZE - 1) / CHUNK_SIZE;
+    }
+
+    /**
+     * @return the next chunk to send
+     */
+    byte[] nextChunk() {
+        int start = mNext * CHUNK_SIZE;
+        int length = Math.min(CHUNK_SIZE, mPayload.length - start);
+        CRC32 crc = new CRC32();
+        crc.update(mPayload, start, length);
+        byte[] chunk = ByteBuffer.allocate(HEADER_SIZE + length).put(CHUNK)
+                .putInt(id).putInt(mNext).putLong(mPayload.length)
+                .putInt((int) crc.getValue()).put(mPayload, start, length)
+                .array();
+        mNext++;
+        return chunk;
+    }
+
+    /**
+     * Sends the transfers of a connection, one chunk of each in turn.
+     * Chunks are written through the same lock as every other frame, so
+     * a text never waits for more than one chunk however large the
+     * transfers are.
+     *
+     * The transfers a lost connection cut off wait until the terminal's
+     * TRANSFER_STATUS says where to carry on with them.
+     */
+    static class Sender extends Thread {
+        private final HistorySync.FrameWriter mWriter;
+        private final ArrayDeque<Transfer> mQueue = new ArrayDeque<>();
+        private final List<Transfer> mWaiting;
+        private boolean mCanceled = false;
+
+        Sender(HistorySync.FrameWriter writer) {
+            mWriter = writer;
+            synchronized (sParked) {
+                mWaiting = new ArrayList<>(sParked);
+                sParked.clear();
+            }
+        }
+
+        synchronized void send(byte[] payload) {
+            mQueue.add(new Transfer(payload));
+            notifyAll();
+        }
+
+        /**
+         * Carries on with every transfer the terminal has part of from the
+         * chunk it is missing. Transfers cut off by the last connection
+         * that it does not have start over.
+         * @param status - transfer id to the next chunk the terminal needs
+         */
+        synchronized void resume(Map<Integer, Integer> status) {
+            for (Transfer transfer : mQueue) {
+                Integer next = status.get(transfer.id);
+                if (next != null) {
+                    transfer.mNext = Math.min(next, transfer.chunkCount());
+                }
+            }
+            for (Transfer transfer : mWaiting) {
+                Integer next = status.get(transfer.id);
+                transfer.mNext = next == null ? 0
+                        : Math.min(next, transfer.chunkCount());
+                if (!transfer.isDone()) {
+                    mQueue.add(transfer);
+                }
+            }
+            mWaiting.clear();
+            notifyAll();
+        }
+
+        synchronized void cancel() {
+            mCanceled = true;
+            notifyAll();
+        }
+
+        public void run() {
+            while (true) {
+                byte[] chunk;
+                synchronized (this) {
+                    while (mQueue.isEmpty() && !mCanceled) {
+                        try {
+                            wait();
+                        } catch (InterruptedException e) {
+                            mCanceled = true;
+                        }
+                    }
+                    if (mCanceled) {
+                        break;
+                    }
+                    Transfer transfer = mQueue.poll();
+                    chunk = transfer.nextChunk();
+                    if (!transfer.isDone()) {
+                        mQueue.add(transfer);
+                    }
+                }
+                mWriter.write(chunk);
+            }
+            synchronized (this) {
+                synchronized (sParked) {
+                    sParked.addAll(mWaiting);
+                    sParked.addAll(mQueue);
+                    while (sParked.size() > MAX_PARKED) {
+                        sParked.remove(0);
+                    }
+                }
+            }
+        }
+    }
+}
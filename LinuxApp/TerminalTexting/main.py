@@ -6,17 +6,87 @@ Created on Jan 15, 2019
 @author: jj
 '''
 
-from src import cursesUI
+from src import cursesUI, logSetup, metrics
+from src.transport import makeTransport
+import argparse
 import logging
+import os
+import signal
     
 macAddress = "C0:EE:FB:27:43:16"
 
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Terminal Texting")
+    parser.add_argument('--transport', default='rfcomm',
+                        help="rfcomm (default), tcp:<host>:<port> or "
+                             "unix:<path>")
+    parser.add_argument('--device-cache',
+                        default=os.path.expanduser(
+                            '~/.terminalTexting/devices.json'),
+                        help="file bluetooth devices and their service "
+                             "channels are remembered in")
+    parser.add_argument('--multi', action='store_true',
+                        help="serve many phones at once")
+    parser.add_argument('--history',
+                        default=os.path.expanduser(
+                            '~/.terminalTexting/messages.db'),
+                        help="database the message history is kept in")
+    parser.add_argument('--attachments',
+                        default=os.path.expanduser(
+                            '~/.terminalTexting/attachments'),
+                        help="directory files sent by the phone are saved "
+                             "in")
+    parser.add_argument('--metrics',
+                        help="file a JSON snapshot of the statistics is "
+                             "written to")
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help="seconds between statistics snapshots")
+    parser.add_argument('--log-file', default='log.log',
+                        help="file to log to, rotated as it grows")
+    parser.add_argument('--log-level', default='INFO',
+                        type=str.upper,
+                        help="DEBUG, INFO (default), WARNING or ERROR")
+    parser.add_argument('--log-module', action='append', default=[],
+                        type=logSetup.parseModuleLevel,
+                        metavar='NAME=LEVEL',
+                        help="level of a single module, e.g. "
+                             "src.bluetoothService=DEBUG")
+    parser.add_argument('--log-json', action='store_true',
+                        help="log JSON lines instead of text")
+    parser.add_argument('--log-max-bytes', type=int, default=5 * 1024 * 1024,
+                        help="size the log is rotated at")
+    parser.add_argument('--log-unredacted', action='store_true',
+                        help="log phone numbers and message contents")
+    return parser.parse_args()
+
 def main():
-    logging.basicConfig(filename='log.log', filemode='w', level=logging.DEBUG)
+    args = parseArgs()
+    # Before any thread is started, so every one of them inherits it.
+    # Only the UI's input thread takes SIGWINCH, see cursesUI.
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGWINCH})
+    logListener = logSetup.setup(path=args.log_file,
+                                 level=args.log_level,
+                                 moduleLevels=dict(args.log_module),
+                                 jsonLines=args.log_json,
+                                 maxBytes=args.log_max_bytes,
+                                 redact=not args.log_unredacted)
     logging.info("Logging started")
     #btman = BluetoothManager()
     #btman.connect(macAddress)
-    cursesUI.startUI()
+    snapshots = None
+    if args.metrics:
+        snapshots = metrics.SnapshotWriter(args.metrics,
+                                           args.metrics_interval)
+    try:
+        cursesUI.startUI(transport=makeTransport(args.transport,
+                                                 args.device_cache),
+                         historyPath=args.history,
+                         multi=args.multi,
+                         attachmentPath=args.attachments)
+    finally:
+        if snapshots is not None:
+            snapshots.join()
+        logListener.stop()
 
 if __name__ == '__main__':
     main()
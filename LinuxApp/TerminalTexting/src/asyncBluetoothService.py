@@ -0,0 +1,410 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import asyncio
+import logging
+import socket
+import threading
+from src import metrics
+from src.bluetoothService import BluetoothService, RemoteDevice, \
+                                 BluetoothManagerError, BluetoothWriteError
+from src.events import Event
+from src.frameReader import FrameReader, FRAME_HEADER
+from src.transport import RfcommTransport
+
+log = logging.getLogger(__name__)
+
+# The same counter as the thread based BluetoothService, see src.metrics
+_frameErrors = metrics.counter("bluetooth.frame_errors")
+
+class AsyncBluetoothService():
+    '''asyncio version of the BluetoothService
+
+    Offers the same public methods and pushes the same Event(outType, args)
+    outputs to the outputQueue as the thread based BluetoothService,
+    but everything runs as tasks on a single event loop. Sockets are
+    used in non-blocking mode through loop.sock_recv_into() and
+    loop.sock_sendall(). The blocking transport calls (discovery, SDP,
+    accept and connect) are run in the loop's default executor.
+
+    The public methods must be called from the event loop's thread. Use
+    loop.call_soon_threadsafe() to call them from anywhere else.
+
+    Any connected socket can be handed to connectWithSocket(), which is
+    how the service is driven by a socket.socketpair() without an
+    adapter.
+
+    Public Constants:
+    (same as BluetoothService)
+
+    Public Methods:
+    discover(String target)
+    connectAsServer()
+    connectAsClient(String macID)
+    connectWithSocket(socket sock, tuple remoteInfo)
+    write(byte[] message)
+    disconnect()
+    close()
+    '''
+
+    STATE_NONE = BluetoothService.STATE_NONE
+    STATE_CONNECTING = BluetoothService.STATE_CONNECTING
+    STATE_CONNECTED = BluetoothService.STATE_CONNECTED
+
+    OUTPUT_DISCOVER_STARTED = BluetoothService.OUTPUT_DISCOVER_STARTED
+    OUTPUT_DISCOVER_RESULT = BluetoothService.OUTPUT_DISCOVER_RESULT
+    OUTPUT_DEVICE_FOUND = BluetoothService.OUTPUT_DEVICE_FOUND
+    OUTPUT_DISCOVER_COMPLETE = BluetoothService.OUTPUT_DISCOVER_COMPLETE
+    OUTPUT_CONNECTION_MADE = BluetoothService.OUTPUT_CONNECTION_MADE
+    OUTPUT_CONNECTION_FAILED = BluetoothService.OUTPUT_CONNECTION_FAILED
+    OUTPUT_CONNECTION_LOST = BluetoothService.OUTPUT_CONNECTION_LOST
+    OUTPUT_DISCONNECTED = BluetoothService.OUTPUT_DISCONNECTED
+    OUTPUT_BLUETOOTH_MESSAGE = BluetoothService.OUTPUT_BLUETOOTH_MESSAGE
+    OUTPUT_WRITE_SUCCESS = BluetoothService.OUTPUT_WRITE_SUCCESS
+    OUTPUT_WRITE_FAILED = BluetoothService.OUTPUT_WRITE_FAILED
+    OUTPUT_ERROR = BluetoothService.OUTPUT_ERROR
+    OUTPUT_NOTE = BluetoothService.OUTPUT_NOTE
+
+    def __init__(self, uuid, serviceName, outputQueue, transport=None, \
+                 loop=None):
+        """Constructor
+
+        outputQueue may be a queue.Queue or an asyncio.Queue, outputs
+        are added with put_nowait(). transport defaults to bluetooth
+        RFCOMM and loop defaults to the running loop.
+        """
+        self.state = self.STATE_NONE
+        self.uuid = uuid
+        self.name = serviceName
+        self.transport = transport or RfcommTransport()
+        self.outputQueue = outputQueue
+        self.loop = loop or asyncio.get_event_loop()
+        self._mySock = None
+        self._remoteSock = None
+        self._remoteInfo = None
+        self._writeQueue = None
+        self._messageCounter = 0
+        self._tasks = set()
+        self._connectTask = None
+        self._connectionTasks = []
+
+    def discover(self, target=None):
+        """Start the discovery process, it stops as soon as the device
+        with address target is found"""
+        self._spawn(self._discover(target))
+
+    def connectAsServer(self):
+        """Wait for a remote device to connect to the advertised service"""
+        if self.state == self.STATE_NONE:
+            self.state = self.STATE_CONNECTING
+            self._connectTask = self._spawn(self._connectAsServer())
+        else:
+            raise BluetoothManagerError()
+
+    def connectAsClient(self, macID):
+        """Connect to the advertised service on another device"""
+        if self.state == self.STATE_NONE:
+            self.state = self.STATE_CONNECTING
+            self._connectTask = self._spawn(self._connectAsClient(macID))
+        else:
+            raise BluetoothManagerError()
+
+    def connectWithSocket(self, sock, remoteInfo=("", 0)):
+        """Use an already connected socket as the connection"""
+        if self.state == self.STATE_NONE:
+            self._remoteInfo = remoteInfo
+            self._connectionMade(sock)
+        else:
+            raise BluetoothManagerError()
+
+    def write(self, message):
+        """Send a byte[] as a message to the connected device
+
+        Returns a messageID to be able to track if the write was
+        successful or not.
+        """
+        if self.state == self.STATE_CONNECTED:
+            self._messageCounter += 1
+            messageID = self._messageCounter
+            self._writeQueue.put_nowait((message, messageID))
+            return messageID
+        else:
+            raise BluetoothWriteError()
+
+    def disconnect(self):
+        """Disconnect from the connected device"""
+        if self.state != self.STATE_NONE:
+            self._closeConnection()
+            self._outputDisconnected("Disconnected")
+
+    def close(self):
+        """Disconnect and cancel any outstanding work"""
+        self._closeConnection()
+        for task in list(self._tasks):
+            task.cancel()
+
+    #-----------------------------Output Methods-------------------------------
+
+    def _output(self, outType, args):
+        self.outputQueue.put_nowait(Event(outType, args))
+
+    def _outputDisconnected(self, comment):
+        self._output(self.OUTPUT_DISCONNECTED, {'comment': comment})
+
+    def _outputWriteSuccess(self, messageID):
+        self._output(self.OUTPUT_WRITE_SUCCESS, {'messageID': messageID})
+
+    def _outputWriteFailed(self, messageID, e, comment):
+        self._output(self.OUTPUT_WRITE_FAILED, {'messageID': messageID, \
+                                                'comment': comment, \
+                                                'error': e})
+
+    def _outputBluetoothMessage(self, buffer):
+        """Called once for every complete frame received
+
+        buffer is a memoryview into the receive buffer and is only valid
+        for the duration of the call.
+        """
+        self._output(self.OUTPUT_BLUETOOTH_MESSAGE, \
+                     {'message': bytes(buffer)})
+
+    def _outputError(self, e, comment):
+        self._output(self.OUTPUT_ERROR, {'comment': comment, 'error': e})
+
+    def _outputNote(self, note):
+        self._output(self.OUTPUT_NOTE, {'note': note})
+
+    #-----------------------------Internal Methods-----------------------------
+
+    def _spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _runBlocking(self, cleanup, function, *args):
+        """Runs a blocking transport call in the executor
+
+        The call itself can not be stopped, so should the task be
+        cancelled while it runs cleanup is called with whatever it
+        returns once it does.
+        """
+        future = self.loop.run_in_executor(None, function, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            def done(future):
+                if not future.cancelled() and future.exception() is None:
+                    cleanup(future.result())
+            future.add_done_callback(done)
+            raise
+
+    async def _discover(self, target):
+        """Scans the area for discoverable bluetooth devices"""
+        self._output(self.OUTPUT_DISCOVER_STARTED, {})
+        known = self.transport.knownDevices()
+        if known:
+            self._output(self.OUTPUT_DISCOVER_RESULT, {'result': known, \
+                                                       'cached': True})
+        # Set from the executor's thread or when the task is cancelled
+        stopped = threading.Event()
+
+        def found(address, name):
+            self.loop.call_soon_threadsafe(self._output, \
+                                           self.OUTPUT_DEVICE_FOUND, \
+                                           {'address': address, 'name': name})
+            if address == target:
+                stopped.set()
+
+        try:
+            devices = await self.loop.run_in_executor( \
+                None, self.transport.discover, found, stopped.is_set)
+        except asyncio.CancelledError:
+            stopped.set()
+            raise
+        except Exception as e:
+            self._outputError(e, "Discovery failed")
+        else:
+            self._output(self.OUTPUT_DISCOVER_RESULT, {'result': devices, \
+                                                       'cached': False})
+        self._output(self.OUTPUT_DISCOVER_COMPLETE, {})
+
+    async def _connectAsServer(self):
+        """Allow a connection to be made from a remote device"""
+        try:
+            mySock = await self._runBlocking(_closeSocket, \
+                                             self._openServerSocket)
+        except Exception as e:
+            self._connectionFailed(e, "Failed to create a server socket.")
+            return
+        if self.state != self.STATE_CONNECTING:
+            # Disconnected while the socket was being set up
+            _closeSocket(mySock)
+            return
+        self._mySock = mySock
+        self._outputNote("Awaiting connection")
+        try:
+            sock, remoteInfo = await self._runBlocking(_closeAccepted, \
+                                    self.transport.accept, mySock)
+            sock = self.transport.nativeSocket(sock)
+        except Exception as e:
+            if self.state == self.STATE_CONNECTING:
+                self._connectionFailed(e, "There was an issue accepting " \
+                                          "connections.")
+            return
+        if self.state != self.STATE_CONNECTING:
+            _closeSocket(sock)
+            return
+        self._remoteInfo = remoteInfo
+        self._connectionMade(sock)
+
+    def _openServerSocket(self):
+        """Blocking part of the server setup, run in the executor"""
+        sock = self.transport.listen()
+        self.transport.advertise(sock, self.name, self.uuid)
+        return sock
+
+    async def _connectAsClient(self, address):
+        """Attempt to make a connection with another device."""
+        try:
+            sock, remoteInfo = await self._runBlocking(_closeAccepted, \
+                    self.transport.connect, address, self.name, self.uuid)
+            sock = self.transport.nativeSocket(sock)
+        except Exception as e:
+            self._connectionFailed(e, "Error when connecting to the " \
+                                      "remote Device.")
+            return
+        if self.state != self.STATE_CONNECTING:
+            # Disconnected while the connection was being made
+            _closeSocket(sock)
+            return
+        self._remoteInfo = remoteInfo
+        self._connectionMade(sock)
+
+    def _connectionMade(self, sock):
+        self._connectTask = None
+        sock.setblocking(False)
+        self._remoteSock = sock
+        self._writeQueue = asyncio.Queue()
+        self.state = self.STATE_CONNECTED
+        self._connectionTasks = [ \
+            self._spawn(self._listen(sock)), \
+            self._spawn(self._writeLoop(sock, self._writeQueue))]
+        device = RemoteDevice(None, self._remoteInfo[0], self._remoteInfo[1])
+        self._output(self.OUTPUT_CONNECTION_MADE, {'device': device})
+
+    def _connectionFailed(self, e, reason):
+        self._closeConnection()
+        self._output(self.OUTPUT_CONNECTION_FAILED, {'comment': reason, \
+                                                     'error': e})
+
+    def _connectionLost(self, e):
+        self._closeConnection()
+        self._output(self.OUTPUT_CONNECTION_LOST, \
+                     {'comment': "The connection was lost", 'error': e})
+
+    def _closeConnection(self):
+        """Closes the sockets and fails whatever is still queued"""
+        self.state = self.STATE_NONE
+        current = asyncio.current_task(self.loop)
+        for task in self._connectionTasks + [self._connectTask]:
+            if task is not None and task is not current:
+                task.cancel()
+        self._connectTask = None
+        self._connectionTasks = []
+        for sock in (self._remoteSock, self._mySock):
+            if sock is not None:
+                try:
+                    # Wakes an accept() still blocked in the executor
+                    sock.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass # Not connected, or already gone
+                try:
+                    sock.close()
+                except Exception as e:
+                    self._outputError(e, "Failed to close socket")
+        self._remoteSock = None
+        self._mySock = None
+        self._remoteInfo = None
+        if self._writeQueue is not None:
+            while not self._writeQueue.empty():
+                _, messageID = self._writeQueue.get_nowait()
+                self._outputWriteFailed(messageID, None, "Connection closed")
+            self._writeQueue = None
+
+    async def _listen(self, sock):
+        """Reads frames until the connection goes away"""
+        reader = FrameReader()
+        while sock is self._remoteSock:
+            try:
+                count = await self.loop.sock_recv_into(sock, \
+                                                       reader.writable())
+                if count == 0:
+                    raise IOError("The remote device closed the connection")
+                reader.commit(count)
+                for frame in reader.frames():
+                    self._handleFrame(frame)
+            except IOError as e:
+                log.debug("Listening stopped: %s", e)
+                if sock is self._remoteSock:
+                    self._connectionLost(e)
+                return
+
+    def _handleFrame(self, frame):
+        """Passes a frame on, a frame that can not be handled is logged
+        and dropped rather than ending the connection"""
+        try:
+            self._outputBluetoothMessage(frame)
+        except Exception as e:
+            _frameErrors.inc()
+            log.exception("Could not handle a frame of %d bytes", \
+                          len(frame))
+            self._outputError(e, "Could not handle a received frame")
+
+    async def _writeLoop(self, sock, writeQueue):
+        """Sends everything queued for sock, coalescing waiting frames"""
+        while True:
+            item = await writeQueue.get()
+            if item is None:
+                return
+            batch = [item]
+            while not writeQueue.empty():
+                item = writeQueue.get_nowait()
+                if item is None:
+                    break
+                batch.append(item)
+            buffers = []
+            for message, _ in batch:
+                buffers.append(FRAME_HEADER.pack(len(message)))
+                buffers.append(message)
+            try:
+                await self.loop.sock_sendall(sock, b''.join(buffers))
+            except asyncio.CancelledError:
+                # The batch is out of the queue, nothing else fails it
+                for _, messageID in batch:
+                    self._outputWriteFailed(messageID, None, \
+                                            "Connection closed")
+                raise
+            except IOError as e:
+                for _, messageID in batch:
+                    self._outputWriteFailed(messageID, e, "Failed to send")
+                if sock is self._remoteSock:
+                    self._connectionLost(e)
+                return
+            for _, messageID in batch:
+                self._outputWriteSuccess(messageID)
+            if item is None:
+                return
+
+def _closeSocket(sock):
+    try:
+        sock.close()
+    except Exception:
+        log.exception("Failed to close socket")
+
+def _closeAccepted(result):
+    """Cleanup for the (socket, remoteInfo) of accept() and connect()"""
+    _closeSocket(result[0])
@@ -3,8 +3,36 @@ Created on Feb 25, 2019
 
 @author: jj
 '''
-from src.bluetoothService import BluetoothService
+from collections import OrderedDict
+from src import compression, events, metrics, specialFrame, transfer
+from src.bluetoothService import BluetoothService, BluetoothWriteError
+from src.multiplexService import MultiplexService
+from src.compression import COMPRESSED, CompressionError
+from src.frameReader import FRAME_HEADER
+from src.specialFrame import SpecialFrameError
+from src.transfer import CHUNK, Reassembler, TransferError
 import logging
+import os
+import random
+import struct
+import time
+
+# Message Types
+TEXT_MESSAGE = 255
+SPECIAL = 0
+
+_decodeErrors = metrics.counter("bluetooth.decode_errors")
+_compressedOut = metrics.counter("bluetooth.compression.frames_out")
+_compressedIn = metrics.counter("bluetooth.compression.frames_in")
+_bytesSaved = metrics.counter("bluetooth.compression.bytes_saved")
+_historyRecords = metrics.counter("bluetooth.history.records")
+_chunksIn = metrics.counter("bluetooth.transfer.chunks_in")
+_transfersIn = metrics.counter("bluetooth.transfer.completed")
+_transferBytes = metrics.counter("bluetooth.transfer.bytes_in")
+_transferErrors = metrics.counter("bluetooth.transfer.errors")
+_transferTime = metrics.histogram("bluetooth.transfer.seconds")
+
+log = logging.getLogger(__name__)
 
 class BluetoothManager(BluetoothService):
     '''Extended BluetoothService for project specific use
@@ -12,90 +40,482 @@ class BluetoothManager(BluetoothService):
     Overrides the _outputBluetoothMessage so that the message can be
     formatted into the displayThreads required form.
     
+    Every connection starts with a HELLO special frame. A phone that
+    answers it acknowledges each frame it receives and reports whether
+    the SMS it was asked to send went out, which is passed on as
+    OUTPUT_MESSAGE_STATUS. An older phone never answers and messages
+    count as sent once they are written to the connection.
+    
+    When both HELLOs have FEATURE_IDS, messages waiting for an ACK go
+    out as IDENTIFIED frames. One that is sent again after a lost
+    connection keeps its id and the phone does not send its SMS twice.
+    The phone then acknowledges them and reports their SMS by id, and
+    holds results that come while disconnected for the next connection.
+    Without ids a result can only come on the connection the message was
+    sent on, messages still waiting for one when it is lost get
+    MESSAGE_SMS_UNKNOWN.
+    
+    When both HELLOs have FEATURE_ZLIB, messages that are long enough
+    are sent as COMPRESSED frames, as long as that makes them smaller.
+    Compressed frames from the phone are always understood.
+    
+    A phone with FEATURE_SYNC is announced with OUTPUT_HISTORY_AVAILABLE
+    and can be asked for its history with syncHistory(). It streams the
+    history back in pages, each decoded as it arrives and passed on as
+    an OUTPUT_HISTORY_PAGE. The phone only sends SYNC_WINDOW pages ahead
+    of the ones given back to syncCredit(), so however long the history
+    no more than that is ever waiting here.
+    
+    Payloads too large for a frame, such as attachments, come as CHUNK
+    frames. They are put back together in a temporary file and handled
+    like any frame once complete, an attachment is saved in
+    attachmentDir and announced with OUTPUT_ATTACHMENT_RECEIVED. A
+    transfer cut off by a lost connection carries on where it stopped
+    on the next one, as every connection starts by telling the phone
+    what is here already.
+    
     Public Constants:
     OUTPUT_RECEIVED_TEXT_MESSAGE
+    OUTPUT_HISTORY_AVAILABLE
+    OUTPUT_HISTORY_PAGE
+    OUTPUT_HISTORY_SYNCED
+    OUTPUT_ATTACHMENT_RECEIVED
+    MESSAGE_SMS_SENT
+    MESSAGE_SMS_FAILED
+    MESSAGE_SMS_UNKNOWN
+    SYNC_WINDOW
     
     Public Methods:
-    (none)
+    syncHistory(int since, String phoneNumber)
+    syncCredit(int syncID, int pages)
     '''
     
-    # Message Types
-    __TEXT_MESSAGE = 255
-    __SPECIAL = 0
-    
     # Output Types
-    OUTPUT_RECEIVED_TEXT_MESSAGE = "receivedText"
+    OUTPUT_RECEIVED_TEXT_MESSAGE = events.RECEIVED_TEXT_MESSAGE
+    OUTPUT_HISTORY_AVAILABLE = events.HISTORY_AVAILABLE
+    OUTPUT_HISTORY_PAGE = events.HISTORY_PAGE
+    OUTPUT_HISTORY_SYNCED = events.HISTORY_SYNCED
+    OUTPUT_ATTACHMENT_RECEIVED = events.ATTACHMENT_RECEIVED
+    
+    # Statuses of OUTPUT_MESSAGE_STATUS, after MESSAGE_ON_WIRE
+    MESSAGE_SMS_SENT = "sms-sent"
+    MESSAGE_SMS_FAILED = "sms-failed"
+    MESSAGE_SMS_UNKNOWN = "sms-unknown"
+    
+    # Most delivered messages remembered while their SMS is being sent
+    MAX_SMS_PENDING = 4096
+    
+    # Pages of history the phone may send ahead of them being stored
+    SYNC_WINDOW = 4
 
-    def __init__(self, uuid, serviceName, outputQueue):
+    def __init__(self, uuid, serviceName, outputQueue, transport=None, \
+                 attachmentDir='attachments'):
+        # sequence -> messageID of messages the phone has, set before the
+        # service thread starts
+        self._smsPending = OrderedDict()
+        # messageID -> None of messages the phone has by their ids, kept
+        # over connections
+        self._smsByID = OrderedDict()
+        self.attachmentDir = attachmentDir
+        # Only used by the thread reading the connection
+        self._reassembler = Reassembler()
+        self._compressing = False
+        self._features = 0 # of the phone's HELLO
+        # Top half of every id, so that ids of another run never match
+        self._idPrefix = random.getrandbits(32) << 32
+        self._syncID = 0 # of the last syncHistory()
+        self._syncing = None # syncID of the sync in progress
+        self._syncWatermark = 0 # of the last page of the sync
+        metrics.gauge("bluetooth.transfer.pending", \
+                      lambda: len(self._reassembler))
         super(BluetoothManager, self).__init__(uuid, \
                                                serviceName, \
-                                               outputQueue)
+                                               outputQueue, \
+                                               transport)
     
-    def _outputBluetoothMessage(self, buffer):
-        messageType = buffer[0]
-        if messageType == self.__TEXT_MESSAGE:
-            # recieved text message
-            self.outputQueue.put((self.OUTPUT_RECEIVED_TEXT_MESSAGE, \
-                                  {'message': TextMessage(buffer[1:])}))
-        elif messageType == self.__SPECIAL:
-            # Special instruction
-            pass
-        else:
-            # Something went wrong
-            pass
-        
-class MessageBuffer():
-    """a byte[] that tracks how much has been read"""
-    def __init__(self, byteArray):
-        self.pointer = 0
-        self.buffer = byteArray
+    def syncHistory(self, since=0, phoneNumber=None):
+        """Asks the phone for its messages after the message with its id
+        since, with phoneNumber or with anyone when None
         
-    def read(self, num):
-        """returns a byte[] of the next characters in the objects []
-        
-        returns a single character if num == 1
+        Every page of messages is an OUTPUT_HISTORY_PAGE, to be passed
+        on to syncCredit() once it is stored. OUTPUT_HISTORY_SYNCED
+        follows the last page. Asking again stops the earlier sync.
+        A page that can not be decoded ends the sync there, with an
+        OUTPUT_HISTORY_SYNCED that is not 'complete'. Returns the syncID
+        of the outputs.
         """
-        newPointer = self.pointer + num
-        output = self.buffer[self.pointer : newPointer]
-        self.pointer = newPointer
-        if num == 1:
-            return output[0]
+        if not self._features & specialFrame.FEATURE_SYNC:
+            raise BluetoothWriteError("The phone can not sync its history")
+        self._syncID += 1
+        self._syncing = self._syncID
+        self._syncWatermark = since
+        self._writeControl(specialFrame.syncRequest(self._syncID, since, \
+                                                    self.SYNC_WINDOW, \
+                                                    phoneNumber))
+        return self._syncID
+    
+    def syncCredit(self, syncID, pages=1):
+        """Lets the phone send pages more pages of the sync. Safe to call
+        from any thread."""
+        if syncID == self._syncing:
+            self._writeControl(specialFrame.syncCredit(syncID, pages))
+    
+    def _outputBluetoothMessage(self, buffer):
+        if buffer[0] == COMPRESSED:
+            buffer = _inflate(self, buffer)
+            if buffer is None:
+                return
+        if buffer[0] == SPECIAL:
+            self._onSpecial(buffer)
+        elif buffer[0] == CHUNK:
+            self._onChunk(buffer)
         else:
-            return output
-        
+            _outputFrame(self, buffer, {})
+    
+    def _greeting(self):
+        # Transfers a lost connection cut off carry on from here
+        return (specialFrame.hello(specialFrame.FEATURE_ACKS | \
+                                   specialFrame.FEATURE_ZLIB | \
+                                   specialFrame.FEATURE_CHUNKS | \
+                                   specialFrame.FEATURE_IDS), \
+                specialFrame.transferStatus(self._reassembler.pending()))
+    
+    def _encodeFrame(self, payload):
+        if not self._compressing:
+            return payload
+        frame = compression.deflate(payload)
+        if frame is None:
+            return payload
+        _compressedOut.inc()
+        _bytesSaved.inc(len(payload) - len(frame))
+        return frame
+    
+    def _identify(self, payload, messageID):
+        if not self._features & specialFrame.FEATURE_IDS:
+            return None
+        return specialFrame.identify(self._idPrefix \
+                                     | messageID & 0xffffffff, payload)
+    
+    def _messageID(self, wireID):
+        """Returns the messageID of an id from the phone, None if it is
+        of another run"""
+        if wireID & ~0xffffffff != self._idPrefix:
+            return None
+        return wireID & 0xffffffff
+    
+    def _connectionMade(self):
+        # Sequence numbers start over with the connection, so results
+        # by them can no longer come
+        for messageID in self._smsPending.values():
+            self._outputMessageStatus(messageID, self.MESSAGE_SMS_UNKNOWN)
+        self._smsPending.clear()
+        if not self._reconnecting:
+            # The same phone is back on a reconnect, messages sent again
+            # before it says HELLO keep their ids
+            self._compressing = False
+            self._features = 0
+        self._syncing = None
+        super(BluetoothManager, self)._connectionMade()
+    
+    def _onSpecial(self, buffer):
+        try:
+            operation, fields = specialFrame.decode(buffer)
+        except SpecialFrameError as e:
+            _decodeErrors.inc()
+            self._outputError(e, "Could not decode a special frame")
+            return
+        if operation == specialFrame.HELLO:
+            _, features = fields
+            # Before acks, messages waiting for one are identified
+            self._features = features
+            self._compressing = bool(features & specialFrame.FEATURE_ZLIB)
+            if features & specialFrame.FEATURE_ACKS:
+                self._enableAcks()
+                self._outputNote("The phone confirms every message")
+            if features & specialFrame.FEATURE_SYNC:
+                self._output(self.OUTPUT_HISTORY_AVAILABLE, {})
+        elif operation == specialFrame.ACK:
+            for sequence, messageID in self._deliveredUpTo(fields[0]):
+                self._smsPending[sequence] = messageID
+            while len(self._smsPending) > self.MAX_SMS_PENDING:
+                self._smsPending.popitem(last=False)
+        elif operation == specialFrame.SMS_RESULT:
+            sequence, result = fields
+            messageID = self._smsPending.pop(sequence, None)
+            if messageID is not None:
+                self._outputSmsResult(messageID, result)
+        elif operation == specialFrame.MESSAGE_ACK:
+            messageID = self._messageID(fields[0])
+            if messageID is None:
+                return
+            for _, messageID in self._deliveredThrough(messageID):
+                self._smsByID[messageID] = None
+            while len(self._smsByID) > self.MAX_SMS_PENDING:
+                self._smsByID.popitem(last=False)
+        elif operation == specialFrame.MESSAGE_RESULT:
+            wireID, result = fields
+            messageID = self._messageID(wireID)
+            if messageID in self._smsByID:
+                del self._smsByID[messageID]
+                self._outputSmsResult(messageID, result)
+        elif operation == specialFrame.SYNC_PAGE:
+            self._onSyncPage(buffer, *fields)
+        elif operation == specialFrame.SYNC_END:
+            syncID, watermark, result = fields
+            if syncID != self._syncing:
+                return
+            self._syncing = None
+            self._output(self.OUTPUT_HISTORY_SYNCED, \
+                         {'syncID': syncID, 'watermark': watermark, \
+                          'complete': result == 0})
+    
+    def _outputSmsResult(self, messageID, result):
+        if result == 0:
+            self._outputMessageStatus(messageID, self.MESSAGE_SMS_SENT)
+        else:
+            self._outputMessageStatus(messageID, self.MESSAGE_SMS_FAILED)
+    
+    def _onSyncPage(self, buffer, syncID, count):
+        if syncID != self._syncing:
+            # Left over from a sync that was asked again
+            return
+        try:
+            records = list(HistoryRecord.decodePage(buffer, count))
+        except TextMessageError as e:
+            _decodeErrors.inc()
+            self._outputError(e, "Could not decode a page of history")
+            # Storing the pages after it would leave it below the
+            # watermark, so the phone gets no more credit and what it
+            # still sends is left over. The next sync starts from the
+            # page before it.
+            self._syncing = None
+            self._output(self.OUTPUT_HISTORY_SYNCED, \
+                         {'syncID': syncID, \
+                          'watermark': self._syncWatermark, \
+                          'complete': False})
+            return
+        _historyRecords.inc(len(records))
+        watermark = max((record.phoneID for record in records), default=0)
+        self._syncWatermark = max(self._syncWatermark, watermark)
+        self._output(self.OUTPUT_HISTORY_PAGE, \
+                     {'syncID': syncID, 'records': records, \
+                      'watermark': watermark})
+
+    def _onChunk(self, buffer):
+        _chunksIn.inc()
+        try:
+            incoming = self._reassembler.add(buffer)
+        except TransferError as e:
+            _transferErrors.inc()
+            log.warning("Chunk not used: %s", e)
+            resumes = self._reassembler.resumes()
+            if resumes:
+                self._writeControl(specialFrame.transferStatus(resumes))
+            return
+        if incoming is None:
+            return
+        try:
+            _transfersIn.inc()
+            _transferBytes.inc(incoming.size)
+            _transferTime.observe(time.perf_counter() - incoming.startedAt)
+            self._onTransfer(incoming)
+        finally:
+            incoming.close()
     
+    def _onTransfer(self, incoming):
+        """Handles the payload of a complete transfer"""
+        with incoming.payload() as payload:
+            kind = payload[0]
+            if kind != transfer.ATTACHMENT:
+                if kind == CHUNK:
+                    self._outputError(TransferError("Chunk in a chunk"), \
+                                      "Could not use a transfer")
+                else:
+                    self._outputBluetoothMessage(payload)
+                return
+        try:
+            phoneNumber, contactName, name, mimeType, path = \
+                incoming.saveAttachment(self.attachmentDir)
+        except (TransferError, OSError) as e:
+            _transferErrors.inc()
+            self._outputError(e, "Could not save an attachment")
+            return
+        self._output(self.OUTPUT_ATTACHMENT_RECEIVED, \
+                     {'phoneNumber': phoneNumber, \
+                      'contactName': contactName, 'name': name, \
+                      'mimeType': mimeType, 'path': path, \
+                      'size': os.path.getsize(path)})
+
+class MultiplexManager(MultiplexService):
+    '''Extended MultiplexService for project specific use
+
+    The text messages of every connected device are decoded as by the
+    BluetoothManager and carry the deviceID they came from.
+
+    Public Constants:
+    OUTPUT_RECEIVED_TEXT_MESSAGE
+
+    Public Methods:
+    (none)
+    '''
+
+    OUTPUT_RECEIVED_TEXT_MESSAGE = events.RECEIVED_TEXT_MESSAGE
+
+    def _outputBluetoothMessage(self, buffer, deviceID):
+        _outputFrame(self, buffer, {'deviceID': deviceID})
+
+def _outputFrame(service, buffer, args):
+    """Turns a received frame into the output of a service, args are
+    added to the output's args"""
+    if buffer[0] == COMPRESSED:
+        buffer = _inflate(service, buffer)
+        if buffer is None:
+            return
+    messageType = buffer[0]
+    if messageType == TEXT_MESSAGE:
+        # recieved text message
+        try:
+            message, _ = TextMessage.decode(buffer, 1)
+        except TextMessageError as e:
+            _decodeErrors.inc()
+            service._outputError(e, "Could not decode a text message")
+            return
+        args['message'] = message
+        args['receivedAt'] = time.perf_counter()
+        service._output(service.OUTPUT_RECEIVED_TEXT_MESSAGE, args)
+    elif messageType == SPECIAL:
+        # Acknowledgements are only followed by the BluetoothManager
+        pass
+    else:
+        # Something went wrong
+        pass
+
+def _inflate(service, buffer):
+    """Returns the payload of a COMPRESSED frame, or None after
+    reporting it to the service if it could not be inflated"""
+    try:
+        payload = compression.inflate(buffer)
+    except CompressionError as e:
+        _decodeErrors.inc()
+        service._outputError(e, "Could not inflate a compressed frame")
+        return None
+    _compressedIn.inc()
+    _bytesSaved.inc(len(payload) - len(buffer))
+    return payload
+        
+# Fixed size layouts of a text message body. The contact name follows
+# the header and the message follows its 4 byte length.
+_TEXT_HEADER = struct.Struct('>12sB') # phoneNumber, contactLength
+_MESSAGE_LENGTH = struct.Struct('>i')
+
 class TextMessage():
     """Contains phoneNumber, contactName, and message as Strings"""
-    def __init__(self, byteArray):
-        logging.debug(f"byteArray: {byteArray}")
-        msg = MessageBuffer(byteArray)
-        # get the phone Number
-        self.phoneNumber = msg.read(12).decode()
-        # get the contact's Name
-        contactLength = int(msg.read(1))
-        self.contactName = msg.read(contactLength).decode()
-        # get the message
-        messageLengthArray = msg.read(4)
-        messageLength = int.from_bytes(messageLengthArray, \
-                                       'big', \
-                                       signed=True)
-        self.message = msg.read(messageLength).decode()
-        logging.debug(f"phoneNumber: {self.phoneNumber}")
-        logging.debug(f"contactLength: {contactLength}")
-        logging.debug(f"contactName: {self.contactName}")
-        logging.debug(f"messageLength: {messageLength}")
-        logging.debug(f"message: {self.message}")
+    __slots__ = ('phoneNumber', 'contactName', 'message')
+
+    def __init__(self, phoneNumber, contactName, message):
+        self.phoneNumber = phoneNumber
+        self.contactName = contactName
+        self.message = message
+
+    @classmethod
+    def decode(cls, buffer, offset=0):
+        """Reads a text message body out of buffer starting at offset
         
-def getBytes(phoneNumber, message):
+        The headers are unpacked in place from a memoryview so only the
+        text fields are copied out of the buffer. Returns a tuple of the
+        TextMessage and the offset just past the end of it.
+        """
+        view = memoryview(buffer)
+        try:
+            phoneNumber, contactLength = \
+                _TEXT_HEADER.unpack_from(view, offset)
+            contactStart = offset + _TEXT_HEADER.size
+            lengthStart = contactStart + contactLength
+            (messageLength,) = _MESSAGE_LENGTH.unpack_from(view, lengthStart)
+        except struct.error as e:
+            raise TextMessageError("Text message header is truncated") from e
+        messageStart = lengthStart + _MESSAGE_LENGTH.size
+        messageEnd = messageStart + messageLength
+        if messageLength < 0 or messageEnd > len(view):
+            raise TextMessageError(f"Invalid message length {messageLength}")
+        return (cls(str(phoneNumber, 'utf-8', 'replace'), \
+                    str(view[contactStart:lengthStart], 'utf-8', 'replace'), \
+                    str(view[messageStart:messageEnd], 'utf-8', 'replace')), \
+                messageEnd)
+
+class HistoryRecord():
+    """A message from the phone's history
+
+    phoneID is the phone's id of the message, timestamp is in seconds,
+    direction is 0 for received and 1 for sent messages and message is
+    the TextMessage.
+    """
+    __slots__ = ('phoneID', 'timestamp', 'direction', 'message')
+
+    def __init__(self, phoneID, timestamp, direction, message):
+        self.phoneID = phoneID
+        self.timestamp = timestamp
+        self.direction = direction
+        self.message = message
+
+    @classmethod
+    def decodePage(cls, buffer, count):
+        """Generator that yields the count records of a SYNC_PAGE frame,
+        decoding each one in place as it is reached"""
+        view = memoryview(buffer)
+        offset = specialFrame.PAGE_HEADER_SIZE
+        for _ in range(count):
+            try:
+                phoneID, milliseconds, direction = \
+                    specialFrame.RECORD_HEADER.unpack_from(view, offset)
+            except struct.error as e:
+                raise TextMessageError("History record is truncated") from e
+            message, offset = TextMessage.decode(view, \
+                                offset + specialFrame.RECORD_HEADER.size)
+            yield cls(phoneID, milliseconds / 1000, direction, message)
+
+    def encode(self):
+        """Returns the record as it is sent in a SYNC_PAGE"""
+        return specialFrame.RECORD_HEADER.pack(self.phoneID, \
+                                               int(self.timestamp * 1000), \
+                                               self.direction) \
+            + getBytes(self.message.phoneNumber, self.message.message, \
+                       self.message.contactName)[1:]
+
+def decodeMany(buffer):
+    """Generator that yields every TextMessage in a buffer of frames
+    
+    buffer holds any number of complete length prefixed frames, as they
+    arrive from the remote device. Frames that are not text messages are
+    skipped.
+    """
+    view = memoryview(buffer)
+    offset = 0
+    end = len(view)
+    while offset + FRAME_HEADER.size <= end:
+        (length,) = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        frameEnd = offset + length
+        if frameEnd > end:
+            raise TextMessageError("Buffer ends part way through a frame")
+        if length > 0 and view[offset] == TEXT_MESSAGE:
+            yield TextMessage.decode(view[:frameEnd], offset + 1)[0]
+        offset = frameEnd
+        
+def getBytes(phoneNumber, message, contactName='none'):
     """Returns a byte[] in a sendable format that the android app can
     turn into a text message."""
-    output = phoneNumber.encode()
-    output += b'\x04'
-    output += b'none'
-    mLength = int(len(message))
+    output = bytes((TEXT_MESSAGE,))
+    output += phoneNumber.encode()
+    contactBytes = contactName.encode()[:255]
+    output += bytes((len(contactBytes),))
+    output += contactBytes
+    messageBytes = message.encode()
+    mLength = len(messageBytes)
     output += mLength.to_bytes(4, 'big', signed=True)
-    output += message.encode()
+    output += messageBytes
     return output
-    
-        
-        
+
+class TextMessageError(Exception):
+    """Raised when a text message can not be decoded"""
+    pass
@@ -7,45 +7,103 @@ Created on Feb 20, 2019
         the sockets. This may likely be an issue with pybluez.
 '''
 
-from threading import Thread
-from queue import Queue
-import bluetooth
+from collections import OrderedDict, deque
+from threading import Thread, Condition, Event as ThreadEvent, Lock, \
+    current_thread
+from queue import Empty
+import random
+import socket
+from src import events, metrics
+from src.boundedQueue import BoundedQueue, COALESCE, DROP
+from src.events import Event
+from src.frameReader import FrameReader, FRAME_HEADER
+from src.transport import RfcommTransport
 import logging
+import time
+
+# Shared by every service, see src.metrics
+_bytesIn = metrics.counter("bluetooth.bytes_in")
+_framesIn = metrics.counter("bluetooth.frames_in")
+_bytesOut = metrics.counter("bluetooth.bytes_out")
+_framesOut = metrics.counter("bluetooth.frames_out")
+_writeFailures = metrics.counter("bluetooth.write_failures")
+_frameErrors = metrics.counter("bluetooth.frame_errors")
+_connections = metrics.counter("bluetooth.connections")
+_reconnects = metrics.counter("bluetooth.reconnects")
+_writeToAck = metrics.histogram("bluetooth.write_to_ack")
+
+log = logging.getLogger(__name__)
 
 class BluetoothService(Thread):
     '''Create and manage bluetooth serial connections
     
     Class deigning to asyncronusly manage bluetooth connections. This
     class utilizes the pyBluez project to interact with the bluetooth
-    adapter. Results are returned through a Queue that should be
-    provided thorugh the constructor.
+    adapter. Results are returned as events.Event(outType, args)
+    through a Queue that should be provided thorugh the constructor.
     
     This class was written to be completely resuable for all pybluez
     projects.
     
+    A connection that is lost is re-established in the background, as
+    server or client, whichever it was made as. Attempts are spaced out
+    with jittered exponential backoff and OUTPUT_RECONNECTING is sent
+    before each one. Every message written is kept in an outbox until
+    it is acknowledged and whatever is left in it is sent again, in
+    order, once the connection is back. Only when reconnecting is given
+    up is OUTPUT_CONNECTION_LOST sent and the outbox failed.
+    
+    A message that was on the wire when the connection was lost may have
+    reached the remote device already. It is only sent again if it went
+    out with an id the remote device can tell it by (see _identify()),
+    otherwise its OUTPUT_MESSAGE_STATUS is MESSAGE_UNKNOWN and it leaves
+    the outbox. A reconnect is taken to be to the same remote device, so
+    it acknowledges messages as it did on the last connection.
+    
+    A message is acknowledged once it has been written to the socket,
+    unless _enableAcks() has been called for the connection. From then
+    on the remote device acknowledges messages itself, by sequence
+    number (see _deliveredUpTo()), and at most SEND_WINDOW messages are
+    on the wire without an acknowledgement. OUTPUT_MESSAGE_STATUS tells
+    when a message is on the wire and OUTPUT_WRITE_SUCCESS, with
+    'delivered' set, when the remote device has it.
+    
+    discover() sends the devices the transport already knows as an
+    OUTPUT_DISCOVER_RESULT with 'cached' set straight away. Then every
+    device is sent as an OUTPUT_DEVICE_FOUND the moment the scan finds
+    it, and again once its name is known. The scan stops early when the
+    device discover() was given is found. A last OUTPUT_DISCOVER_RESULT
+    has every device found.
+    
     Public Constants:
     STATE_NONE
     STATE_CONNECTING
     STATE_CONNECTED
     OUTPUT_DISCOVER_STARTED
     OUTPUT_DISCOVER_RESULT
+    OUTPUT_DEVICE_FOUND
     OUTPUT_DISCOVER_COMPLETE
     OUTPUT_CONNECTION_MADE
     OUTPUT_CONNECTION_FAILED
     OUTPUT_CONNECTION_LOST
+    OUTPUT_RECONNECTING
     OUTPUT_DISCONNECTED
     OUTPUT_BLUETOOTH_MESSAGE
     OUTPUT_WRITE_SUCCESS
     OUTPUT_WRITE_FAILED
+    OUTPUT_MESSAGE_STATUS
+    MESSAGE_ON_WIRE
+    MESSAGE_UNKNOWN
     OUTPUT_ERROR
     OUTPUT_NOTE
     
     Public Methods:
-    discover()
+    discover(String target)
     connectAsServer()
     connectAsClient(String macID)
     write(byte[] message)
     disconnect()
+    connectionCount()
     join()
     '''
     
@@ -55,24 +113,43 @@ class BluetoothService(Thread):
     STATE_CONNECTED = "connected"
     
     # Output Types
-    OUTPUT_DISCOVER_STARTED = "discoverStarted"
-    OUTPUT_DISCOVER_RESULT = "discoverResult"
-    OUTPUT_DISCOVER_COMPLETE = "discoverComplete"
-    OUTPUT_CONNECTION_MADE = "connectionMade"
-    OUTPUT_CONNECTION_FAILED = "connectionFailedError"
-    OUTPUT_CONNECTION_LOST = "connectionLostError"
-    OUTPUT_DISCONNECTED = "disconnected"
-    OUTPUT_BLUETOOTH_MESSAGE = "message"
-    OUTPUT_WRITE_SUCCESS = "writeSuccess"
-    OUTPUT_WRITE_FAILED = "writeFailed"
-    OUTPUT_ERROR = "error"
-    OUTPUT_NOTE = "note"
+    OUTPUT_DISCOVER_STARTED = events.DISCOVER_STARTED
+    OUTPUT_DISCOVER_RESULT = events.DISCOVER_RESULT
+    OUTPUT_DEVICE_FOUND = events.DEVICE_FOUND
+    OUTPUT_DISCOVER_COMPLETE = events.DISCOVER_COMPLETE
+    OUTPUT_CONNECTION_MADE = events.CONNECTION_MADE
+    OUTPUT_CONNECTION_FAILED = events.CONNECTION_FAILED
+    OUTPUT_CONNECTION_LOST = events.CONNECTION_LOST
+    OUTPUT_RECONNECTING = events.RECONNECTING
+    OUTPUT_DISCONNECTED = events.DISCONNECTED
+    OUTPUT_BLUETOOTH_MESSAGE = events.BLUETOOTH_MESSAGE
+    OUTPUT_WRITE_SUCCESS = events.WRITE_SUCCESS
+    OUTPUT_WRITE_FAILED = events.WRITE_FAILED
+    OUTPUT_MESSAGE_STATUS = events.MESSAGE_STATUS
+    OUTPUT_ERROR = events.ERROR
+    OUTPUT_NOTE = events.NOTE
+    
+    # Statuses of OUTPUT_MESSAGE_STATUS
+    MESSAGE_ON_WIRE = "on-wire"
+    # On the wire when the connection was lost, not sent again
+    MESSAGE_UNKNOWN = "unknown"
+    
+    # Most commands waiting for the service thread
+    MAX_COMMANDS = 64
+    # Most messages waiting to be acknowledged
+    MAX_OUTBOX = 4096
+    # Most messages on the wire that the remote device has not yet
+    # acknowledged, when it acknowledges them
+    SEND_WINDOW = 32
+    # Backoff between attempts to get a lost connection back, in seconds
+    RECONNECT_MIN_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30.0
+    RECONNECT_ATTEMPTS = 10
     
     # commands
     __DISCOVER = "discover"
     __SERVER_CONNECT = "serverConnect"
     __CLIENT_CONNECT = "clientConnect"
-    __WRITE = "write"
     __THREAD_DONE = "done"
     __DISCONNECT = "disconnect"
     __STOP = "stop"
@@ -81,37 +158,60 @@ class BluetoothService(Thread):
     __MAIN_THREAD = "main"
     __DISCOVERY_THREAD = "discovery"
     __CONNECTION_THREAD = "connection"
-    __WRITE_THREAD = "write"
 
-    def __init__(self, uuid, serviceName, outputQueue):
+    def __init__(self, uuid, serviceName, outputQueue, transport=None, \
+                 reconnect=True):
         '''Constructor
         
         The uuid and serviceName are strings and should match for 
         whatever other device you are connecting to. The outputQueue
-        should be a standard Queue object that gets populated with the
-        output of the service threads.
+        should be a Queue or EventBus object that gets populated with the
+        output of the service threads. When it is bounded and full,
+        reading from the connection waits for room, which pushes back
+        on the remote device. transport is a Transport from
+        src.transport and defaults to bluetooth RFCOMM. With reconnect
+        False a lost connection stays lost.
         '''
         super(BluetoothService, self).__init__()
         self.state = self.STATE_NONE
         self.uuid = uuid
         self.name = serviceName
-        self.commandInput = Queue()
+        self.transport = transport or RfcommTransport()
+        self.reconnect = reconnect
+        self.commandInput = BoundedQueue(self.MAX_COMMANDS)
         self.outputQueue = outputQueue # Use the _output() method to access
         self.threadList = []
         self._mySock = None
         self._remoteSock = None
         self._remoteInfo = None
+        self._writer = None
         self._messageCounter = 0
+        self._connectionCount = 0
+        self._address = None # None when connected as server
+        self._outbox = OrderedDict() # messageID -> message, not yet acked
+        self._outboxLock = Lock()
+        # messageIDs in the outbox that went out without an id, so may be
+        # on the remote device already
+        self._unidentified = set()
+        self._acking = False # the remote device acknowledges messages
+        self._reconnecting = False
+        self._cancelWait = ThreadEvent() # cuts a backoff short
         self.canceled = False
+        metrics.gauge("bluetooth.commands_queued", self.commandInput.qsize)
+        metrics.gauge("bluetooth.threads", lambda: len(self.threadList))
+        metrics.gauge("bluetooth.writes_queued", self._writesQueued)
+        metrics.gauge("bluetooth.outbox", lambda: len(self._outbox))
         self.start()
         
-    def discover(self):
-        """Launch a thread that begins the discovery process"""
-        self.commandInput.put((self.__DISCOVER,))
+    def discover(self, target=None):
+        """Launch a thread that begins the discovery process. It stops
+        as soon as the device with address target is found."""
+        self.commandInput.put((self.__DISCOVER, target))
         
     def connectAsServer(self):
         """Launch a thread to make a connection as a bluetooth Server"""
         if self.state == self.STATE_NONE:
+            self._address = None
             self.commandInput.put((self.__SERVER_CONNECT,))
         else:
             raise BluetoothManagerError()
@@ -119,33 +219,50 @@ class BluetoothService(Thread):
     def connectAsClient(self, macID):
         """Launch a thread to make a connection as a bluetooth Client"""
         if self.state == self.STATE_NONE:
-            self.commandInput.put((self.__Client_CONNECT, macID))
+            self._address = macID
+            self.commandInput.put((self.__CLIENT_CONNECT, macID))
         else:
             raise BluetoothManagerError()
     
-    def write(self, message):
+    def write(self, message, deviceID=None):
         """Send a byte[] as a message to the connected device
         
         Returns a messageID to be able to track if the write was
-        successful or not.
+        successful or not. While reconnecting the message waits in the
+        outbox. deviceID is only there for the MultiplexService's sake,
+        there is only ever one device.
         """
-        if self.state == self.STATE_CONNECTED:
+        if self.state != self.STATE_CONNECTED and not self._reconnecting:
+            raise BluetoothWriteError()
+        with self._outboxLock:
+            if len(self._outbox) >= self.MAX_OUTBOX:
+                raise BluetoothWriteError("Too many messages waiting to " \
+                                          "be sent")
             self._messageCounter += 1
             messageID = self._messageCounter
-            self.commandInput.put((self.__WRITE, message, messageID))
+            self._outbox[messageID] = message
+            if self._writer is not None \
+                    and not self._writer.put(message, messageID):
+                # Control frames share the writer's queue, so it can be
+                # full when the outbox is not
+                del self._outbox[messageID]
+                raise BluetoothWriteError("Too many messages waiting to " \
+                                          "be sent")
             return messageID
-        else:
-            raise BluetoothWriteError()
         
     def disconnect(self):
         """Disconnect from the connected device"""
         if self.state != self.STATE_NONE:
-            logging.debug("Sending disconnect input command")
+            log.debug("Sending disconnect input command")
             self.commandInput.put((self.__DISCONNECT,))
         
+    def connectionCount(self):
+        """Number of devices connected right now, 0 or 1"""
+        return 1 if self.state == self.STATE_CONNECTED else 0
+        
     def join(self, timeout=None):
         """Request to join the thread that runs the Bluetooth Serivce"""
-        self.commandInput.put((self.__STOP,))
+        self.commandInput.put((self.__STOP,), COALESCE, self.__STOP)
         Thread.join(self, timeout=timeout)
     
     #-----------------------------Output Methods-------------------------------
@@ -156,14 +273,19 @@ class BluetoothService(Thread):
         Every output should use this method to write to the Queue in
         order to preserve consistancy/readability on the receiving end.
         """
-        self.outputQueue.put((outType, args))
+        self.outputQueue.put(Event(outType, args))
         
     def _outputDiscoveryStarted(self):
         self._output(self.OUTPUT_DISCOVER_STARTED, {})
         
-    def _outputDiscoveryResult(self, result):
-        self._output(self.OUTPUT_DISCOVER_RESULT, {'result': result})
+    def _outputDiscoveryResult(self, result, cached=False):
+        self._output(self.OUTPUT_DISCOVER_RESULT, {'result': result, \
+                                                   'cached': cached})
         
+    def _outputDeviceFound(self, address, name):
+        self._output(self.OUTPUT_DEVICE_FOUND, {'address': address, \
+                                                'name': name})
+    
     def _outputDiscoveryComplete(self):
         self._output(self.OUTPUT_DISCOVER_COMPLETE, {})
         
@@ -178,19 +300,37 @@ class BluetoothService(Thread):
         self._output(self.OUTPUT_CONNECTION_LOST, {'comment': comment, \
                                                    'error': e})
         
+    def _outputReconnecting(self, e, attempt, delay):
+        self._output(self.OUTPUT_RECONNECTING, {'comment': "Reconnecting", \
+                                                'error': e, \
+                                                'attempt': attempt, \
+                                                'delay': delay})
+        
     def _outputDisconnected(self, comment):
         self._output(self.OUTPUT_DISCONNECTED, {'comment': comment})
         
-    def _outputWriteSuccess(self, messageID):
-        self._output(self.OUTPUT_WRITE_SUCCESS, {'messageID': messageID})
+    def _outputWriteSuccess(self, messageID, delivered=False):
+        self._output(self.OUTPUT_WRITE_SUCCESS, {'messageID': messageID, \
+                                                 'delivered': delivered})
+        
+    def _outputMessageStatus(self, messageID, status):
+        self._output(self.OUTPUT_MESSAGE_STATUS, {'messageID': messageID, \
+                                                  'status': status})
         
     def _outputWriteFailed(self, messageID, e, comment):
+        _writeFailures.inc()
         self._output(self.OUTPUT_WRITE_FAILED, {'messageID': messageID, \
                                                 'comment': comment, \
                                                 'error': e})
 
     def _outputBluetoothMessage(self, buffer):
-        self._output(self.OUTPUT_BLUETOOTH_MESSAGE, {'message': buffer})
+        """Called once for every complete frame received
+
+        buffer is a memoryview into the receive buffer and is only valid
+        for the duration of the call.
+        """
+        self._output(self.OUTPUT_BLUETOOTH_MESSAGE, \
+                     {'message': bytes(buffer)})
         
     def _outputError(self, e, comment):
         self._output(self.OUTPUT_ERROR, {'comment': comment, 'error': e})
@@ -200,21 +340,120 @@ class BluetoothService(Thread):
     
     #-----------------------------Internal Methods-----------------------------
     
+    def _writesQueued(self):
+        writer = self._writer
+        return writer.queue.qsize() if writer is not None else 0
+    
+    def _acknowledged(self, messageID, delivered=False):
+        """The message is done with, it leaves the outbox. delivered is
+        True when the remote device said it has it."""
+        with self._outboxLock:
+            self._outbox.pop(messageID, None)
+            self._unidentified.discard(messageID)
+        self._outputWriteSuccess(messageID, delivered)
+    
+    def _onWire(self, messageID, identified):
+        """The writer sent a message that waits for an acknowledgement,
+        identified is True when it went out with its id"""
+        if not identified:
+            with self._outboxLock:
+                if messageID in self._outbox:
+                    self._unidentified.add(messageID)
+        self._outputMessageStatus(messageID, self.MESSAGE_ON_WIRE)
+    
+    def _greeting(self):
+        """Returns the frames sent ahead of everything else on a new
+        connection, for a handshake. None unless overridden."""
+        return ()
+    
+    def _encodeFrame(self, payload):
+        """Returns a message's payload as it is sent on this connection.
+        Unchanged unless overridden."""
+        return payload
+    
+    def _identify(self, payload, messageID):
+        """Returns the frame a message is sent as with messageID in it,
+        for the remote device to tell it apart from a message it already
+        has. Called when the message is sent, None unless overridden."""
+        return None
+    
+    def _writeControl(self, payload):
+        """Sends a frame that is not a message, so is not counted,
+        acknowledged or kept in the outbox"""
+        writer = self._writer
+        if writer is not None:
+            writer.putControl(payload)
+    
+    def _enableAcks(self):
+        """The remote device acknowledges messages on this connection,
+        from the next one sent"""
+        self._acking = True
+        writer = self._writer
+        if writer is not None:
+            writer.enableAcks()
+    
+    def _deliveredUpTo(self, sequence):
+        """The remote device acknowledged every message up to sequence
+        
+        Returns a list of (sequence, messageID) of the messages that
+        were waiting for it.
+        """
+        writer = self._writer
+        if writer is None:
+            return []
+        return self._delivered(writer.acknowledge(sequence))
+    
+    def _deliveredThrough(self, messageID):
+        """The remote device acknowledged every message up to messageID,
+        for messages that went out with their ids
+        
+        Returns a list of (sequence, messageID) as _deliveredUpTo().
+        """
+        writer = self._writer
+        if writer is None:
+            return []
+        return self._delivered(writer.acknowledgeMessage(messageID))
+    
+    def _delivered(self, delivered):
+        now = time.perf_counter()
+        for _, messageID, sentAt in delivered:
+            _writeToAck.observe(now - sentAt)
+            self._acknowledged(messageID, True)
+        return [(sequence, messageID) for sequence, messageID, _ in delivered]
+    
+    def _sendFailed(self, messageID, e):
+        """The writer could not send a message. It stays in the outbox
+        to be sent again or failed with the connection."""
+        log.debug("Message %d not sent: %s", messageID, e)
+        with self._outboxLock:
+            self._unidentified.discard(messageID)
+    
+    def _failOutbox(self, e, comment):
+        """Reports every message that will never be acknowledged"""
+        with self._outboxLock:
+            messageIDs = list(self._outbox)
+            self._outbox.clear()
+            self._unidentified.clear()
+        for messageID in messageIDs:
+            self._outputWriteFailed(messageID, e, comment)
+    
     def _threadDone(self, myThread):
         """called when a worker thread completes its execution
         
         so it may be joined and cleaned up.
         """
-        self.commandInput.put((self.__THREAD_DONE, myThread))
+        # Never waits, the service thread may be joining this thread
+        self.commandInput.put((self.__THREAD_DONE, myThread), COALESCE, \
+                              myThread)
     
     def run(self):
         """Endless loop waiting for inputs instructions"""
         while True:
-            logging.debug(f"BluetoothService trying to get a command")
             command = self.commandInput.get()
-            logging.info(f"BluetoothService command: {command[0]}")
+            log.info("BluetoothService command: %s", command[0])
             if command[0] == self.__DISCOVER:
-                newThread = WorkerThread(self, target=self._discoverTread)
+                newThread = WorkerThread(self, target=self._discoverTread,
+                                         args=(command[1],))
                 self.threadList.append((self.__DISCOVERY_THREAD, newThread))
                 newThread.start()
                 continue
@@ -224,7 +463,6 @@ class BluetoothService(Thread):
                                          target=self._connectAsServerThread)
                 self.threadList.append((self.__CONNECTION_THREAD, newThread))
                 newThread.start()
-                logging.debug("IS THIS BLOCKING???")
                 continue
                 
             elif command[0] == self.__CLIENT_CONNECT:
@@ -235,14 +473,6 @@ class BluetoothService(Thread):
                 newThread.start()
                 continue
             
-            elif command[0] == self.__WRITE:
-                newThread = WorkerThread(self,
-                                         target=self._writeThread,
-                                         args=(command[1], command[2]))
-                self.threadList.append((self.__WRITE_THREAD, newThread))
-                newThread.start()
-                continue
-            
             elif command[0] == self.__THREAD_DONE:
                 myThread = command[1]
                 try:
@@ -256,52 +486,66 @@ class BluetoothService(Thread):
                 continue
                 
             elif command[0] in (self.__DISCONNECT, self.__STOP):
-                logging.debug("disconnecting, hi")
+                log.debug("Disconnecting")
                 self.canceled = True
-                if self._remoteSock != None:
-                    try:
-                        self._remoteSock.close()
-                        logging.debug("Remote Sock closed")
-                    except Exception as e:
-                        self._outputError(e, "Failed to close remote socket")
-                    self._remoteSock = None
-                    self._remoteInfo = None
+                self._cancelWait.set()
+                self._closeRemote()
                 if self._mySock != None:
+                    try:
+                        # and an accept blocked in a connection thread
+                        self._mySock.shutdown(socket.SHUT_RDWR)
+                    except Exception:
+                        pass
                     try:
                         self._mySock.close()
-                        logging.debug("My Sock closed")
+                        log.debug("Listening socket closed")
                     except Exception as e:
                         self._outputError(e, "Failed to close socket")
                     self._mySock = None
+                self._stopWriter()
                 while len(self.threadList) > 0:
                     trd = self.threadList.pop(-1)
                     trd[1].cancel()
                     trd[1].join()
+                self._failOutbox(None, "Connection closed")
                 self.state = self.STATE_NONE
+                self._cancelWait.clear()
                 self.canceled = False
-                logging.debug("Should be disconnected now")
+                log.debug("Disconnected")
                 if command[0] == self.__STOP:
                     return
                 else:
                     continue
         
-    def _discoverTread(self):
+    def _discoverTread(self, target):
         """Scans the area for discoverable bluetooth devices"""
         self._outputDiscoveryStarted()
-        devices = bluetooth.discover_devices(duration=8, 
-                                             flush_cache=True, 
-                                             lookup_names=True, 
-                                             lookup_class=False, 
-                                             device_id=-1)
-        self._outputDiscoveryResult(devices)
+        known = self.transport.knownDevices()
+        if known:
+            self._outputDiscoveryResult(known, cached=True)
+        worker = current_thread()
+        targetFound = ThreadEvent()
+        
+        def found(address, name):
+            self._outputDeviceFound(address, name)
+            if address == target:
+                targetFound.set()
+        
+        def stop():
+            return worker.canceled or self.canceled or targetFound.is_set()
+        
+        try:
+            devices = self.transport.discover(found, stop)
+        except Exception as e:
+            self._outputError(e, "Discovery failed")
+        else:
+            self._outputDiscoveryResult(devices)
         self._outputDiscoveryComplete()
         
     def _connectAsServerThread(self):
         """Allow a connection to be made from a remote device"""
         try:
-            self._mySock = bluetooth.BluetoothSocket()
-            self._mySock.bind(("", bluetooth.PORT_ANY))
-            self._mySock.listen(1)
+            self._mySock = self.transport.listen()
         except Exception as e:
             self._connectionFailed(e, "Failed to create a server socket.")
             return
@@ -313,13 +557,7 @@ class BluetoothService(Thread):
                          + str(self._mySock))
         
         try:
-            bluetooth.advertise_service( \
-                sock=self._mySock, \
-                name=self.name, \
-                service_id=self.uuid, \
-                service_classes=[self.uuid, bluetooth.SERIAL_PORT_CLASS], \
-                profiles=[bluetooth.SERIAL_PORT_PROFILE] \
-                )
+            self.transport.advertise(self._mySock, self.name, self.uuid)
         except Exception as e:
             self._connectionFailed(e, "Failed to advertise the service.")
             return
@@ -330,7 +568,8 @@ class BluetoothService(Thread):
         self._outputNote("Awaiting connection")
         
         try:
-            self._remoteSock, self._remoteInfo = self._mySock.accept()
+            self._remoteSock, self._remoteInfo = \
+                self.transport.accept(self._mySock)
         except Exception as e:
             self._connectionFailed(e, "There was an issue accepting " \
                                       "connections.")
@@ -343,31 +582,14 @@ class BluetoothService(Thread):
         self._listen()
     
     def _connectAsClientThread(self, address):
-        """Attempt to make a connection with another bluetooth device."""
-        try:
-            foundServices = bluetooth.find_service(self.name, \
-                                                   self.uuid, \
-                                                   address)
-        except Exception as e:
-            self._connectionFailed(e, "Could not search for any matching " \
-                                      "broadcasts.")
-            
-        
-        if (self.canceled):
-            self._connectionCanceled()
-            return 
-        if len(foundServices) == 0:
-            self._connectionFailed(None, "Didn't find any matching broadcasts")
-            
-        match = foundServices[0]
-        self._remoteInfo = (match['host'], match['port'])
-        self._remoteSock = bluetooth.BluetoothSocket()
+        """Attempt to make a connection with another device."""
         try:
-            self._remoteSock.connect()
+            self._remoteSock, self._remoteInfo = \
+                self.transport.connect(address, self.name, self.uuid)
         except Exception as e:
-            self._connectionFailed(e, "Error when connection to the remote " \
-                                      "Device.")
-        
+            self._connectionFailed(e, "Error when connecting to the " \
+                                      "remote Device.")
+            return
         
         if (self.canceled):
             self._connectionCanceled()
@@ -376,9 +598,45 @@ class BluetoothService(Thread):
         self._listen()
             
     def _connectionMade(self):
+        _connections.inc()
+        if self._connectionCount:
+            _reconnects.inc()
+        self._connectionCount += 1
         device = RemoteDevice(None, self._remoteInfo[0], self._remoteInfo[1])
-        self._outputConnectionMade(device)
+        # A new connection may be to another device
+        self._acking = self._acking and self._reconnecting
+        # Whatever was not acknowledged on the last connection goes
+        # first, write() can not get in between under the lock
+        with self._outboxLock:
+            writer = WriterThread(self, self._remoteSock, self.SEND_WINDOW)
+            if self._acking:
+                writer.enableAcks()
+            for payload in self._greeting():
+                writer.putControl(payload)
+            dropped = []
+            unknown = [messageID for messageID in self._outbox \
+                       if messageID in self._unidentified]
+            for messageID in unknown:
+                del self._outbox[messageID]
+            self._unidentified.clear()
+            for messageID, message in self._outbox.items():
+                if not writer.put(message, messageID):
+                    dropped.append(messageID)
+            for messageID in dropped:
+                del self._outbox[messageID]
+            replayed = len(self._outbox)
+            self._writer = writer
+        # Connected before anyone hears of it, so they can write
         self.state = self.STATE_CONNECTED
+        self._outputConnectionMade(device)
+        if replayed:
+            self._outputNote(f"Sending {replayed} messages again")
+        for messageID in unknown:
+            self._outputMessageStatus(messageID, self.MESSAGE_UNKNOWN)
+        for messageID in dropped:
+            self._outputWriteFailed(messageID, None, "Too many messages " \
+                                                     "waiting to be sent")
+        writer.start()
     
     def _connectionFailed(self, e, reason):
         self._outputConnectionFailed(e, reason)
@@ -389,33 +647,132 @@ class BluetoothService(Thread):
         self.state = self.STATE_NONE
     
     def _connectionLost(self, e):
+        self._stopWriter()
+        self._failOutbox(e, "Connection lost")
         self._outputConnectionLost(e, "The connection was lost")
         self.state = self.STATE_NONE
     
+    def _reconnect(self, e):
+        """Gets a lost connection back, returns False if it was given
+        up or the service was told to disconnect
+        
+        Waits between attempts double up to RECONNECT_MAX_DELAY. Each
+        is drawn from the upper half of its range so that a failure on
+        the phone's side does not bring every attempt back in step.
+        """
+        self._reconnecting = True
+        self.state = self.STATE_CONNECTING
+        self._stopWriter()
+        self._closeRemote()
+        delay = self.RECONNECT_MIN_DELAY
+        try:
+            for attempt in range(1, self.RECONNECT_ATTEMPTS + 1):
+                wait = random.uniform(delay / 2, delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                log.info("Reconnecting in %.1fs, attempt %d", wait, attempt)
+                self._outputReconnecting(e, attempt, wait)
+                if self._cancelWait.wait(wait):
+                    return False
+                try:
+                    remoteSock, remoteInfo = self._reestablish()
+                except Exception as error:
+                    if self.canceled:
+                        return False
+                    log.info("Reconnect attempt %d failed: %s", attempt, \
+                             error)
+                    e = error
+                    continue
+                if self.canceled:
+                    remoteSock.close()
+                    return False
+                self._remoteSock, self._remoteInfo = remoteSock, remoteInfo
+                self._connectionMade()
+                return True
+            return False
+        finally:
+            self._reconnecting = False
+    
+    def _reestablish(self):
+        """Blocks for a new connection made the same way as the last"""
+        if self._address is not None:
+            return self.transport.connect(self._address, self.name, \
+                                          self.uuid)
+        if self._mySock is None:
+            self._mySock = self.transport.listen()
+            self.transport.advertise(self._mySock, self.name, self.uuid)
+        return self.transport.accept(self._mySock)
+    
+    def _closeRemote(self):
+        """Closes the connected socket, if there is one"""
+        remoteSock = self._remoteSock
+        self._remoteSock = None
+        self._remoteInfo = None
+        if remoteSock is None:
+            return
+        try:
+            # shutdown wakes a recv blocked in _listen
+            remoteSock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            remoteSock.close()
+            log.debug("Remote socket closed")
+        except Exception as e:
+            self._outputError(e, "Failed to close remote socket")
+        
+    def _stopWriter(self):
+        """Stops the writer thread of the current connection"""
+        writer = self._writer
+        self._writer = None
+        if writer is not None:
+            writer.cancel()
+            writer.join()
+    
     def _listen(self):
-        """Wait for an incoming message from the connected device"""
+        """Wait for incoming frames from the connected device
+
+        Only whole frames are passed on. Several frames may arrive in a
+        single read and a frame may be split over several reads. When
+        the connection is lost it is got back here if possible.
+        """
+        reader = FrameReader()
         while self.state == self.STATE_CONNECTED:
+            sock = self._remoteSock
             try:
-                buffer = self._remoteSock.recv(1024)
-                logging.info(f"RecievedBluetoothMessage: {buffer}")
-                self._outputBluetoothMessage(buffer)
+                if sock is None:
+                    raise IOError("The connection was closed")
+                count = reader.recvFrom(sock)
+                if count == 0:
+                    raise IOError("The remote device closed the connection")
+                _bytesIn.inc(count)
+                debug = log.isEnabledFor(logging.DEBUG)
+                for frame in reader.frames():
+                    _framesIn.inc()
+                    if debug:
+                        log.debug("Received frame: %d bytes", len(frame))
+                    self._handleFrame(frame)
             except IOError as e:
-                logging.debug("IOError in listen")
+                log.debug("Listening stopped: %s", e)
+                if not self.canceled and self.reconnect \
+                        and self._reconnect(e):
+                    reader = FrameReader()
+                    continue
                 if not self.canceled:
                     self._connectionLost(e)
                 else:
                     self._outputDisconnected("Disconnected")
                 return
-    
-    def _writeThread(self, buffer, messageID):
-        """Send a message to the connected device"""
+        
+    def _handleFrame(self, frame):
+        """Passes a frame on, a frame that can not be handled is logged
+        and dropped rather than ending the connection"""
         try:
-            logging.debug(f"Sending: {buffer}")
-            self._remoteSock.send(buffer)
-        except IOError as e:
-            self._outputWriteFailed(messageID, e, "")
-        else:
-            self._outputWriteSuccess(messageID)
+            self._outputBluetoothMessage(frame)
+        except Exception as e:
+            _frameErrors.inc()
+            log.exception("Could not handle a frame of %d bytes", \
+                          len(frame))
+            self._outputError(e, "Could not handle a received frame")
         
 class WorkerThread(Thread):
     """Thread class that passes itself back to its caller upon completion"""
@@ -437,6 +794,226 @@ class WorkerThread(Thread):
     def cancel(self):
         self.canceled = True
         
+class WriterThread(Thread):
+    '''Sends frames to the connected device in the order they are queued
+    
+    One WriterThread lives for the duration of a connection. Whatever is
+    waiting in its queue when it wakes up is coalesced into as few send
+    calls as possible. Every messageID is passed back to the context's
+    _acknowledged() once sent or to _sendFailed() if it was not.
+    
+    After enableAcks() messages are numbered in the order they are sent,
+    starting at 1, and go to _onWire() instead. They are sent as the
+    context's _identify() makes them, if it does. They wait in the window
+    until acknowledge() is called with their sequence number. While
+    window messages wait, no more are sent. Control frames are not
+    numbered and do not count against the window.
+    '''
+    
+    # Limits on how much is coalesced into a single send
+    MAX_BATCH_BYTES = 64 * 1024
+    MAX_BATCH_FRAMES = 512
+    # Most frames waiting to be sent
+    MAX_QUEUED = 4096
+    
+    def __init__(self, context, sock, window=None):
+        super(WriterThread, self).__init__(daemon=True)
+        self.context = context
+        self.sock = sock
+        self.window = window or self.MAX_BATCH_FRAMES
+        self.queue = BoundedQueue(self.MAX_QUEUED)
+        self.canceled = False
+        self.acks = False
+        self.sequence = 0 # messages sent on this connection
+        self._pending = None # first item of the next batch
+        self._unacked = deque() # (sequence, messageID, sentAt)
+        self._windowOpen = Condition()
+        
+    def put(self, message, messageID):
+        """Queue a payload to be framed and sent, returns False if the
+        queue is full"""
+        message = self.context._encodeFrame(message)
+        return self.queue.put((FRAME_HEADER.pack(len(message)), message, \
+                               messageID, time.perf_counter()), DROP)
+    
+    def putControl(self, payload):
+        """Queue a frame that is not a message"""
+        return self.queue.put((FRAME_HEADER.pack(len(payload)), payload, \
+                               None, time.perf_counter()), DROP)
+    
+    def enableAcks(self):
+        with self._windowOpen:
+            self.acks = True
+    
+    def acknowledge(self, sequence):
+        """Takes every message up to sequence out of the window, returns
+        their (sequence, messageID, sentAt)"""
+        return self._acknowledge(0, sequence)
+    
+    def acknowledgeMessage(self, messageID):
+        """As acknowledge(), up to messageID. messageIDs are sent in
+        order, so they rise through the window as sequences do."""
+        return self._acknowledge(1, messageID)
+    
+    def _acknowledge(self, field, upTo):
+        delivered = []
+        with self._windowOpen:
+            while self._unacked and self._unacked[0][field] <= upTo:
+                delivered.append(self._unacked.popleft())
+            self._windowOpen.notify()
+        return delivered
+        
+    def cancel(self):
+        """Stop after the current batch. Anything left queued fails."""
+        self.canceled = True
+        self.queue.put(None, COALESCE, "cancel")
+        with self._windowOpen:
+            self._windowOpen.notify()
+        
+    def run(self):
+        while not self.canceled:
+            batch = self._nextBatch()
+            if batch:
+                self._send(batch)
+        # Report everything that never made it out
+        leftover = [self._pending] if self._pending else []
+        while True:
+            try:
+                leftover.append(self.queue.get_nowait())
+            except Empty:
+                break
+        for item in leftover:
+            if item is not None and item[2] is not None:
+                self.context._sendFailed(item[2], None)
+    
+    def _waitForWindow(self):
+        """Blocks while the window is full, returns how many messages
+        can be sent"""
+        with self._windowOpen:
+            if not self.acks:
+                return self.MAX_BATCH_FRAMES
+            while len(self._unacked) >= self.window and not self.canceled:
+                self._windowOpen.wait()
+            return self.window - len(self._unacked)
+                
+    def _nextBatch(self):
+        """Blocks for one frame and room in the window, then takes
+        whatever else is waiting that fits"""
+        item = self._pending or self.queue.get()
+        self._pending = None
+        if item is None:
+            return []
+        room = self._waitForWindow()
+        if self.canceled:
+            self._pending = item
+            return []
+        batch = []
+        size = 0
+        messages = 0
+        while item is not None:
+            batch.append(item)
+            size += len(item[0]) + len(item[1])
+            if item[2] is not None:
+                messages += 1
+            if size >= self.MAX_BATCH_BYTES or messages >= room \
+                    or len(batch) >= self.MAX_BATCH_FRAMES:
+                break
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not None and \
+                    size + len(item[1]) > self.MAX_BATCH_BYTES:
+                self._pending = item
+                break
+        return batch
+    
+    def _send(self, batch):
+        """Writes a batch of frames with a single scatter/gather call
+        where the socket supports it"""
+        # Numbered and in the window before they go, an acknowledgement
+        # can come back before sendmsg() returns
+        onWire = self._number(batch)
+        buffers = []
+        for header, message, _, _ in batch:
+            buffers.append(header)
+            buffers.append(message)
+        sent = 0
+        try:
+            if hasattr(self.sock, 'sendmsg'):
+                sent = self._sendmsgAll(buffers)
+            else:
+                self.sock.sendall(b''.join(buffers))
+        except IOError as e:
+            # Frames that went out completely before the error succeeded
+            position = 0
+            for header, message, messageID, queuedAt in batch:
+                size = len(header) + len(message)
+                position += size
+                if position <= sent:
+                    self._sent(messageID, queuedAt, size, onWire)
+                elif messageID is not None:
+                    self.context._sendFailed(messageID, e)
+            # Make sure the reading side notices and reconnects
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            return
+        for header, message, messageID, queuedAt in batch:
+            self._sent(messageID, queuedAt, len(header) + len(message), \
+                       onWire)
+    
+    def _number(self, batch):
+        """Gives the messages of a batch their sequence numbers, and ids
+        where the context has them. Returns True if they wait in the
+        window for acknowledgements"""
+        now = time.perf_counter()
+        numbered = []
+        with self._windowOpen:
+            acks = self.acks
+            for index, (_, message, messageID, queuedAt) in enumerate(batch):
+                if messageID is None:
+                    continue
+                self.sequence += 1
+                if not acks:
+                    continue
+                frame = self.context._identify(message, messageID)
+                if frame is not None:
+                    batch[index] = (FRAME_HEADER.pack(len(frame)), frame, \
+                                    messageID, queuedAt)
+                self._unacked.append((self.sequence, messageID, now))
+                numbered.append((messageID, frame is not None))
+        # Reported before the acknowledgements can be
+        for messageID, identified in numbered:
+            self.context._onWire(messageID, identified)
+        return acks
+    
+    def _sent(self, messageID, queuedAt, size, onWire=False):
+        _framesOut.inc()
+        _bytesOut.inc(size)
+        if messageID is None or onWire:
+            return
+        # Without acknowledgements from the remote device, the ack is
+        # the frame being handed to the socket
+        _writeToAck.observe(time.perf_counter() - queuedAt)
+        self.context._acknowledged(messageID)
+    
+    def _sendmsgAll(self, buffers):
+        """sendmsg() until every buffer is sent, returns the bytes sent"""
+        views = [memoryview(b) for b in buffers]
+        total = 0
+        while views:
+            count = self.sock.sendmsg(views)
+            total += count
+            # Drop what was sent, the socket may have taken a partial write
+            while views and count >= len(views[0]):
+                count -= len(views[0])
+                views.pop(0)
+            if views and count:
+                views[0] = views[0][count:]
+        return total
+
 class RemoteDevice:
     """Simple structure for passing related data about a device"""
     def __init__(self, name, address, channel):
@@ -0,0 +1,127 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from collections import deque
+from queue import Empty, Full
+from threading import Condition, Lock
+import time
+
+# What put() does when the queue is full
+BLOCK = "block" # wait for room, pushing back on the producer
+COALESCE = "coalesce" # replace the waiting item with the same key
+DROP = "drop" # throw the item away and count it
+
+class BoundedQueue():
+    '''Queue with a bound and a policy for every put()
+
+    A drop in replacement for the Queue between two threads. Each put()
+    chooses what happens when the queue is full:
+
+    BLOCK - the producer waits for room, as Queue.put() does.
+    COALESCE - the item takes the place of the waiting item with the
+        same key, or is added to the end if there is none. Coalesced
+        items are accepted even when the queue is full, there can only
+        ever be one per key.
+    DROP - the item is thrown away and counted in dropped.
+
+    highWater is the most items that have been waiting at once.
+
+    Public Methods:
+    put(item, String policy, key)
+    put_nowait(item)
+    get(boolean block, float timeout)
+    get_nowait()
+    qsize()
+    empty()
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.highWater = 0
+        self.dropped = 0
+        self._items = deque() # [item, key] cells
+        self._keyed = {} # key -> cell of the waiting item
+        self._lock = Lock()
+        self._notEmpty = Condition(self._lock)
+        self._notFull = Condition(self._lock)
+
+    def put(self, item, policy=BLOCK, key=None, timeout=None):
+        """Adds an item, returns False if it was dropped
+
+        key is only used by COALESCE and must not be None. Raises
+        queue.Full if a BLOCK put times out.
+        """
+        with self._lock:
+            if policy == COALESCE:
+                cell = self._keyed.get(key)
+                if cell is not None:
+                    cell[0] = item
+                    return True
+                cell = [item, key]
+                self._keyed[key] = cell
+                self._append(cell)
+                return True
+            if len(self._items) >= self.maxsize:
+                if policy == DROP:
+                    self.dropped += 1
+                    return False
+                self._waitForRoom(timeout)
+            self._append([item, None])
+            return True
+
+    def put_nowait(self, item):
+        with self._lock:
+            if len(self._items) >= self.maxsize:
+                raise Full
+            self._append([item, None])
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            if not block:
+                if not self._items:
+                    raise Empty
+            elif timeout is None:
+                while not self._items:
+                    self._notEmpty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self._notEmpty.wait(remaining)
+            item, key = self._items.popleft()
+            if key is not None:
+                del self._keyed[key]
+            self._notFull.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def _append(self, cell):
+        self._items.append(cell)
+        if len(self._items) > self.highWater:
+            self.highWater = len(self._items)
+        self._notEmpty.notify()
+
+    def _waitForRoom(self, timeout):
+        if timeout is None:
+            while len(self._items) >= self.maxsize:
+                self._notFull.wait()
+            return
+        deadline = time.monotonic() + timeout
+        while len(self._items) >= self.maxsize:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Full
+            self._notFull.wait(remaining)
@@ -0,0 +1,95 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import zlib
+from src.frameReader import MAX_FRAME_SIZE
+
+# A COMPRESSED frame is this type byte, the id of the preset dictionary
+# and the zlib stream of the original payload, type byte included. Only
+# sent once the HELLO of both ends has FEATURE_ZLIB.
+COMPRESSED = 254
+
+# Payloads smaller than this are never worth compressing
+THRESHOLD = 96
+
+# Words and phrases that come up in text messages. zlib finds matches
+# for the start of a message in here, which is what makes compressing
+# a single short text pay. The most common strings are at the end,
+# where they are cheapest to refer to. Must match Compression.java on
+# the phone byte for byte, a new dictionary needs a new id.
+SMS_DICTIONARY = (
+    b"appointment tomorrow morning afternoon evening weekend Monday "
+    b"Tuesday Wednesday Thursday Friday Saturday Sunday birthday "
+    b"congratulations happy anniversary dinner lunch breakfast coffee "
+    b"meeting office work school home traffic parking station airport "
+    b"flight train bus car pick up drop off on my way running late "
+    b"be there in 5 minutes 10 minutes half an hour an hour "
+    b"sounds good no problem don't worry take care talk to you later "
+    b"let me know what do you think what time where are you "
+    b"call me when you can can you call me I'll call you back "
+    b"did you get my message I just saw this sorry I missed your call "
+    b"thank you so much thanks love you miss you see you soon "
+    b"see you tomorrow have a good day good night good morning "
+    b"how are you I'm fine okay ok yes no maybe tonight today "
+    b"because about would could should really please just "
+    b"that this with have what when will your from they there "
+    b"the and you for are not but can all "
+    )
+
+SMS_DICTIONARY_ID = 1
+
+DICTIONARIES = {
+    0: None,
+    SMS_DICTIONARY_ID: SMS_DICTIONARY,
+    }
+
+def deflate(payload, dictionaryID=SMS_DICTIONARY_ID):
+    """Returns payload as a COMPRESSED frame, or None when compressing
+    it does not save at least an eighth of it"""
+    if len(payload) < THRESHOLD:
+        return None
+    dictionary = DICTIONARIES[dictionaryID]
+    if dictionary is None:
+        deflater = zlib.compressobj(9)
+    else:
+        deflater = zlib.compressobj(9, zdict=dictionary)
+    frame = bytes((COMPRESSED, dictionaryID)) + deflater.compress(payload) \
+        + deflater.flush()
+    if len(frame) > len(payload) - len(payload) // 8:
+        return None
+    return frame
+
+def inflate(buffer, maxSize=MAX_FRAME_SIZE):
+    """Returns the original payload of a COMPRESSED frame
+
+    The compressed stream is read straight out of buffer, which may be
+    a memoryview into the receive buffer, and inflated in a single
+    pass. No more than maxSize bytes are ever produced, so a corrupt
+    frame can not use up memory.
+    """
+    view = memoryview(buffer)
+    if len(view) < 2 or view[0] != COMPRESSED:
+        raise CompressionError("Not a compressed frame")
+    if view[1] not in DICTIONARIES:
+        raise CompressionError(f"Unknown dictionary {view[1]}")
+    dictionary = DICTIONARIES[view[1]]
+    if dictionary is None:
+        inflater = zlib.decompressobj()
+    else:
+        inflater = zlib.decompressobj(zdict=dictionary)
+    try:
+        payload = inflater.decompress(view[2:], maxSize)
+    except zlib.error as e:
+        raise CompressionError("Compressed frame is corrupt") from e
+    if inflater.unconsumed_tail:
+        raise CompressionError("Compressed frame is too large")
+    if not inflater.eof:
+        raise CompressionError("Compressed frame is truncated")
+    return payload
+
+class CompressionError(Exception):
+    """Raised when a compressed frame can not be inflated"""
+    pass
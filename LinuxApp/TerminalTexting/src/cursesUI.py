@@ -6,27 +6,64 @@ Created on Feb 25, 2019
 
 import xml.etree.ElementTree as ET
 import curses
+from functools import partial
 from src.colorSet import ColorSet
 from src.scrollWindow import ScrollWindow
 from src.textBar import TextBar
 from src.tbox import Tbox
-from queue import Queue
 from src.inputThread import InputThread
 from src.displayThread import DisplayThread
-from src.bluetoothManager import BluetoothManager
+from src.bluetoothManager import BluetoothManager, MultiplexManager
+from src.bluetoothService import BluetoothWriteError
+from src.messageStore import MessageStore
 import logging
+import signal
 from src import bluetoothManager
+from src import events, metrics
+from src.events import Dispatcher, Event
+from src.eventBus import EventBus
+from src.logSetup import redact
 
 STRINGS = ET.parse('res/strings.xml').getroot()
 UUID = "56abddf0-d4d2-45c7-9b2b-7837582d436f"
 SERVICE_NAME = "TerminalTexting"
 COMMAND_WINDOW_MIN_HEIGHT = 3
+SCROLL_KEYS = (curses.KEY_PPAGE, curses.KEY_NPAGE, \
+               curses.KEY_HOME, curses.KEY_END)
 
-def startUI():
-    """Entry point"""
-    ui = UserInterface()
+# MessageStore status of every OUTPUT_MESSAGE_STATUS status
+MESSAGE_STATUSES = {
+    BluetoothManager.MESSAGE_ON_WIRE: MessageStore.STATUS_ON_WIRE,
+    BluetoothManager.MESSAGE_SMS_SENT: MessageStore.STATUS_SENT,
+    BluetoothManager.MESSAGE_SMS_FAILED: MessageStore.STATUS_FAILED,
+    BluetoothManager.MESSAGE_UNKNOWN: MessageStore.STATUS_UNKNOWN,
+    BluetoothManager.MESSAGE_SMS_UNKNOWN: MessageStore.STATUS_UNKNOWN,
+    }
+
+log = logging.getLogger(__name__)
+
+def startUI(transport=None, historyPath='messages.db', multi=False, \
+            attachmentPath='attachments'):
+    """Entry point, multi serves many phones at once"""
+    ui = UserInterface(transport, historyPath, multi, attachmentPath)
     curses.wrapper(ui.main)
 
+def windowLayout(maxY, maxX):
+    """Returns a dict of window name to (lines, columns, y, x) for a
+    screen of maxY by maxX"""
+    commandHeight = int(maxY * 0.1)
+    if commandHeight < COMMAND_WINDOW_MIN_HEIGHT:
+        commandHeight = COMMAND_WINDOW_MIN_HEIGHT
+    displayHeight = max(maxY - commandHeight - 6, 1)
+    return {
+        'display': (displayHeight, maxX - 2, 1, 1),
+        'info': (1, maxX, displayHeight + 2, 0),
+        'tbox': (commandHeight, maxX - 2, displayHeight + 4, 1),
+        'options': (1, maxX, maxY - 1, 0),
+        'displayBorder': (displayHeight + 2, maxX, 0, 0),
+        'commandBorder': (commandHeight + 2, maxX, displayHeight + 3, 0),
+        }
+
 def getString(name):
     """returns a string from the strings.xml resource file"""
     for e in STRINGS.findall('string'):
@@ -48,6 +85,15 @@ class UserInterface():
     
     Each of the state methods involve listening for a new input from
     one of the worker threads and exicutes the appropriate behaviour.
+    The states share a single state method which looks the event up
+    in the state's Dispatcher, falling back to the handlers common to
+    every state. New behaviour is added with registerHandler() and
+    bindKey() instead of another branch in each state.
+    
+    With multi set, any number of phones can be connected through a
+    MultiplexManager. Their events carry a deviceID, a reply goes back
+    to the phone the text came from and losing one phone does not leave
+    the listen state.
     '''
 
     __STATE_START = "start"
@@ -57,28 +103,43 @@ class UserInterface():
     __STATE_COMPOSE = "compse"
     __STATE_STOP = "stop"
 
-    def __init__(self):
+    def __init__(self, transport=None, historyPath='messages.db', \
+                 multi=False, attachmentPath='attachments'):
         self.state = self.__STATE_START
+        self.transport = transport
+        self.historyPath = historyPath
+        self.attachmentPath = attachmentPath
+        self.multi = multi
         self.newState = self.__STATE_START
         self.FSMBoolean = True
+        self.stdscr = None
         self.inputThread = None
         self.displayThread = None
         self.bluetoothManager = None
-        self.inputQueue = Queue()
+        self.messageStore = None
+        self.inputQueue = EventBus()
         self.lastRecievedNumber = None
+        self.lastRecievedDevice = None
+        self.sendNumber = None
+        self.sendDevice = None
+        self.lastSentID = None
+        self.historySynced = 0 # messages of the current history sync
+        self.historySyncID = None # of the current history sync
+        self.__commonEvents = Dispatcher()
+        self.__stateEvents = {}
         
         self.__stateFunc = { \
             self.__STATE_CONNECT: (self.__enterConnect, \
-                                    self.__Connect, \
+                                    self.__runState, \
                                     self.__leaveConnect), \
             self.__STATE_DISCONNECT: (self.__enterDisconnect, \
-                                       self.__Disconnect, \
+                                       self.__runState, \
                                        self.__leaveDisconnect), \
             self.__STATE_LISTEN: (self.__enterListen, \
-                                   self.__Listen, \
+                                   self.__runState, \
                                    self.__leaveListen), \
             self.__STATE_COMPOSE: (self.__enterCompose, \
-                                    self.__Compose, \
+                                    self.__runState, \
                                     self.__leaveCompose), \
             self.__STATE_STOP: (None, \
                                  self.__stop, \
@@ -90,8 +151,8 @@ class UserInterface():
         try:
             self.__setup(stdscr)
             while self.FSMBoolean:
-                logging.info(f"State: {self.state},   " \
-                             f"NewState: {self.newState}")
+                log.info("State: %s,   NewState: %s", self.state, \
+                         self.newState)
                 if self.__stateFunc[self.newState][0] != None:
                     self.__stateFunc[self.newState][0]()
                 self.state = self.newState
@@ -127,26 +188,22 @@ class UserInterface():
                     .set('bluetoothManager', curses.color_pair(5)) \
                     .set('options', curses.color_pair(6))
         
-        # Get the hight and width of the main window and ctablealculate the
+        # Get the hight and width of the main window and calculate the
         # dimentions of the display and command windows
-        (maxY, maxX) = stdscr.getmaxyx()
-        commandHeight = int(maxY * 0.1)
-        if commandHeight < COMMAND_WINDOW_MIN_HEIGHT:
-            commandHeight = COMMAND_WINDOW_MIN_HEIGHT
-        displayHeight = maxY - commandHeight - 6
+        self.stdscr = stdscr
+        layout = windowLayout(*stdscr.getmaxyx())
         
-        # Create the windows\
-        dwin = curses.newwin(displayHeight, maxX - 2, 1, 1)
-        iwin = curses.newwin(1, maxX, displayHeight + 2, 0)
-        cwin = curses.newwin(commandHeight, maxX - 2, displayHeight + 4, 1)
-        swin = curses.newwin(1, maxX, maxY - 1, 0)
+        # Create the windows
+        dwin = curses.newwin(*layout['display'])
+        iwin = curses.newwin(*layout['info'])
+        cwin = curses.newwin(*layout['tbox'])
+        swin = curses.newwin(*layout['options'])
         
         # Create the borders
-        dwinBorderWin = curses.newwin(displayHeight + 2, maxX, 0, 0)
+        dwinBorderWin = curses.newwin(*layout['displayBorder'])
         dwinBorderWin.border()
         dwinBorderWin.refresh()
-        cwinBorderWin = curses.newwin(commandHeight + 2, maxX, \
-                                      displayHeight + 3, 0)
+        cwinBorderWin = curses.newwin(*layout['commandBorder'])
         cwinBorderWin.border()
         cwinBorderWin.refresh()
         
@@ -156,12 +213,34 @@ class UserInterface():
         opt = TextBar(swin, self.colorSet.get('options'))
         self.tbox = Tbox(cwin, self.inputQueue)
         
-        # Launch inputThread, displayThread, and bluetoothManager Thread
+        # Only the inputThread takes SIGWINCH, which wakes its getch()
+        # with KEY_RESIZE. Every thread started from here inherits this.
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGWINCH})
+        
+        # Launch the history writer, inputThread, displayThread, and
+        # bluetoothManager Thread
+        self.messageStore = MessageStore(self.historyPath)
         self.inputThread = InputThread(self.inputQueue, self.tbox)
-        self.displayThread = DisplayThread(dis, info, self.tbox, opt)
-        self.bluetoothManager = BluetoothManager(UUID, \
-                                                 SERVICE_NAME, \
-                                                 self.inputQueue)
+        self.displayThread = DisplayThread(dis, info, self.tbox, opt, \
+                                borders={'displayBorder': dwinBorderWin, \
+                                         'commandBorder': cwinBorderWin})
+        if self.multi:
+            self.bluetoothManager = MultiplexManager(UUID, \
+                                                     SERVICE_NAME, \
+                                                     self.inputQueue, \
+                                                     self.transport)
+        else:
+            self.bluetoothManager = BluetoothManager(UUID, \
+                                                     SERVICE_NAME, \
+                                                     self.inputQueue, \
+                                                     self.transport, \
+                                                     self.attachmentPath)
+        self.__registerEvents()
+        metrics.gauge("ui.events_queued", self.inputQueue.qsize)
+        metrics.gauge("ui.events_high_water", \
+                      lambda: list(self.inputQueue.highWater))
+        metrics.gauge("ui.events_dropped", \
+                      lambda: list(self.inputQueue.dropped))
         
         self.displayThread.printToDisplay("NOTE", \
                                           self.colorSet.get('note'), \
@@ -169,50 +248,137 @@ class UserInterface():
         
         self.newState = self.__STATE_CONNECT
         
+    def registerHandler(self, state, kind, handler):
+        """Handle an event kind while in state, or in every state when
+        state is None. handler is called with the event's args."""
+        self.__dispatcherFor(state).register(kind, handler)
+    
+    def bindKey(self, state, ch, handler):
+        """Call handler(ch) for a keystroke while in state, or in every
+        state when state is None"""
+        self.__dispatcherFor(state).bindKey(ch, handler)
+    
+    def __dispatcherFor(self, state):
+        if state is None:
+            return self.__commonEvents
+        if state not in self.__stateEvents:
+            self.__stateEvents[state] = Dispatcher(self.__commonEvents)
+        return self.__stateEvents[state]
+    
+    def __registerEvents(self):
+        """Fills the dispatch tables of every state"""
+        bm = BluetoothManager
+        # Any state
+        self.registerHandler(None, bm.OUTPUT_RECEIVED_TEXT_MESSAGE,
+                             self.__onReceivedText)
+        self.registerHandler(None, bm.OUTPUT_BLUETOOTH_MESSAGE,
+                             self.__onBluetoothMessage)
+        self.registerHandler(None, bm.OUTPUT_WRITE_SUCCESS,
+                             self.__onWriteSuccess)
+        self.registerHandler(None, bm.OUTPUT_WRITE_FAILED,
+                             self.__onWriteFailed)
+        self.registerHandler(None, bm.OUTPUT_MESSAGE_STATUS,
+                             self.__onMessageStatus)
+        self.registerHandler(None, bm.OUTPUT_ERROR,
+                             self.__printError)
+        self.registerHandler(None, bm.OUTPUT_NOTE,
+                             self.__onNote)
+        # Phones coming and going while others stay connected
+        self.registerHandler(None, bm.OUTPUT_CONNECTION_MADE,
+                             self.__printConnectionMade)
+        self.registerHandler(None, bm.OUTPUT_DISCONNECTED,
+                             self.__onDisconnected)
+        self.registerHandler(None, bm.OUTPUT_RECONNECTING,
+                             self.__onReconnecting)
+        # History from the phone, whenever it (re)connects
+        self.registerHandler(None, bm.OUTPUT_HISTORY_AVAILABLE,
+                             self.__onHistoryAvailable)
+        self.registerHandler(None, bm.OUTPUT_HISTORY_PAGE,
+                             self.__onHistoryPage)
+        self.registerHandler(None, bm.OUTPUT_HISTORY_SYNCED,
+                             self.__onHistorySynced)
+        self.registerHandler(None, events.HISTORY_NOT_STORED,
+                             self.__onHistoryNotStored)
+        self.registerHandler(None, bm.OUTPUT_ATTACHMENT_RECEIVED,
+                             self.__onAttachmentReceived)
+        for ch in SCROLL_KEYS:
+            self.bindKey(None, ch, self.displayThread.scrollDisplay)
+        self.bindKey(None, curses.ascii.DC4, # ^T
+                     lambda ch: self.displayThread.toggleStats())
+        # curses has resized stdscr by the time KEY_RESIZE is read
+        self.bindKey(None, curses.KEY_RESIZE, \
+                     lambda ch: self.displayThread.resize( \
+                         windowLayout(*self.stdscr.getmaxyx())))
+        
+        # Connect
+        state = self.__STATE_CONNECT
+        self.bindKey(state, curses.ascii.CAN, # ^X
+                     lambda ch: self.__setState(self.__STATE_STOP))
+        self.bindKey(state, curses.ascii.SO, # ^N
+                     lambda ch: self.bluetoothManager.connectAsServer())
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_MADE,
+                             self.__onConnectionMade)
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_FAILED,
+                             self.__printError)
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_LOST,
+                             self.__printError)
+        
+        # Listen
+        state = self.__STATE_LISTEN
+        self.bindKey(state, curses.ascii.CAN, # ^X
+                     lambda ch: self.__setState(self.__STATE_DISCONNECT))
+        self.bindKey(state, curses.ascii.SI, # ^O
+                     lambda ch: self.__startCompose(None, None))
+        self.bindKey(state, curses.ascii.ENQ, # ^E
+                     lambda ch: self.__startCompose(self.lastRecievedNumber, \
+                                                    self.lastRecievedDevice))
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_LOST,
+                             self.__onConnectionLost)
+        
+        # Disconnect
+        state = self.__STATE_DISCONNECT
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_LOST,
+                             self.__onConnectionLost)
+        self.registerHandler(state, bm.OUTPUT_DISCONNECTED,
+                             self.__onDisconnected)
+        
+        # Compose
+        state = self.__STATE_COMPOSE
+        self.registerHandler(state, bm.OUTPUT_CONNECTION_LOST,
+                             self.__onConnectionLost)
+        self.registerHandler(state, InputThread.OUTPUT_GATHER,
+                             self.__onGather)
+        self.registerHandler(state, InputThread.OUTPUT_CANCEL,
+                             lambda args: self.__setState(self.__STATE_LISTEN))
+    
+    def __runState(self):
+        """State method shared by every state
+        
+        Dispatches events to the handlers registered for the state until
+        one of them changes the state. The EventBus hands out keystrokes
+        and connection changes before bulk events, which come in batches.
+        """
+        state = self.state
+        dispatcher = self.__dispatcherFor(state)
+        while self.newState == state:
+            batch = self.inputQueue.getBatch()
+            debug = log.isEnabledFor(logging.DEBUG)
+            for i, event in enumerate(batch):
+                if debug:
+                    log.debug("Event: %s", events.name(event.kind))
+                dispatcher.dispatch(event)
+                if self.newState != state:
+                    # The rest belong to the next state
+                    self.inputQueue.requeue(batch[i + 1:])
+                    break
+    
+    def __setState(self, state):
+        self.newState = state
+    
     def __enterConnect(self):
         self.displayThread.printOptions(getString('options_connect'))
         self.displayThread.printStatus(getString('info_connect_options'))
     
-    def __Connect(self):
-        while self.newState == self.__STATE_CONNECT:
-            myIn = self.inputQueue.get()
-            outType = myIn[0]
-            args = myIn[1]
-            logging.info(outType)
-            if not self.__standardHandlingMacro(outType, args):
-                if outType == InputThread.KEYBOARD_INPUT:
-                    if myIn[1] == curses.ascii.CAN: # ^X
-                        self.newState = self.__STATE_STOP
-                    elif myIn[1] == curses.ascii.SO: # ^N
-                        logging.debug("connectAsServer")
-                        logging.debug(self.bluetoothManager.state)
-                        self.bluetoothManager.connectAsServer()
-                    elif myIn[1] == curses.ascii.NAK: # ^U
-                        # Client Connect
-                        pass
-                    else:
-                        # Not relivent keystroke
-                        pass
-                elif outType == BluetoothManager.OUTPUT_CONNECTION_MADE:
-                    self.newState = self.__STATE_LISTEN
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    "Connection made with " \
-                                    + args['device'].address)
-                    return
-                elif outType == BluetoothManager.OUTPUT_CONNECTION_FAILED:
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " + \
-                                    + str(args['error']))
-                elif outType == BluetoothManager.OUTPUT_CONNECTION_LOST:
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " + \
-                                    + str(args['error']))
-                else:
-                    pass # Weird
-    
     def __leaveConnect(self):
         pass
     
@@ -220,38 +386,6 @@ class UserInterface():
         self.displayThread.printOptions(getString('options_listen'))
         self.displayThread.printStatus(getString('info_listen'))
     
-    def __Listen(self):
-        while self.newState == self.__STATE_LISTEN:
-            myIn = self.inputQueue.get()
-            outType = myIn[0]
-            args = myIn[1]
-            logging.info(outType)
-            if not self.__standardHandlingMacro(outType, args):
-                if outType == InputThread.KEYBOARD_INPUT:
-                    if myIn[1] == curses.ascii.CAN: # ^X
-                        self.newState = self.__STATE_DISCONNECT
-                    elif myIn[1] == curses.ascii.SI: # ^O
-                        self.sendNumber = None
-                        self.displayThread.printStatus( \
-                            getString('info_number_compose'))
-                        self.newState = self.__STATE_COMPOSE
-                    elif myIn[1] == curses.ascii.ENQ: # ^E
-                        self.sendNumber = self.lastRecievedNumber
-                        self.displayThread.printStatus(\
-                                            getString('info_compose'))
-                        self.newState = self.__STATE_COMPOSE
-                    else:
-                        pass
-                elif outType == BluetoothManager.OUTPUT_CONNECTION_LOST:
-                    self.newState = self.__STATE_CONNECT
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " \
-                                    + str(args['error']))
-                    return
-                else:
-                    pass # Weird
-    
     def __leaveListen(self):
         pass
     
@@ -259,31 +393,6 @@ class UserInterface():
         self.displayThread.printOptions(getString('options_disconnect'))
         self.bluetoothManager.disconnect()
     
-    def __Disconnect(self):
-        while self.newState == self.__STATE_DISCONNECT:
-            myIn = self.inputQueue.get()
-            outType = myIn[0]
-            args = myIn[1]
-            logging.info(outType)
-            if not self.__standardHandlingMacro(outType, args):
-                if outType == InputThread.KEYBOARD_INPUT:
-                        pass
-                elif outType == BluetoothManager.OUTPUT_CONNECTION_LOST:
-                    self.newState = self.__STATE_CONNECT
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " \
-                                    + str(args['error']))
-                    return
-                elif outType == BluetoothManager.OUTPUT_DISCONNECTED:
-                    self.newState = self.__STATE_CONNECT
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'])
-                    return
-                else:
-                    pass # Weird
-    
     def __leaveDisconnect(self):
         pass
     
@@ -292,89 +401,198 @@ class UserInterface():
         self.displayThread.printStatus(getString('info_number_compose'))
         self.inputThread.editMode(displayThread=self.displayThread)
     
-    def __Compose(self):
-        while self.newState == self.__STATE_COMPOSE:
-            myIn = self.inputQueue.get()
-            outType = myIn[0]
-            args = myIn[1]
-            logging.info(outType)
-            if not self.__standardHandlingMacro(outType, args):
-                if outType == BluetoothManager.OUTPUT_CONNECTION_LOST:
-                    self.newState = self.__STATE_CONNECT
-                    self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " + \
-                                    + str(args['error']))
-                    return
-                elif outType == InputThread.OUTPUT_GATHER:
-                    if not self.sendNumber:
-                        self.sendNumber = args['message']
-                        self.displayThread.printStatus(\
-                                            getString('info_compose'))
-                        self.displayThread.clearTBox()
-                    else:
-                        logging.info(f"args['message': {args['message']}")
-                        blueMessage = \
-                            bluetoothManager.getBytes(self.sendNumber, \
-                                                      args['message'])
-                        logging.info(f"blueMessage: {blueMessage}")
-                        self.bluetoothManager.write(blueMessage)
-                        self.newState = self.__STATE_LISTEN
-                elif outType == InputThread.OUTPUT_CANCEL:
-                    self.newState = self.__STATE_LISTEN
-                else:
-                    pass # Weird
-    
     def __leaveCompose(self):
         self.inputThread.editMode(value=False)
         self.displayThread.clearTBox()
     
-    def __standardHandlingMacro(self, outType, args):
-        '''Handles the outputs of modules regardless of state
-        Used to avoid rewirting the code.
-        '''
-        if outType == BluetoothManager.OUTPUT_RECEIVED_TEXT_MESSAGE:
-            self.lastRecievedNumber = args['message'].phoneNumber
-            title = args['message'].contactName \
-                    + " (" \
-                    + args['message'].phoneNumber \
-                    + ")"
-            self.displayThread.printToDisplay(title, \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['message'].message)
-        elif outType == BluetoothManager.OUTPUT_BLUETOOTH_MESSAGE:
-            self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['message'])
-            return True
-        elif outType == BluetoothManager.OUTPUT_WRITE_SUCCESS:
-            # TODO: Message Tracking
-            return True
-        elif outType == BluetoothManager.OUTPUT_WRITE_FAILED:
-            # TODO: Message Tracking
-            return True
-        elif outType == BluetoothManager.OUTPUT_ERROR:
-            self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['comment'] + " - " \
-                                    + str(args['error']))
-            return True
-        elif outType == BluetoothManager.OUTPUT_NOTE:
-            self.displayThread.printToDisplay("Bluetooth", \
-                                    self.colorSet.get('bluetoothManager'), \
-                                    args['note'])
-            return True
+    #-----------------------------Event Handlers-------------------------------
+    
+    def __startCompose(self, number, deviceID):
+        """Compose to number, or ask for the number first when None.
+        deviceID is the phone to send through, None for the default."""
+        self.sendNumber = number
+        self.sendDevice = deviceID
+        if number:
+            self.displayThread.printStatus(getString('info_compose'))
+        else:
+            self.displayThread.printStatus(getString('info_number_compose'))
+        self.newState = self.__STATE_COMPOSE
+    
+    def __onConnectionMade(self, args):
+        self.newState = self.__STATE_LISTEN
+        self.__printConnectionMade(args)
+    
+    def __printConnectionMade(self, args):
+        text = "Connection made with " + args['device'].address
+        if 'deviceID' in args:
+            text += f" as phone {args['deviceID']}"
+        self.__printBluetooth(text)
+    
+    def __onConnectionLost(self, args):
+        # A single phone of many going away is only worth a note
+        if 'deviceID' not in args:
+            self.newState = self.__STATE_CONNECT
+        self.__printError(args)
+    
+    def __onReconnecting(self, args):
+        # Stay put, messages written meanwhile are sent once it is back
+        self.__printBluetooth(f"Connection lost ({args['error']}), trying "
+                              f"again in {args['delay']:.1f}s "
+                              f"(attempt {args['attempt']})")
+    
+    def __onDisconnected(self, args):
+        if 'deviceID' not in args:
+            self.newState = self.__STATE_CONNECT
+        self.__printBluetooth(args['comment'])
+    
+    def __onGather(self, args):
+        if not self.sendNumber:
+            self.sendNumber = args['message']
+            self.displayThread.printStatus(getString('info_compose'))
+            self.displayThread.clearTBox()
         else:
+            blueMessage = bluetoothManager.getBytes(self.sendNumber, \
+                                                    args['message'])
+            log.info("Sending %d bytes to %s", len(blueMessage), \
+                     redact(self.sendNumber))
+            try:
+                messageID = self.bluetoothManager.write(blueMessage, \
+                                                        self.sendDevice)
+            except BluetoothWriteError as e:
+                self.__printError({'comment': "Message not sent", \
+                                   'error': e})
+                return
+            self.messageStore.addSent(self.sendNumber, \
+                                      args['message'], \
+                                      messageID)
+            self.lastSentID = messageID
+            self.newState = self.__STATE_LISTEN
+    
+    def __onReceivedText(self, args):
+        message = args['message']
+        self.messageStore.addReceived(message)
+        self.lastRecievedNumber = message.phoneNumber
+        self.lastRecievedDevice = args.get('deviceID')
+        title = message.contactName + " (" + message.phoneNumber + ")"
+        if self.lastRecievedDevice is not None:
+            title += f" [phone {self.lastRecievedDevice}]"
+        self.displayThread.printToDisplay(title, \
+                                self.colorSet.get('bluetoothManager'), \
+                                message.message, \
+                                args.get('receivedAt'))
+    
+    def __onAttachmentReceived(self, args):
+        # Kept in the history like a text, the file stays where it is
+        text = f"[{args['name']}, {args['mimeType']}, " \
+               f"{args['size'] // 1024} KB, saved to {args['path']}]"
+        message = bluetoothManager.TextMessage(args['phoneNumber'], \
+                                               args['contactName'], text)
+        self.__onReceivedText({'message': message})
+    
+    def __onHistoryAvailable(self, args):
+        if self.__syncHistory():
+            self.__printBluetooth("Syncing the history of the phone")
+    
+    def __syncHistory(self):
+        """Asks for everything after what is stored, a sync that was cut
+        off carries on from its last stored page"""
+        since = self.messageStore.watermark('')
+        try:
+            self.historySyncID = self.bluetoothManager.syncHistory(since)
+        except BluetoothWriteError as e:
+            self.__printError({'comment': "History not synced", 'error': e})
             return False
-        
+        self.historySynced = 0
+        return True
+    
+    def __onHistoryPage(self, args):
+        if args['syncID'] != self.historySyncID:
+            return # Left over from a sync that was asked again
+        # The phone sends another page once this one is stored
+        credit = partial(self.bluetoothManager.syncCredit, args['syncID'])
+        notStored = partial(self.inputQueue.put, \
+                            Event(events.HISTORY_NOT_STORED, \
+                                  {'syncID': args['syncID']}))
+        self.messageStore.addHistory(args['records'], '', \
+                                     args['watermark'], credit, notStored)
+        self.historySynced += len(args['records'])
+    
+    def __onHistoryNotStored(self, args):
+        # Every page after the one that failed fails as well, the sync
+        # is only asked again once
+        if args['syncID'] != self.historySyncID:
+            return
+        self.__printBluetooth("History could not be stored, syncing again")
+        self.messageStore.retryHistory('')
+        self.__syncHistory()
+    
+    def __onHistorySynced(self, args):
+        if args['syncID'] != self.historySyncID:
+            return
+        if args['complete']:
+            # Messages after the last page that could not be sent are
+            # not asked for again
+            self.messageStore.addHistory((), '', args['watermark'])
+            self.__printBluetooth(f"History synced, {self.historySynced} "
+                                  f"messages")
+        else:
+            self.__printBluetooth("The phone could not sync all of its "
+                                  "history")
+    
+    def __onBluetoothMessage(self, args):
+        self.__printBluetooth(args['message'])
+    
+    def __onNote(self, args):
+        self.__printBluetooth(args['note'])
+    
+    def __onWriteSuccess(self, args):
+        # Without 'delivered' all that is known is that it was written
+        if args.get('delivered'):
+            self.__updateStatus(args['messageID'], \
+                                MessageStore.STATUS_DELIVERED)
+        else:
+            self.__updateStatus(args['messageID'], \
+                                MessageStore.STATUS_ON_WIRE)
+    
+    def __onWriteFailed(self, args):
+        self.__updateStatus(args['messageID'], MessageStore.STATUS_FAILED)
+    
+    def __onMessageStatus(self, args):
+        status = MESSAGE_STATUSES.get(args['status'])
+        if status is None:
+            return
+        self.__updateStatus(args['messageID'], status)
+        if status == MessageStore.STATUS_FAILED:
+            self.__printBluetooth("The phone could not send a message")
+        elif args['status'] == BluetoothManager.MESSAGE_UNKNOWN:
+            self.__printBluetooth("A message may not have reached the "
+                                  "phone, it was not sent again")
+    
+    def __updateStatus(self, messageID, status):
+        self.messageStore.updateStatus(messageID, status)
+        if messageID == self.lastSentID \
+                and self.state == self.__STATE_LISTEN:
+            self.displayThread.printStatus("Last message: " + status)
+    
+    def __printBluetooth(self, text):
+        self.displayThread.printToDisplay("Bluetooth", \
+                                self.colorSet.get('bluetoothManager'), \
+                                text)
+    
+    def __printError(self, args):
+        self.__printBluetooth(args['comment'] + " - " + str(args['error']))
     
     def __stop(self):
         self.displayThread.printToDisplay("Note", \
                                           self.colorSet.get('note'), \
                                           "Good Bye!\n[Press any key to exit]")
         self.inputThread.join()
+        # Nothing reads the events from here on, don't let a full bus
+        # hold up the bluetooth threads
+        self.inputQueue.close()
         self.bluetoothManager.join()
         self.displayThread.join()
+        self.messageStore.join()
         self.FSMBoolean = False
         
             
@@ -0,0 +1,144 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from threading import Lock
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+class DeviceCache():
+    '''Remote devices seen before, kept in a JSON file
+
+    Every device is stored by address with its name, class, the time
+    it was last seen and the RFCOMM channel its service was last found
+    on. Devices not seen for ttl seconds are left out of devices() and
+    their channel is not used any more, they are dropped from the file
+    the next time it is written.
+
+    Changes are only kept in memory until save(), so a discovery that
+    sees many devices writes the file once. The file is replaced in one
+    step so a crash never leaves half of it. A missing or unreadable
+    file is an empty cache.
+
+    Public Methods:
+    devices()
+    seen(String address, String name, int deviceClass)
+    name(String address)
+    channel(String address)
+    setChannel(String address, int channel)
+    forgetChannel(String address)
+    save()
+    '''
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        self._saveLock = Lock() # one writer of the file at a time
+        self._devices = self._load()
+        self._dirty = False # changed since the file was written
+
+    def devices(self):
+        """Returns a list of (address, name) of the devices seen within
+        the ttl, most recently seen first"""
+        now = time.time()
+        with self._lock:
+            fresh = [(entry['lastSeen'], address, entry.get('name')) \
+                     for address, entry in self._devices.items() \
+                     if now - entry['lastSeen'] < self.ttl]
+        fresh.sort(reverse=True)
+        return [(address, name) for _, address, name in fresh]
+
+    def seen(self, address, name=None, deviceClass=None):
+        """Records that a device was just found or connected to"""
+        with self._lock:
+            entry = self._devices.setdefault(address, {})
+            entry['lastSeen'] = time.time()
+            if name is not None:
+                entry['name'] = name
+            if deviceClass is not None:
+                entry['class'] = deviceClass
+            self._dirty = True
+
+    def name(self, address):
+        """Returns the name of address, None if it is not known or too
+        old"""
+        with self._lock:
+            entry = self._devices.get(address)
+            if entry is None or time.time() - entry['lastSeen'] >= self.ttl:
+                return None
+            return entry.get('name')
+
+    def channel(self, address):
+        """Returns the channel the service of address was last found on,
+        None if it is not known or too old"""
+        with self._lock:
+            entry = self._devices.get(address)
+            if entry is None or 'channel' not in entry \
+                    or time.time() - entry['lastSeen'] >= self.ttl:
+                return None
+            return entry['channel']
+
+    def setChannel(self, address, channel):
+        with self._lock:
+            entry = self._devices.setdefault(address, {})
+            entry['lastSeen'] = time.time()
+            entry['channel'] = channel
+            self._dirty = True
+
+    def forgetChannel(self, address):
+        """The cached channel did not work, the next connect looks it up"""
+        with self._lock:
+            entry = self._devices.get(address)
+            if entry is not None and entry.pop('channel', None) is not None:
+                self._dirty = True
+
+    def save(self):
+        """Writes the file if anything changed since it was last written"""
+        with self._saveLock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                now = time.time()
+                for address in [address for address, entry \
+                                in self._devices.items() \
+                                if now - entry['lastSeen'] >= self.ttl]:
+                    del self._devices[address]
+                text = json.dumps(self._devices, indent=1, sort_keys=True)
+            self._write(text)
+
+    def _load(self):
+        try:
+            with open(self.path) as source:
+                devices = json.load(source)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            log.warning("Could not read the device cache %s", self.path)
+            return {}
+        if not isinstance(devices, dict):
+            return {}
+        # Anything without a time it was seen is of no use
+        return {address: entry for address, entry in devices.items() \
+                if isinstance(entry, dict) \
+                and isinstance(entry.get('lastSeen'), (int, float))}
+
+    def _write(self, text):
+        """Replaces the file with text, hold _saveLock"""
+        temporary = self.path + ".tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temporary, 'w') as out:
+                out.write(text)
+            os.replace(temporary, self.path)
+        except OSError:
+            log.exception("Could not write the device cache")
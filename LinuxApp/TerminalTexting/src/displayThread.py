@@ -2,7 +2,15 @@
 @author: jj
 '''
 from threading import Thread
-from queue import Queue
+from queue import Empty
+from src.boundedQueue import BoundedQueue, COALESCE, DROP
+from src.statsOverlay import StatsOverlay
+from src import metrics
+import curses
+import logging
+import time
+
+log = logging.getLogger(__name__)
 
 class DisplayThread(Thread):
     '''Thread class specifically for outputting to the curses windows
@@ -10,69 +18,229 @@ class DisplayThread(Thread):
     Curses is not thread safe and tends to behave poorly when multiple
     threads attempt to output to the display simotaniously. This thread
     collects output requests through a queue to handle them safely.
+    
+    Requests are handled in frames. Everything waiting in the queue is
+    applied to the windows with noutrefresh() and the terminal is then
+    updated once with curses.doupdate(). Frames are limited to maxFps
+    per second, requests that come in sooner join the next frame. A
+    frame ends on time however many requests are still waiting.
+    
+    The request queue holds at most maxQueue requests. Status and
+    options only keep their latest text while waiting, scrolling is
+    dropped when the queue is full and everything else waits for room.
+    
+    toggleStats() shows the lines of the metrics registry in a box over
+    the display, refreshed twice a second while it is shown.
+    
+    resize() lays every window out again once the terminal has changed
+    size. Only the latest layout is kept while waiting.
+    
+    bracketedPaste() asks the terminal to mark pastes. It is written
+    through curses, in order with everything else that is drawn, and
+    turned off again when the thread stops.
     '''
 
     __PRINT_OPTIONS = "options"
     __PRINT_STATUS = "status"
     __PRINT_TO_DISPLAY = "display"
     __TBOX_COMMAND = "tboxCommand"
+    __TBOX_INSERT = "tboxInsert"
     __TBOX_CLEAR = "tboxClear"
+    __SCROLL = "scroll"
+    __STATS = "stats"
+    __RESIZE = "resize"
+    __PASTE_MODE = "pasteMode"
     __STOP = "stop"
 
-    def __init__(self, dis, info, tbox, opt):
+    def __init__(self, dis, info, tbox, opt, maxFps=60, maxQueue=1024, \
+                 registry=None, borders=None):
         """Constuctor
         
         dis - scollWindow
         info - textBar
         tbox - tbox
         opt - textBar
+        maxFps - most terminal updates per second
+        maxQueue - most requests waiting to be applied
+        registry - metrics.Registry shown by toggleStats()
+        borders - dict of name to the windows the borders are drawn in
         """
         super(DisplayThread, self).__init__()
         self.dis = dis
         self.info = info
         self.tbox = tbox
         self.opt = opt
-        self.input = Queue()
+        self.borders = borders or {}
+        self.pasteMode = False # bracketed paste is on
+        self.frameTime = 1.0 / maxFps
+        self.input = BoundedQueue(maxQueue)
+        registry = registry or metrics.REGISTRY
+        self.stats = StatsOverlay(dis.win, registry.lines)
+        self._received = [] # receive times of the entries in this frame
+        self._receiveToRender = metrics.histogram("ui.receive_to_render")
+        metrics.gauge("display.queued", self.input.qsize)
+        metrics.gauge("display.high_water", lambda: self.input.highWater)
         self.start()
         
     def printOptions(self, text):
-        self.input.put((self.__PRINT_OPTIONS, text))
+        self.input.put((self.__PRINT_OPTIONS, text), COALESCE, \
+                       self.__PRINT_OPTIONS)
         
     def printStatus(self, text):
-        self.input.put((self.__PRINT_STATUS, text))
+        self.input.put((self.__PRINT_STATUS, text), COALESCE, \
+                       self.__PRINT_STATUS)
+        
+    def printToDisplay(self, title, titleColor, text, receivedAt=None):
+        """Add an entry to the display
         
-    def printToDisplay(self, title, titleColor, text):
-        self.input.put((self.__PRINT_TO_DISPLAY, title, titleColor, text))
+        receivedAt - time.perf_counter() of when the text arrived, for
+                     the receive to render latency
+        """
+        self.input.put((self.__PRINT_TO_DISPLAY, title, titleColor, text, \
+                        receivedAt))
         
     def tBoxCommand(self, command):
         """Print characters or move cursor actions"""
         self.input.put((self.__TBOX_COMMAND, command))
         
+    def tBoxInsert(self, text):
+        """Print a run of characters to the text box in one go"""
+        self.input.put((self.__TBOX_INSERT, text))
+        
     def clearTBox(self):
         self.input.put((self.__TBOX_CLEAR,))
         
-    def join(self, timeout=None):
-        self.input.put((self.__STOP,))
-        Thread.join(self, timeout=timeout)
+    def scrollDisplay(self, ch):
+        """Page the display with a PageUp/PageDown/Home/End keystroke"""
+        self.input.put((self.__SCROLL, ch), DROP)
         
-    def run(self):
-        while True:
-            command = self.input.get()
-            if command[0] == self.__PRINT_OPTIONS:
-                self.opt.update(command[1])
-            elif command[0] == self.__PRINT_STATUS:
-                self.info.update(command[1])
-            elif command[0] == self.__PRINT_TO_DISPLAY:
-                self.dis.addEntry(command[1], command[2], command[3])
-            elif command[0] == self.__TBOX_COMMAND:
-                self.tbox.do_command(command[1])
-            elif command[0] == self.__TBOX_CLEAR:
-                self.tbox.clear()
-            elif command[0] == self.__STOP:
-                break
+    def toggleStats(self):
+        """Show or hide the statistics over the display"""
+        self.input.put((self.__STATS,), DROP)
         
+    def resize(self, layout):
+        """Lay the windows out again after the terminal changed size
         
+        layout - dict of (lines, columns, y, x) for 'display', 'info',
+                 'tbox', 'options' and every name in borders
+        """
+        self.input.put((self.__RESIZE, layout), COALESCE, self.__RESIZE)
         
+    def bracketedPaste(self, enable):
+        """Turn bracketed paste on or off, terminals without it ignore
+        the request"""
+        self.input.put((self.__PASTE_MODE, enable), COALESCE, \
+                       self.__PASTE_MODE)
+        
+    def join(self, timeout=None):
+        self.input.put((self.__STOP,), COALESCE, self.__STOP)
+        Thread.join(self, timeout=timeout)
         
+    def run(self):
+        lastFrame = 0
+        running = True
+        while running:
+            # Wake up to refresh the statistics while they are shown
+            timeout = self.stats.refreshTime if self.stats.visible else None
+            try:
+                command = self.input.get(timeout=timeout)
+            except Empty:
+                command = None
+            while command is not None:
+                if not self._apply(command):
+                    running = False
+                    break
+                command = self._nextCommand(lastFrame)
+            self.dis.noutrefresh()
+            self.stats.noutrefresh()
+            # Last so the cursor is left in the text box
+            self.tbox.win.noutrefresh()
+            curses.doupdate()
+            if self._received:
+                now = time.perf_counter()
+                for receivedAt in self._received:
+                    self._receiveToRender.observe(now - receivedAt)
+                self._received.clear()
+            lastFrame = time.monotonic()
+        self._setPasteMode(False)
+        curses.doupdate()
+            
+    def _nextCommand(self, lastFrame):
+        """Returns the next request for this frame, or None once the
+        frame is over
         
-        
\ No newline at end of file
+        A frame is over once frameTime has passed since the last one,
+        even with requests still waiting. They go in the next frame, so
+        requests that come faster than they are applied can not hold up
+        the terminal updates.
+        """
+        wait = lastFrame + self.frameTime - time.monotonic()
+        if wait <= 0:
+            return None
+        try:
+            return self.input.get(timeout=wait)
+        except Empty:
+            return None
+            
+    def _apply(self, command):
+        """Applies a single request, returns False to stop the thread"""
+        if command[0] == self.__PRINT_OPTIONS:
+            self.opt.update(command[1])
+        elif command[0] == self.__PRINT_STATUS:
+            self.info.update(command[1])
+        elif command[0] == self.__PRINT_TO_DISPLAY:
+            self.dis.addEntry(command[1], command[2], command[3])
+            if command[4] is not None:
+                self._received.append(command[4])
+        elif command[0] == self.__TBOX_COMMAND:
+            self.tbox.do_command(command[1])
+        elif command[0] == self.__TBOX_INSERT:
+            self.tbox.insertText(command[1])
+        elif command[0] == self.__TBOX_CLEAR:
+            self.tbox.clear()
+        elif command[0] == self.__SCROLL:
+            self.dis.scrollKey(command[1])
+        elif command[0] == self.__STATS:
+            if not self.stats.toggle():
+                self.dis.touch() # Redraw what the statistics covered
+        elif command[0] == self.__RESIZE:
+            self._resize(command[1])
+        elif command[0] == self.__PASTE_MODE:
+            self._setPasteMode(command[1])
+        elif command[0] == self.__STOP:
+            return False
+        return True
+    
+    def _setPasteMode(self, enable):
+        if enable != self.pasteMode:
+            self.pasteMode = enable
+            curses.putp(b"\x1b[?2004h" if enable else b"\x1b[?2004l")
+    
+    def _resize(self, layout):
+        try:
+            for name, win in self.borders.items():
+                (lines, columns, y, x) = layout[name]
+                _move(win, y, x)
+                win.resize(lines, columns)
+                win.erase()
+                win.border()
+                win.noutrefresh()
+            (lines, columns, y, x) = layout['display']
+            _move(self.dis.win, y, x)
+            self.dis.resize(lines, columns)
+            (lines, columns, y, x) = layout['tbox']
+            _move(self.tbox.win, y, x)
+            self.tbox.win.resize(lines, columns)
+            self.tbox.win.touchwin()
+            for bar, name in ((self.info, 'info'), (self.opt, 'options')):
+                (_, columns, y, x) = layout[name]
+                _move(bar.win, y, x)
+                bar.resize(columns)
+        except curses.error:
+            # Too small to lay out, the next resize puts it right
+            log.warning("Could not lay the windows out for %s", layout)
+            
+def _move(win, y, x):
+    """Moves win, shrunk first so that it fits wherever it goes"""
+    win.resize(1, 1)
+    win.mvwin(y, x)
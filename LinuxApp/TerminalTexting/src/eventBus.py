@@ -0,0 +1,239 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from collections import deque
+from queue import Empty, Full
+from threading import Condition, Lock
+import time
+from src import events
+from src.boundedQueue import BLOCK, DROP
+
+# Priority levels, lower is served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Keystrokes and anything that changes the state of the UI
+DEFAULT_PRIORITIES = {
+    events.KEYBOARD_INPUT: PRIORITY_HIGH,
+    events.GATHER: PRIORITY_HIGH,
+    events.CANCEL: PRIORITY_HIGH,
+    events.CONNECTION_MADE: PRIORITY_HIGH,
+    events.CONNECTION_FAILED: PRIORITY_HIGH,
+    events.CONNECTION_LOST: PRIORITY_HIGH,
+    events.DISCONNECTED: PRIORITY_HIGH,
+    events.RECONNECTING: PRIORITY_HIGH,
+    events.RECEIVED_TEXT_MESSAGE: PRIORITY_BULK,
+    events.WRITE_SUCCESS: PRIORITY_BULK,
+    events.WRITE_FAILED: PRIORITY_BULK,
+    events.MESSAGE_STATUS: PRIORITY_BULK,
+    # Pages of history stay in order with their end
+    events.HISTORY_PAGE: PRIORITY_BULK,
+    events.HISTORY_SYNCED: PRIORITY_BULK,
+    events.ATTACHMENT_RECEIVED: PRIORITY_BULK,
+    }
+
+# The only kinds a full DROP level throws away, a lost keystroke is
+# typed again but a lost change of the connection's state is not sent
+# again. Every other kind waits for room as on a BLOCK level.
+DEFAULT_DROPPABLE = frozenset((events.KEYBOARD_INPUT,))
+
+# (maxsize, policy) of every level. Bulk events come from the threads
+# reading the connection, blocking them stops reading and pushes back
+# on the phone. Nothing else should ever get close to its bound.
+DEFAULT_LIMITS = (
+    (1024, DROP),
+    (1024, DROP),
+    (4096, BLOCK),
+    )
+
+class EventBus():
+    '''Queue of events for the UserInterface, served by priority
+
+    Takes the place of the plain Queue shared by the worker threads and
+    accepts the same put() and get() calls. Every event is put in the
+    FIFO of its priority level and the highest level with events is
+    served first. Events of the same level keep their order.
+
+    Bulk events (received texts and write acknowledgements) are handed
+    out in batches by getBatch(), so a burst of them costs one lock per
+    batch. Lower levels can only be passed over maxSkip times in a row,
+    after that they are served once, which bounds their wait even when
+    keys are held down.
+
+    Every level is bounded. A full BLOCK level makes put() wait, a full
+    DROP level throws droppable events (keystrokes) away and counts them
+    in dropped, any other event waits. Once the bus is closed nothing
+    waits any more, events that do not fit are dropped. highWater is the most events that have waited per level.
+
+    Public Methods:
+    put(Event event)
+    get(boolean block, float timeout)
+    getBatch(int limit, float timeout)
+    requeue(list events)
+    close()
+    qsize()
+    '''
+
+    def __init__(self, priorities=None, limits=DEFAULT_LIMITS, \
+                 batchSize=64, maxSkip=16, droppable=DEFAULT_DROPPABLE):
+        """Constructor
+
+        priorities - dict of event kind to priority level, kinds that
+                     are not in it are PRIORITY_NORMAL
+        limits - (maxsize, policy) of every level
+        batchSize - most bulk events returned by one getBatch()
+        maxSkip - times a waiting level can be passed over in a row
+        droppable - event kinds a full DROP level throws away
+        """
+        self.priorities = DEFAULT_PRIORITIES.copy() if priorities is None \
+            else priorities
+        self.limits = limits
+        self.batchSize = batchSize
+        self.maxSkip = maxSkip
+        self.droppable = droppable
+        self.highWater = [0, 0, 0]
+        self.dropped = [0, 0, 0]
+        self._levels = (deque(), deque(), deque())
+        self._skipped = [0, 0, 0]
+        self._count = 0
+        self._closed = False
+        lock = Lock()
+        self._ready = Condition(lock)
+        self._space = Condition(lock)
+
+    def put(self, event, block=True, timeout=None):
+        """Adds an event, returns False if it was dropped
+
+        Only waits when the event's level is full and its policy is
+        BLOCK, or the event is not droppable. Raises queue.Full if block is False or timeout runs out.
+        """
+        level = self.priorities.get(event[0], PRIORITY_NORMAL)
+        maxsize, policy = self.limits[level]
+        fifo = self._levels[level]
+        with self._ready:
+            if len(fifo) >= maxsize:
+                if self._closed or \
+                   (policy == DROP and event[0] in self.droppable):
+                    self.dropped[level] += 1
+                    return False
+                if not block:
+                    raise Full
+                self._waitForRoom(fifo, maxsize, timeout)
+                if self._closed:
+                    self.dropped[level] += 1
+                    return False
+            fifo.append(event)
+            if len(fifo) > self.highWater[level]:
+                self.highWater[level] = len(fifo)
+            self._count += 1
+            self._ready.notify()
+            return True
+
+    def put_nowait(self, event):
+        return self.put(event, block=False)
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the next event, as Queue.get()"""
+        with self._ready:
+            self._wait(block, timeout)
+            level = self._nextLevel()
+            self._count -= 1
+            self._space.notify_all()
+            return self._levels[level].popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def getBatch(self, limit=None, timeout=None):
+        """Removes and returns a list of the next events
+
+        A single event unless the next level to be served is bulk, in
+        which case up to limit (batchSize by default) bulk events are
+        returned together. Blocks until there is an event, or raises
+        Empty after timeout seconds.
+        """
+        with self._ready:
+            self._wait(True, timeout)
+            level = self._nextLevel()
+            fifo = self._levels[level]
+            self._space.notify_all()
+            if level != PRIORITY_BULK:
+                self._count -= 1
+                return [fifo.popleft()]
+            count = min(len(fifo), limit or self.batchSize)
+            self._count -= count
+            return [fifo.popleft() for _ in range(count)]
+
+    def requeue(self, unhandled):
+        """Puts events from getBatch() back in front of their level,
+        for when only some of them were handled. Ignores the bounds."""
+        with self._ready:
+            for event in reversed(unhandled):
+                level = self.priorities.get(event[0], PRIORITY_NORMAL)
+                self._levels[level].appendleft(event)
+                self._count += 1
+            if unhandled:
+                self._ready.notify()
+
+    def close(self):
+        """Stops put() from waiting, for when nothing will read the bus
+        any more. Producers that are waiting drop their event."""
+        with self._ready:
+            self._closed = True
+            self._space.notify_all()
+
+    def qsize(self):
+        return self._count
+
+    def empty(self):
+        return self._count == 0
+
+    def _wait(self, block, timeout):
+        """Waits for an event while holding the lock"""
+        if not block:
+            if not self._count:
+                raise Empty
+        elif timeout is None:
+            while not self._count:
+                self._ready.wait()
+        else:
+            deadline = time.monotonic() + timeout
+            while not self._count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Empty
+                self._ready.wait(remaining)
+
+    def _waitForRoom(self, fifo, maxsize, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(fifo) >= maxsize and not self._closed:
+            if deadline is None:
+                self._space.wait()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Full
+            self._space.wait(remaining)
+
+    def _nextLevel(self):
+        """Picks the level to serve, there must be an event waiting"""
+        chosen = None
+        for level, fifo in enumerate(self._levels):
+            if not fifo:
+                continue
+            if chosen is None:
+                chosen = level
+            elif self._skipped[level] >= self.maxSkip:
+                # Waited long enough, its turn
+                chosen = level
+                break
+        for level in range(len(self._levels)):
+            if level == chosen or not self._levels[level]:
+                self._skipped[level] = 0
+            else:
+                self._skipped[level] += 1
+        return chosen
@@ -0,0 +1,100 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from collections import namedtuple
+
+# Event kinds. Small ints so dispatch tables hash and compare them
+# cheaply. The worker threads expose these under their own names, e.g.
+# InputThread.KEYBOARD_INPUT and BluetoothService.OUTPUT_NOTE.
+KEYBOARD_INPUT = 1
+GATHER = 2
+CANCEL = 3
+DISCOVER_STARTED = 4
+DISCOVER_RESULT = 5
+DISCOVER_COMPLETE = 6
+CONNECTION_MADE = 7
+CONNECTION_FAILED = 8
+CONNECTION_LOST = 9
+DISCONNECTED = 10
+BLUETOOTH_MESSAGE = 11
+WRITE_SUCCESS = 12
+WRITE_FAILED = 13
+ERROR = 14
+NOTE = 15
+RECEIVED_TEXT_MESSAGE = 16
+RECONNECTING = 17
+MESSAGE_STATUS = 18
+HISTORY_AVAILABLE = 19
+HISTORY_PAGE = 20
+HISTORY_SYNCED = 21
+DEVICE_FOUND = 22
+ATTACHMENT_RECEIVED = 23
+HISTORY_NOT_STORED = 24
+
+_NAMES = {value: name for name, value in globals().items() \
+          if name.isupper() and isinstance(value, int)}
+
+class Event(namedtuple('Event', ('kind', 'args'))):
+    '''An output of a worker thread for the UserInterface
+
+    kind is one of the constants above and args a dict of the details,
+    or the key code for KEYBOARD_INPUT. Being a tuple, an event still
+    unpacks as (outType, args).
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"Event({name(self.kind)}, {self.args!r})"
+
+def name(kind):
+    """Readable name of an event kind, for logging"""
+    return _NAMES.get(kind, str(kind))
+
+class Dispatcher():
+    '''Table of handlers for events, looked up by kind
+
+    Keyboard events are looked up a second time by key code, so states
+    can bind keys without a handler that compares every key. Handlers
+    are called with the event's args.
+
+    Public Methods:
+    register(int kind, function handler)
+    bindKey(int ch, function handler)
+    dispatch(Event event)
+    '''
+
+    def __init__(self, fallback=None):
+        """Constructor
+
+        fallback - Dispatcher asked for any kind or key not found here
+        """
+        self.fallback = fallback
+        self._handlers = {KEYBOARD_INPUT: self._dispatchKey}
+        self._keys = {}
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+        return self
+
+    def bindKey(self, ch, handler):
+        self._keys[ch] = handler
+        return self
+
+    def dispatch(self, event):
+        """Calls the handler of the event, returns False if none did"""
+        handler = self._handlers.get(event.kind)
+        if handler is not None and handler(event.args) is not False:
+            return True
+        if self.fallback is not None:
+            return self.fallback.dispatch(event)
+        return False
+
+    def _dispatchKey(self, ch):
+        handler = self._keys.get(ch)
+        if handler is None:
+            return False
+        handler(ch)
+        return True
@@ -0,0 +1,137 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import struct
+
+# Every frame on the wire is a 4 byte big endian length followed by that
+# many bytes of payload. The first byte of the payload is the message type.
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 1 << 20
+
+class FrameReader():
+    '''Splits a byte stream into length prefixed frames
+
+    Data is read with recv_into() straight into a preallocated
+    bytearray so that no new bytes objects are made for each read. Any
+    number of complete frames can be pulled out after a read and a
+    partial frame is kept until the rest of it arrives.
+
+    The frames handed out are memoryview slices of the internal buffer.
+    They are only valid until the next call to recvFrom(). Copy them
+    with bytes() if they need to be kept any longer.
+
+    Public Methods:
+    recvFrom(socket sock)
+    writable()
+    commit(int count)
+    feed(byte[] data)
+    frames()
+    '''
+
+    def __init__(self, size=4096, maxFrameSize=MAX_FRAME_SIZE):
+        """Constructor
+
+        size - initial size of the receive buffer in bytes. The buffer
+               grows when a single frame does not fit.
+        maxFrameSize - largest payload accepted before the stream is
+                       considered corrupt.
+        """
+        self.maxFrameSize = maxFrameSize
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # first byte that has not been handed out
+        self._end = 0 # one past the last byte received
+
+    def recvFrom(self, sock):
+        """Reads whatever is available on sock into the buffer
+
+        Returns the number of bytes read. 0 means the remote end closed
+        the connection.
+        """
+        self._makeRoom()
+        recvInto = getattr(sock, 'recv_into', None)
+        if recvInto is not None:
+            count = recvInto(self._view[self._end:])
+        else:
+            # Some socket wrappers (pybluez) do not expose recv_into
+            data = sock.recv(len(self._buffer) - self._end)
+            count = len(data)
+            self._view[self._end : self._end + count] = data
+        self._end += count
+        return count
+
+    def writable(self):
+        """Returns a memoryview of the free space at the end of the buffer
+
+        For callers that do their own reads, such as loop.sock_recv_into().
+        commit() must be called with the number of bytes written into it.
+        """
+        self._makeRoom()
+        return self._view[self._end:]
+
+    def commit(self, count):
+        """Marks count bytes of the writable() view as received"""
+        self._end += count
+
+    def feed(self, data):
+        """Copies data into the buffer as if it had been received
+
+        Used by transports that hand over bytes rather than a socket.
+        """
+        count = len(data)
+        self._makeRoom(count)
+        self._view[self._end : self._end + count] = data
+        self._end += count
+
+    def frames(self):
+        """Generator that yields the payload of every complete frame"""
+        headerSize = FRAME_HEADER.size
+        while self._end - self._start >= headerSize:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+            if length > self.maxFrameSize:
+                raise FramingError(f"Frame of {length} bytes is larger " \
+                                   f"than the limit of {self.maxFrameSize}")
+            if length == 0:
+                # Every payload has at least its type byte
+                raise FramingError("Frame of 0 bytes")
+            frameEnd = self._start + headerSize + length
+            if frameEnd > self._end:
+                break
+            payload = self._view[self._start + headerSize : frameEnd]
+            self._start = frameEnd
+            yield payload
+
+    def _makeRoom(self, needed=1):
+        """Moves a partial frame to the front of the buffer and grows
+        the buffer when the partial frame can not fit otherwise."""
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+        required = pending + needed
+        if pending >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+            if length <= self.maxFrameSize:
+                required = max(required, FRAME_HEADER.size + length)
+        if required > len(self._buffer):
+            # Replace rather than resize since frames may still be
+            # exported from the old buffer.
+            newBuffer = bytearray(max(required, len(self._buffer) * 2))
+            newBuffer[0:pending] = self._view[self._start:self._end]
+            self._buffer = newBuffer
+            self._view = memoryview(newBuffer)
+            self._start, self._end = 0, pending
+        elif self._end + needed > len(self._buffer) \
+                or self._end - self._start < self._start:
+            self._view[0:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+def packFrame(payload):
+    """Returns payload with the length prefix prepended"""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class FramingError(IOError):
+    """Raised when the incoming stream can no longer be split in frames"""
+    pass
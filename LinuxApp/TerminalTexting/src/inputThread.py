@@ -3,6 +3,10 @@
 '''
 from threading import Thread
 from curses import ascii
+import curses
+import signal
+from src import events
+from src.events import Event
 
 class InputThread(Thread):
     '''Thread class specifically for collecting keystokes
@@ -11,14 +15,32 @@ class InputThread(Thread):
     to the outputQueue. When switching to edit mode, a displayThread is
     passed and the keystokes or commands are passed there using the 
     displayThread's tBoxCommand(ch) method call.
+    
+    In edit mode, printable keys that are already waiting are read
+    ahead and passed on together with tBoxInsert(text), so fast typing
+    and pastes cost one display request instead of one per key.
+    Bracketed paste is turned on while editing, so a paste arrives as
+    a single run even when it holds newlines or tabs. The display
+    thread asks the terminal for it, as only it writes to the terminal.
+    
+    Keystrokes are read from a pad of the thread's own rather than from
+    the tbox, so reading never changes or refreshes a window the
+    display thread draws in.
+    
+    KEY_RESIZE is always passed to the outputQueue, whatever the mode.
     '''
     
-    KEYBOARD_INPUT = "keyboardInput"
-    OUTPUT_GATHER = "gather"
-    OUTPUT_CANCEL = "cancel"
+    KEYBOARD_INPUT = events.KEYBOARD_INPUT
+    OUTPUT_GATHER = events.GATHER
+    OUTPUT_CANCEL = events.CANCEL
     
     __STANDARD_MODE = "standard"
     __EDIT_MODE = "edit"
+    
+    __PASTE_START = [ord(c) for c in "[200~"] # after an ESC
+    __PASTE_END = [ascii.ESC] + [ord(c) for c in "[201~"]
+    __PASTE_TIMEOUT = 100 # ms to wait for the rest of a paste
+    __MAX_RUN = 4096 # most keystrokes passed on in one request
 
     def __init__(self, outputQueue, tbox):
         super(InputThread, self).__init__()
@@ -27,6 +49,9 @@ class InputThread(Thread):
         self.running = True
         self.mode = self.__STANDARD_MODE
         self.displayThread = None
+        # Never drawn in, so getch() has nothing to refresh
+        self.keys = curses.newpad(1, 1)
+        self.keys.keypad(True)
         self.start()
     
     def editMode(self, value=True, displayThread=None):
@@ -43,34 +68,106 @@ class InputThread(Thread):
             self.mode = self.__EDIT_MODE
         else:
             self.mode = self.__STANDARD_MODE
+        # Leaving edit mode, the display thread it was for turns it off
+        pasteDisplay = displayThread or self.displayThread
         self.displayThread = displayThread
+        if pasteDisplay is not None:
+            pasteDisplay.bracketedPaste(value)
         
     def join(self, timeout=None):
         """terminates and joins the thread after 1 last keystroke"""
         self.running = False
+        if self.displayThread is not None:
+            self.displayThread.bracketedPaste(False)
         Thread.join(self, timeout=timeout)
         
     def run(self):
+        # The terminal changing size interrupts getch() with KEY_RESIZE
+        # only in the thread SIGWINCH is delivered to
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGWINCH})
         while self.running:
-            ch = self.tbox.getInput()
-            if self.mode == self.__STANDARD_MODE:
+            ch = self.keys.getch()
+            if self.mode == self.__STANDARD_MODE or ch == curses.KEY_RESIZE:
                 if self.running:
-                    self.output.put((self.KEYBOARD_INPUT, ch))
+                    self.output.put(Event(self.KEYBOARD_INPUT, ch))
             else: # Edit Mode
                 if self.running:
                     if ch == ascii.VT:
                         # gather
-                        self.output.put((self.OUTPUT_GATHER, \
+                        self.output.put(Event(self.OUTPUT_GATHER, \
                                          {'message': self.tbox.gather()}))
                     elif ch == ascii.ENQ:
                         # cancel
-                        self.output.put((self.OUTPUT_CANCEL, ()))
+                        self.output.put(Event(self.OUTPUT_CANCEL, {}))
+                    elif ch in (curses.KEY_PPAGE, curses.KEY_NPAGE):
+                        # page through the display while composing
+                        self.displayThread.scrollDisplay(ch)
+                    elif ch == ascii.ESC and self._pasteStarted():
+                        self.displayThread.tBoxInsert(self._readPaste())
+                    elif ascii.isprint(ch):
+                        self.displayThread.tBoxInsert(self._readRun(ch))
                     else:
                         # send to display thread
                         self.displayThread.tBoxCommand(ch)
-            
-            
-            
-            
-            
-            
\ No newline at end of file
+                        
+    def _readRun(self, ch):
+        """Returns ch and the printable keys already waiting after it"""
+        run = [chr(ch)]
+        while len(run) < self.__MAX_RUN:
+            ch = self._getInputNoWait()
+            if ch == -1:
+                break
+            if not ascii.isprint(ch):
+                curses.ungetch(ch) # Handled on the next pass
+                break
+            run.append(chr(ch))
+        return "".join(run)
+    
+    def _pasteStarted(self):
+        """Checks if the ESC just read starts a bracketed paste. Any
+        other keys read while checking are put back."""
+        read = []
+        for expected in self.__PASTE_START:
+            ch = self._getInputNoWait()
+            if ch == -1:
+                break
+            read.append(ch)
+            if ch != expected:
+                break
+        if read == self.__PASTE_START:
+            return True
+        for ch in reversed(read):
+            curses.ungetch(ch)
+        return False
+    
+    def _readPaste(self):
+        """Reads up to the end of a bracketed paste
+        
+        Line breaks and tabs become spaces since the message is sent as
+        a single line. Gives up on the end marker if the terminal goes
+        quiet.
+        """
+        end = self.__PASTE_END
+        pasted = []
+        self.keys.timeout(self.__PASTE_TIMEOUT)
+        try:
+            while True:
+                ch = self.keys.getch()
+                if ch == -1:
+                    break
+                pasted.append(ch)
+                if ch == end[-1] and pasted[-len(end):] == end:
+                    del pasted[-len(end):]
+                    break
+        finally:
+            self.keys.timeout(-1)
+        return "".join(" " if ch in (ascii.NL, ascii.CR, ascii.TAB) \
+                       else chr(ch) for ch in pasted if 0 <= ch < 0x110000)
+    
+    def _getInputNoWait(self):
+        """Returns a keystroke that is already waiting, or -1"""
+        self.keys.nodelay(True)
+        try:
+            return self.keys.getch()
+        finally:
+            self.keys.nodelay(False)
@@ -0,0 +1,90 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import unicodedata
+
+_widths = {}
+
+def charWidth(ch):
+    """Number of terminal cells a character takes up
+
+    Combining marks and other zero width characters take 0 cells, East
+    Asian wide and fullwidth characters (CJK, most emoji) take 2.
+    """
+    width = _widths.get(ch)
+    if width is None:
+        if unicodedata.category(ch) in ('Mn', 'Me', 'Cf') \
+                or unicodedata.combining(ch):
+            width = 0
+        elif unicodedata.east_asian_width(ch) in ('W', 'F'):
+            width = 2
+        else:
+            width = 1
+        _widths[ch] = width
+    return width
+
+def textWidth(text):
+    """Number of terminal cells text takes up"""
+    if text.isascii():
+        return len(text)
+    return sum(charWidth(ch) for ch in text)
+
+def wrap(text, width):
+    """Breaks text into lines of at most width cells
+
+    Lines are broken after the last space that fits and only mid word
+    when a word is longer than a line. Newlines always start a new
+    line. Returns a list of (start, end) indexes into text so no copies
+    are made until a line is actually drawn.
+    """
+    width = max(width, 2)
+    ascii = text.isascii()
+    lines = []
+    start = 0 # first character of the current line
+    used = 0 # cells used on the current line
+    space = -1 # index of the last space on the current line
+    usedAtSpace = 0
+    i = 0
+    end = len(text)
+    while i < end:
+        ch = text[i]
+        if ch == '\n':
+            lines.append((start, i))
+            start = i + 1
+            used = 0
+            space = -1
+            i += 1
+            continue
+        cells = 1 if ascii else charWidth(ch)
+        if used + cells > width and cells > 0 and i > start:
+            if space > start:
+                lines.append((start, space))
+                start = space + 1
+                used -= usedAtSpace + 1
+            else:
+                lines.append((start, i))
+                start = i
+                used = 0
+            space = -1
+            continue # the character has not been placed yet
+        if ch == ' ':
+            space = i
+            usedAtSpace = used
+        used += cells
+        i += 1
+    lines.append((start, end))
+    return lines
+
+def clip(text, width):
+    """Returns as much of the start of text as fits in width cells"""
+    if text.isascii():
+        return text[:width]
+    used = 0
+    for i, ch in enumerate(text):
+        used += charWidth(ch)
+        if used > width:
+            return text[:i]
+    return text
@@ -0,0 +1,134 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from logging.handlers import QueueHandler, QueueListener, \
+                             RotatingFileHandler
+import json
+import logging
+import re
+from src import metrics
+from src.boundedQueue import BoundedQueue, DROP
+
+# Anything that looks like a phone number
+_PHONE_NUMBER = re.compile(r'\+?\d[\d\- ]{6,}\d')
+
+_redacting = True
+_dropped = metrics.counter("log.dropped")
+
+class Redacted():
+    '''Wraps message contents passed as a logging argument
+
+    Only turned into text when the record is written, as a placeholder
+    unless redaction has been turned off with setup(redact=False).
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if _redacting:
+            return f"<redacted {len(self.value)}>"
+        return str(self.value)
+
+    __repr__ = __str__
+
+def redact(value):
+    """Marks a logging argument as private, e.g.
+
+    log.debug("Sending %s", redact(message))
+    """
+    return Redacted(value)
+
+class _RedactingFilter(logging.Filter):
+    """Masks phone numbers in the finished message. Runs on the writer
+    thread, after the message has been formatted."""
+
+    def filter(self, record):
+        message = record.getMessage()
+        record.msg = _PHONE_NUMBER.sub(_maskNumber, message)
+        record.args = None
+        return True
+
+def _maskNumber(match):
+    number = match.group()
+    return "*" * (len(number) - 2) + number[-2:]
+
+class _LazyQueueHandler(QueueHandler):
+    """Hands records to the writer thread as they are
+
+    The standard QueueHandler formats every record before queueing it,
+    which is the work this is meant to keep off the calling thread. A
+    full queue drops the record and counts it instead of blocking.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if not self.queue.put(record, DROP):
+            _dropped.inc()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup(path='log.log', level=logging.INFO, moduleLevels=None, \
+          jsonLines=False, maxBytes=5 * 1024 * 1024, backupCount=3, \
+          redact=True, maxQueue=10000):
+    """Sends every log record through a queue to a background writer
+
+    path - file written to, rotated when it reaches maxBytes with
+           backupCount old files kept
+    level - level of the root logger
+    moduleLevels - dict of logger name (e.g. "src.bluetoothService") to
+                   level, for finer or coarser logging of single modules
+    jsonLines - write JSON objects instead of plain text lines
+    redact - hide message contents and phone numbers
+    maxQueue - most records waiting, more are dropped and counted
+
+    Returns the QueueListener, stop() it to flush the file at exit.
+    """
+    global _redacting
+    _redacting = redact
+    fileHandler = RotatingFileHandler(path, maxBytes=maxBytes, \
+                                      backupCount=backupCount)
+    if jsonLines:
+        fileHandler.setFormatter(JsonFormatter())
+    else:
+        fileHandler.setFormatter(logging.Formatter( \
+            "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"))
+    if redact:
+        fileHandler.addFilter(_RedactingFilter())
+    records = BoundedQueue(maxQueue)
+    listener = QueueListener(records, fileHandler, \
+                             respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_LazyQueueHandler(records))
+    root.setLevel(level)
+    for name, moduleLevel in (moduleLevels or {}).items():
+        logging.getLogger(name).setLevel(moduleLevel)
+    listener.start()
+    return listener
+
+def parseModuleLevel(text):
+    """Parses NAME=LEVEL, e.g. src.bluetoothService=DEBUG"""
+    name, _, level = text.partition("=")
+    level = level.upper()
+    if not name or not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f"Expected NAME=LEVEL, got '{text}'")
+    return name, level
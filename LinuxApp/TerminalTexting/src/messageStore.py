@@ -0,0 +1,341 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from threading import Thread, Event, Lock
+from queue import Empty
+import logging
+import os
+import sqlite3
+import time
+from src.boundedQueue import BoundedQueue
+
+log = logging.getLogger(__name__)
+
+class MessageStore(Thread):
+    '''Keeps every sent and received text in an SQLite database
+
+    Writes are queued and committed in batches by this thread so the
+    UI never waits on the disk. The database runs in WAL mode so reads
+    from other threads are not blocked by the writer. Messages are
+    indexed by phone number and time, so the last N messages of a
+    conversation are a short index scan however large the history is.
+
+    Outgoing messages are tracked by the messageID returned from
+    BluetoothService.write(). Those ids restart with every run, so they
+    are stored along with the session they belong to.
+
+    History synced from the phone is written a page at a time, in one
+    transaction with the watermark of the page, so an interrupted sync
+    picks up after the last page stored. Messages keep the phone's own
+    id, a message already stored, from an earlier sync or because it
+    was seen live, is not stored twice. Once a page could not be
+    stored, the pages of its scope after it are not stored either,
+    that would leave a gap below the watermark, until retryHistory().
+
+    Public Constants:
+    DIRECTION_RECEIVED
+    DIRECTION_SENT
+    STATUS_RECEIVED
+    STATUS_QUEUED
+    STATUS_ON_WIRE
+    STATUS_DELIVERED
+    STATUS_SENT
+    STATUS_FAILED
+    STATUS_UNKNOWN
+
+    Public Methods:
+    addReceived(TextMessage message)
+    addSent(String phoneNumber, String message, int messageID)
+    updateStatus(int messageID, String status)
+    addHistory(list records, String scope, int watermark, function done,
+               function failed)
+    retryHistory(String scope)
+    watermark(String scope)
+    lastMessages(String phoneNumber, int count)
+    flush()
+    join()
+    '''
+
+    DIRECTION_RECEIVED = 0
+    DIRECTION_SENT = 1
+
+    STATUS_RECEIVED = "received"
+    STATUS_QUEUED = "queued"
+    STATUS_ON_WIRE = "on-wire" # written to the connection
+    STATUS_DELIVERED = "delivered" # the phone has it
+    STATUS_SENT = "sent" # the phone sent it as an SMS
+    STATUS_FAILED = "failed"
+    STATUS_UNKNOWN = "unknown" # may or may not have been sent as an SMS
+
+    __INSERT = "insert"
+    __UPDATE = "update"
+    __HISTORY = "history"
+    __RETRY = "retry"
+    __FLUSH = "flush"
+    __STOP = "stop"
+
+    __SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " id INTEGER PRIMARY KEY,"
+        " timestamp REAL NOT NULL,"
+        " phoneNumber TEXT NOT NULL,"
+        " contactName TEXT,"
+        " direction INTEGER NOT NULL,"
+        " status TEXT NOT NULL,"
+        " message TEXT NOT NULL,"
+        " session INTEGER,"
+        " messageID INTEGER,"
+        " phoneID INTEGER)",
+        "CREATE INDEX IF NOT EXISTS messagesByNumber"
+        " ON messages (phoneNumber, timestamp)",
+        "CREATE INDEX IF NOT EXISTS messagesByTime ON messages (timestamp)",
+        "CREATE INDEX IF NOT EXISTS messagesBySend"
+        " ON messages (session, messageID) WHERE messageID IS NOT NULL",
+        "CREATE TABLE IF NOT EXISTS watermarks ("
+        " scope TEXT PRIMARY KEY,"
+        " watermark INTEGER NOT NULL)",
+        )
+    __PHONE_ID_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS messagesByPhoneID" \
+                       " ON messages (phoneID) WHERE phoneID IS NOT NULL"
+    __INSERT_SQL = "INSERT INTO messages (timestamp, phoneNumber, " \
+                   "contactName, direction, status, message, session, " \
+                   "messageID) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    __UPDATE_SQL = "UPDATE messages SET status = ? " \
+                   "WHERE session = ? AND messageID = ?"
+    __HISTORY_SQL = "INSERT OR IGNORE INTO messages (timestamp, " \
+                    "phoneNumber, contactName, direction, status, message, " \
+                    "phoneID) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    # Gives the phone's id to the same message stored without one
+    __CLAIM_SQL = "UPDATE OR IGNORE messages SET phoneID = ? WHERE id = (" \
+                  "SELECT id FROM messages WHERE phoneNumber = ? " \
+                  "AND timestamp BETWEEN ? AND ? AND direction = ? " \
+                  "AND message = ? AND phoneID IS NULL LIMIT 1)"
+    __WATERMARK_SQL = "INSERT OR REPLACE INTO watermarks (scope, " \
+                      "watermark) VALUES (?, max(?, coalesce((SELECT " \
+                      "watermark FROM watermarks WHERE scope = ?), 0)))"
+    __SELECT_WATERMARK_SQL = "SELECT watermark FROM watermarks " \
+                             "WHERE scope = ?"
+    # Seconds between the phone's time of a message and ours for them to
+    # be taken as the same message
+    __CLAIM_WINDOW = 6 * 3600
+    __SELECT_SQL = "SELECT timestamp, phoneNumber, contactName, " \
+                   "direction, status, message FROM messages " \
+                   "WHERE phoneNumber = ? ORDER BY timestamp DESC LIMIT ?"
+
+    def __init__(self, path, batchSize=512, maxQueue=65536):
+        """Constructor
+
+        path - file of the SQLite database, created if missing
+        batchSize - most writes committed in a single transaction
+        maxQueue - most writes waiting, adding more waits for room
+        """
+        super(MessageStore, self).__init__(daemon=True)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batchSize = batchSize
+        self.session = time.time_ns()
+        self.input = BoundedQueue(maxQueue)
+        self._readLock = Lock()
+        self._readConnection = None
+        connection = self._connect()
+        for statement in self.__SCHEMA:
+            connection.execute(statement)
+        columns = [row[1] for row in \
+                   connection.execute("PRAGMA table_info(messages)")]
+        if 'phoneID' not in columns:
+            connection.execute("ALTER TABLE messages ADD COLUMN " \
+                               "phoneID INTEGER")
+        connection.execute(self.__PHONE_ID_INDEX)
+        connection.commit()
+        connection.close()
+        self.start()
+
+    def addReceived(self, message, timestamp=None):
+        """Save a TextMessage received from the remote device"""
+        self.input.put((self.__INSERT, \
+                        (timestamp or time.time(), message.phoneNumber, \
+                         message.contactName, self.DIRECTION_RECEIVED, \
+                         self.STATUS_RECEIVED, message.message, None, None)))
+
+    def addSent(self, phoneNumber, message, messageID, timestamp=None):
+        """Save an outgoing message. Its status starts as queued."""
+        self.input.put((self.__INSERT, \
+                        (timestamp or time.time(), phoneNumber, None, \
+                         self.DIRECTION_SENT, self.STATUS_QUEUED, message, \
+                         self.session, messageID)))
+
+    def updateStatus(self, messageID, status):
+        """Change the delivery status of a message from addSent()"""
+        self.input.put((self.__UPDATE, (status, self.session, messageID)))
+
+    def addHistory(self, records, scope, watermark, done=None, \
+                   failed=None):
+        """Save a page of history from the phone
+
+        records - HistoryRecords of the page
+        scope - what was synced, a phone number or '' for everything
+        watermark - phone's id of the last message of the page
+        done - called from the writer once the page is committed
+        failed - called from the writer instead of done when the page
+                 was not stored
+        """
+        rows = []
+        for record in records:
+            message = record.message
+            if record.direction == self.DIRECTION_SENT:
+                status = self.STATUS_SENT
+            else:
+                status = self.STATUS_RECEIVED
+            rows.append((record.timestamp, message.phoneNumber, \
+                         message.contactName, record.direction, status, \
+                         message.message, record.phoneID))
+        self.input.put((self.__HISTORY, (rows, scope, watermark, done, \
+                                         failed)))
+
+    def retryHistory(self, scope):
+        """Store the pages of scope again after one failed. Call it
+        before the sync is asked for again from watermark()."""
+        self.input.put((self.__RETRY, scope))
+
+    def watermark(self, scope):
+        """Returns the phone's id of the last message synced for scope,
+        0 if nothing was"""
+        with self._readLock:
+            row = self._reader().execute(self.__SELECT_WATERMARK_SQL, \
+                                         (scope,)).fetchone()
+        return row[0] if row else 0
+
+    def lastMessages(self, phoneNumber, count):
+        """Returns the last count messages with phoneNumber, oldest first
+
+        Only sees writes that have been committed, call flush() first to
+        include everything queued so far.
+        """
+        with self._readLock:
+            rows = self._reader().execute(self.__SELECT_SQL, \
+                                          (phoneNumber, count)).fetchall()
+        rows.reverse()
+        return [StoredMessage(*row) for row in rows]
+
+    def flush(self, timeout=None):
+        """Blocks until every write queued so far is committed"""
+        done = Event()
+        self.input.put((self.__FLUSH, done))
+        return done.wait(timeout)
+
+    def join(self, timeout=None):
+        """Commits what is queued and stops the writer"""
+        self.input.put((self.__STOP, None))
+        Thread.join(self, timeout=timeout)
+        with self._readLock:
+            if self._readConnection is not None:
+                self._readConnection.close()
+                self._readConnection = None
+
+    def _reader(self):
+        """Connection for reads from other threads, hold _readLock"""
+        if self._readConnection is None:
+            self._readConnection = self._connect(checkSameThread=False)
+        return self._readConnection
+
+    def _connect(self, checkSameThread=True):
+        connection = sqlite3.connect(self.path, \
+                                     check_same_thread=checkSameThread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def run(self):
+        connection = self._connect()
+        # Scopes that an earlier page of is missing from
+        failedScopes = set()
+        running = True
+        while running:
+            batch = [self.input.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.input.get_nowait())
+                except Empty:
+                    break
+            writes = []
+            pages = [] # (scope, done, failed) of the history written
+            skipped = [] # failed of the history that is not written
+            flushes = []
+            for command, args in batch:
+                if command == self.__HISTORY:
+                    if args[1] in failedScopes:
+                        skipped.append(args[4])
+                    else:
+                        writes.append((command, args))
+                        pages.append((args[1], args[3], args[4]))
+                elif command == self.__RETRY:
+                    failedScopes.discard(args)
+                elif command == self.__FLUSH:
+                    flushes.append(args)
+                elif command == self.__STOP:
+                    running = False
+                else:
+                    writes.append((command, args))
+            committed = True
+            try:
+                with connection:
+                    self._write(connection, writes)
+            except sqlite3.Error:
+                log.exception("MessageStore failed to write a batch")
+                committed = False
+                failedScopes.update(scope for scope, _, _ in pages)
+            for _, done, failed in pages:
+                callback = done if committed else failed
+                if callback is not None:
+                    callback()
+            for failed in skipped:
+                if failed is not None:
+                    failed()
+            for done in flushes:
+                done.set()
+        connection.close()
+
+    def _write(self, connection, writes):
+        inserts = []
+        for command, args in writes:
+            if command == self.__INSERT:
+                inserts.append(args)
+                continue
+            # Keep the order, inserts before this go first
+            if inserts:
+                connection.executemany(self.__INSERT_SQL, inserts)
+                inserts = []
+            if command == self.__UPDATE:
+                connection.execute(self.__UPDATE_SQL, args)
+            elif command == self.__HISTORY:
+                self._writeHistory(connection, *args[:3])
+        if inserts:
+            connection.executemany(self.__INSERT_SQL, inserts)
+
+    def _writeHistory(self, connection, rows, scope, watermark):
+        window = self.__CLAIM_WINDOW
+        connection.executemany(self.__CLAIM_SQL, \
+            ((row[6], row[1], row[0] - window, row[0] + window, row[3], \
+              row[5]) for row in rows))
+        # Claimed messages have the phoneID now and are ignored
+        connection.executemany(self.__HISTORY_SQL, rows)
+        connection.execute(self.__WATERMARK_SQL, (scope, watermark, scope))
+
+class StoredMessage():
+    """A message as read back from the MessageStore"""
+    __slots__ = ('timestamp', 'phoneNumber', 'contactName', 'direction', \
+                 'status', 'message')
+
+    def __init__(self, timestamp, phoneNumber, contactName, direction, \
+                 status, message):
+        self.timestamp = timestamp
+        self.phoneNumber = phoneNumber
+        self.contactName = contactName
+        self.direction = direction
+        self.status = status
+        self.message = message
@@ -0,0 +1,201 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from bisect import bisect_left
+from threading import Thread, Event, Lock
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+class Counter():
+    """A count that only goes up
+
+    inc() is a single attribute update, cheap enough for every frame.
+    Under the GIL an increment can very rarely be lost to a race, which
+    is fine for statistics.
+    """
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+class Gauge():
+    """A value read from a function when a snapshot is taken, so the
+    code being measured pays nothing"""
+    __slots__ = ('name', 'function')
+
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+    def read(self):
+        try:
+            return self.function()
+        except Exception:
+            return None
+
+class Histogram():
+    """Distribution of durations in seconds
+
+    Samples are counted in buckets that double in size from 10µs up to
+    about 80s, so observe() is a binary search and an increment and
+    memory does not grow with the number of samples. Percentiles are
+    the upper edge of the bucket they fall in, or the largest sample if
+    that is smaller.
+    """
+    __slots__ = ('name', 'counts', 'count', 'total', 'max')
+
+    BOUNDS = [0.00001 * 2 ** i for i in range(24)]
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                return self.max
+        return self.max
+
+    def read(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1e3 if self.count else 0,
+                'p50_ms': self.percentile(0.50) * 1e3,
+                'p90_ms': self.percentile(0.90) * 1e3,
+                'p99_ms': self.percentile(0.99) * 1e3,
+                'max_ms': self.max * 1e3}
+
+class Registry():
+    '''Named counters, gauges and histograms
+
+    Metrics are created once, usually when a module or object is set
+    up, and the returned object is kept and updated directly. Asking
+    for a name that already exists returns the existing metric, except
+    for gauges which are replaced so they follow the newest object.
+
+    Public Methods:
+    counter(String name)
+    gauge(String name, function function)
+    histogram(String name)
+    snapshot()
+    lines()
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name, function):
+        with self._lock:
+            gauge = Gauge(name, function)
+            self._metrics[name] = gauge
+            return gauge
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def snapshot(self):
+        """Returns a dict of every metric's current value"""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return {name: metric.read() for name, metric in metrics}
+
+    def lines(self):
+        """Returns the snapshot as short lines of text, for display"""
+        lines = []
+        for name, value in self.snapshot().items():
+            if isinstance(value, dict):
+                value = f"n={value['count']} p50={value['p50_ms']:.2f}ms " \
+                        f"p99={value['p99_ms']:.2f}ms " \
+                        f"max={value['max_ms']:.2f}ms"
+            lines.append(f"{name}: {value}")
+        return lines
+
+    def _get(self, name, metricType):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metricType(name)
+                self._metrics[name] = metric
+            return metric
+
+class SnapshotWriter(Thread):
+    '''Writes a JSON snapshot of a Registry to a file every interval
+    seconds
+
+    The file is replaced in one step so readers never see half of it.
+    '''
+
+    def __init__(self, path, interval=10.0, registry=None):
+        super(SnapshotWriter, self).__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self._done = Event()
+        self.start()
+
+    def join(self, timeout=None):
+        """Writes a last snapshot and stops"""
+        self._done.set()
+        Thread.join(self, timeout=timeout)
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        snapshot = {'timestamp': time.time(),
+                    'metrics': self.registry.snapshot()}
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, 'w') as out:
+                json.dump(snapshot, out, indent=1)
+            os.replace(temporary, self.path)
+        except OSError:
+            log.exception("Could not write the metrics snapshot")
+
+# The registry everything reports to
+REGISTRY = Registry()
+
+def counter(name):
+    return REGISTRY.counter(name)
+
+def gauge(name, function):
+    return REGISTRY.gauge(name, function)
+
+def histogram(name):
+    return REGISTRY.histogram(name)
@@ -0,0 +1,459 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from collections import deque
+from itertools import count
+from threading import Thread
+from queue import Empty
+import logging
+import selectors
+import socket
+import time
+from src import metrics
+from src.bluetoothService import BluetoothService, RemoteDevice, \
+                                 BluetoothManagerError, BluetoothWriteError
+from src.boundedQueue import BoundedQueue, COALESCE, DROP
+from src.events import Event
+from src.frameReader import FrameReader, FRAME_HEADER
+from src.transport import RfcommTransport
+
+# Shared with BluetoothService, see src.metrics
+_bytesIn = metrics.counter("bluetooth.bytes_in")
+_framesIn = metrics.counter("bluetooth.frames_in")
+_bytesOut = metrics.counter("bluetooth.bytes_out")
+_framesOut = metrics.counter("bluetooth.frames_out")
+_writeFailures = metrics.counter("bluetooth.write_failures")
+_frameErrors = metrics.counter("bluetooth.frame_errors")
+_connections = metrics.counter("bluetooth.connections")
+_writeToAck = metrics.histogram("bluetooth.write_to_ack")
+
+log = logging.getLogger(__name__)
+
+class MultiplexService(Thread):
+    '''Server for many remote devices at once on a single thread
+
+    Where the BluetoothService holds one connection, the MultiplexService
+    keeps accepting connections on the advertised service until
+    disconnect() is called. The listening socket and every connection
+    are non-blocking and served by one selectors loop, so a connection
+    costs a FrameReader and an outbox rather than a thread.
+
+    Every connection is given a deviceID, an int that is never reused
+    while the service runs. The same Event(outType, args) outputs as
+    the BluetoothService are pushed to the outputQueue, with 'deviceID'
+    added to the args of everything that concerns a single connection.
+    write() takes the deviceID to send to, or sends to the device that
+    was heard from last.
+
+    A bounded outputQueue that is full makes the loop wait, which stops
+    reading from every device until there is room again.
+
+    Public Constants:
+    (same as BluetoothService)
+    MAX_CONNECTIONS
+
+    Public Methods:
+    connectAsServer()
+    write(byte[] message, int deviceID)
+    disconnect(int deviceID)
+    connectionCount()
+    join()
+    '''
+
+    STATE_NONE = BluetoothService.STATE_NONE
+    STATE_CONNECTING = BluetoothService.STATE_CONNECTING
+    STATE_CONNECTED = BluetoothService.STATE_CONNECTED
+
+    OUTPUT_DISCOVER_STARTED = BluetoothService.OUTPUT_DISCOVER_STARTED
+    OUTPUT_DISCOVER_RESULT = BluetoothService.OUTPUT_DISCOVER_RESULT
+    OUTPUT_DISCOVER_COMPLETE = BluetoothService.OUTPUT_DISCOVER_COMPLETE
+    OUTPUT_CONNECTION_MADE = BluetoothService.OUTPUT_CONNECTION_MADE
+    OUTPUT_CONNECTION_FAILED = BluetoothService.OUTPUT_CONNECTION_FAILED
+    OUTPUT_CONNECTION_LOST = BluetoothService.OUTPUT_CONNECTION_LOST
+    OUTPUT_DISCONNECTED = BluetoothService.OUTPUT_DISCONNECTED
+    OUTPUT_BLUETOOTH_MESSAGE = BluetoothService.OUTPUT_BLUETOOTH_MESSAGE
+    OUTPUT_WRITE_SUCCESS = BluetoothService.OUTPUT_WRITE_SUCCESS
+    OUTPUT_WRITE_FAILED = BluetoothService.OUTPUT_WRITE_FAILED
+    OUTPUT_ERROR = BluetoothService.OUTPUT_ERROR
+    OUTPUT_NOTE = BluetoothService.OUTPUT_NOTE
+
+    # Most devices connected at once, more are turned away
+    MAX_CONNECTIONS = 64
+    # Most commands waiting for the loop
+    MAX_COMMANDS = 4096
+    # Most frames waiting to be sent to a single device
+    MAX_OUTBOX = 4096
+    # Limit on how much is handed to a single sendmsg
+    MAX_SEND_BUFFERS = 512
+
+    # commands
+    __SERVER_CONNECT = "serverConnect"
+    __WRITE = "write"
+    __DISCONNECT = "disconnect"
+    __STOP = "stop"
+
+    def __init__(self, uuid, serviceName, outputQueue, transport=None, \
+                 maxConnections=MAX_CONNECTIONS):
+        '''Constructor
+
+        Takes the same arguments as the BluetoothService. Connections
+        past maxConnections are closed as soon as they are accepted.
+        '''
+        super(MultiplexService, self).__init__(daemon=True)
+        self.state = self.STATE_NONE
+        self.uuid = uuid
+        self.name = serviceName
+        self.transport = transport or RfcommTransport()
+        self.outputQueue = outputQueue # Use the _output() method to access
+        self.maxConnections = maxConnections
+        self.commandInput = BoundedQueue(self.MAX_COMMANDS)
+        self._selector = selectors.DefaultSelector()
+        # Written to by other threads to wake the loop for a command
+        self._wakeIn, self._wakeOut = socket.socketpair()
+        self._wakeIn.setblocking(False)
+        self._wakeOut.setblocking(False)
+        self._selector.register(self._wakeIn, selectors.EVENT_READ, None)
+        self._mySock = None
+        self._connections = {} # deviceID -> _Connection
+        self._deviceIDs = count(1)
+        self._messageIDs = count(1)
+        self._lastHeard = None # deviceID writes go to by default
+        metrics.gauge("bluetooth.commands_queued", self.commandInput.qsize)
+        metrics.gauge("bluetooth.devices", self.connectionCount)
+        metrics.gauge("bluetooth.writes_queued", self._writesQueued)
+        self.start()
+
+    def connectAsServer(self):
+        """Start accepting connections from remote devices"""
+        if self.state == self.STATE_NONE:
+            self.state = self.STATE_CONNECTING
+            self._command((self.__SERVER_CONNECT,))
+        else:
+            raise BluetoothManagerError()
+
+    def write(self, message, deviceID=None):
+        """Send a byte[] as a message to a connected device
+
+        deviceID defaults to the device a frame was last received from.
+        Returns a messageID to be able to track if the write was
+        successful or not, the outcome is reported with the deviceID.
+        """
+        if deviceID is None:
+            deviceID = self._lastHeard
+            if deviceID is None and len(self._connections) == 1:
+                deviceID = next(iter(self._connections))
+        if deviceID is None or deviceID not in self._connections:
+            raise BluetoothWriteError()
+        messageID = next(self._messageIDs)
+        if not self.commandInput.put((self.__WRITE, deviceID, message, \
+                                      messageID, time.perf_counter()), DROP):
+            raise BluetoothWriteError("Too many messages waiting to be sent")
+        self._wake()
+        return messageID
+
+    def disconnect(self, deviceID=None):
+        """Disconnect one device, or stop serving altogether when
+        deviceID is None"""
+        if self.state != self.STATE_NONE:
+            self._command((self.__DISCONNECT, deviceID))
+
+    def connectionCount(self):
+        """Number of devices connected right now"""
+        return len(self._connections)
+
+    def join(self, timeout=None):
+        """Disconnect everything and join the I/O thread"""
+        self.commandInput.put((self.__STOP,), COALESCE, self.__STOP)
+        self._wake()
+        Thread.join(self, timeout=timeout)
+
+    #-----------------------------Output Methods-------------------------------
+
+    def _output(self, outType, args):
+        self.outputQueue.put(Event(outType, args))
+
+    def _outputNote(self, note):
+        self._output(self.OUTPUT_NOTE, {'note': note})
+
+    def _outputError(self, e, comment):
+        self._output(self.OUTPUT_ERROR, {'comment': comment, 'error': e})
+
+    def _outputWriteFailed(self, messageID, deviceID, e, comment):
+        _writeFailures.inc()
+        self._output(self.OUTPUT_WRITE_FAILED, {'messageID': messageID, \
+                                                'deviceID': deviceID, \
+                                                'comment': comment, \
+                                                'error': e})
+
+    def _outputBluetoothMessage(self, buffer, deviceID):
+        """Called once for every complete frame received
+
+        buffer is a memoryview into the device's receive buffer and is
+        only valid for the duration of the call.
+        """
+        self._output(self.OUTPUT_BLUETOOTH_MESSAGE, \
+                     {'message': bytes(buffer), 'deviceID': deviceID})
+
+    #-----------------------------Internal Methods-----------------------------
+
+    def _command(self, command):
+        self.commandInput.put(command)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeOut.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already plenty of wake ups waiting, or shutting down
+            pass
+
+    def _writesQueued(self):
+        return sum(len(c.outbox) for c in list(self._connections.values()))
+
+    def run(self):
+        """The I/O loop, sleeps in select() until a socket or a command
+        needs attention"""
+        try:
+            while True:
+                for key, mask in self._selector.select():
+                    if key.data is None:
+                        if not self._runCommands():
+                            return
+                    elif key.data is self:
+                        self._accept()
+                    elif key.data.deviceID in self._connections:
+                        if mask & selectors.EVENT_READ:
+                            self._read(key.data)
+                        if mask & selectors.EVENT_WRITE \
+                                and key.data.deviceID in self._connections:
+                            self._flush(key.data)
+        finally:
+            self._selector.close()
+            self._wakeIn.close()
+            self._wakeOut.close()
+
+    def _runCommands(self):
+        """Runs every waiting command, returns False to stop the loop"""
+        try:
+            while self._wakeIn.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                command = self.commandInput.get_nowait()
+            except Empty:
+                return True
+            if command[0] == self.__WRITE:
+                self._queueWrite(*command[1:])
+            elif command[0] == self.__SERVER_CONNECT:
+                log.info("MultiplexService command: %s", command[0])
+                self._startServer()
+            elif command[0] == self.__DISCONNECT:
+                log.info("MultiplexService command: %s", command[0])
+                if command[1] is None:
+                    self._stopServer()
+                elif command[1] in self._connections:
+                    self._close(self._connections[command[1]], None, \
+                                "Disconnected")
+            elif command[0] == self.__STOP:
+                log.info("MultiplexService command: %s", command[0])
+                self._stopServer()
+                return False
+
+    def _startServer(self):
+        try:
+            self._mySock = self.transport.listen(self.maxConnections)
+            self.transport.advertise(self._mySock, self.name, self.uuid)
+            self._mySock.setblocking(False)
+            self._selector.register(self._mySock, selectors.EVENT_READ, self)
+        except Exception as e:
+            self._closeListener()
+            self.state = self.STATE_NONE
+            self._output(self.OUTPUT_CONNECTION_FAILED, \
+                         {'comment': "Failed to create a server socket.", \
+                          'error': e})
+            return
+        self._outputNote("Awaiting connections")
+
+    def _stopServer(self):
+        """Closes every connection and the listening socket"""
+        serving = self.state != self.STATE_NONE
+        for connection in list(self._connections.values()):
+            self._close(connection, None, "Disconnected")
+        self._closeListener()
+        self.state = self.STATE_NONE
+        if serving:
+            # Without a deviceID, the service as a whole
+            self._output(self.OUTPUT_DISCONNECTED, \
+                         {'comment': "Stopped accepting connections"})
+
+    def _closeListener(self):
+        if self._mySock is None:
+            return
+        try:
+            self._selector.unregister(self._mySock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            self._mySock.close()
+        except Exception as e:
+            self._outputError(e, "Failed to close socket")
+        self._mySock = None
+
+    def _accept(self):
+        try:
+            sock, remoteInfo = self.transport.accept(self._mySock)
+        except BlockingIOError:
+            return
+        except Exception as e:
+            self._outputError(e, "There was an issue accepting connections.")
+            return
+        if len(self._connections) >= self.maxConnections:
+            sock.close()
+            self._outputNote(f"Turned away {remoteInfo[0]}, already serving "
+                             f"{len(self._connections)} devices")
+            return
+        sock = self.transport.nativeSocket(sock)
+        sock.setblocking(False)
+        connection = _Connection(next(self._deviceIDs), sock, remoteInfo)
+        self._connections[connection.deviceID] = connection
+        self._selector.register(sock, selectors.EVENT_READ, connection)
+        _connections.inc()
+        log.info("Device %d connected", connection.deviceID)
+        self.state = self.STATE_CONNECTED
+        device = RemoteDevice(None, remoteInfo[0], remoteInfo[1])
+        self._output(self.OUTPUT_CONNECTION_MADE, \
+                     {'device': device, 'deviceID': connection.deviceID})
+
+    def _read(self, connection):
+        try:
+            received = connection.reader.recvFrom(connection.sock)
+            if received == 0:
+                raise IOError("The remote device closed the connection")
+            _bytesIn.inc(received)
+            for frame in connection.reader.frames():
+                _framesIn.inc()
+                self._lastHeard = connection.deviceID
+                try:
+                    self._outputBluetoothMessage(frame, connection.deviceID)
+                except Exception as e:
+                    # Only the device that sent it is dropped, the loop
+                    # carries on serving the others
+                    _frameErrors.inc()
+                    log.exception("Device %d sent a frame of %d bytes that "
+                                  "could not be handled", \
+                                  connection.deviceID, len(frame))
+                    self._close(connection, e, "Sent a frame that could " \
+                                               "not be handled")
+                    return
+        except BlockingIOError:
+            pass
+        except IOError as e:
+            log.debug("Device %d stopped: %s", connection.deviceID, e)
+            self._close(connection, e, "The connection was lost")
+
+    def _queueWrite(self, deviceID, message, messageID, queuedAt):
+        connection = self._connections.get(deviceID)
+        if connection is None:
+            self._outputWriteFailed(messageID, deviceID, None, \
+                                    "Device is not connected")
+            return
+        if len(connection.outbox) >= self.MAX_OUTBOX:
+            self._outputWriteFailed(messageID, deviceID, None, \
+                                    "Too many messages waiting to be sent")
+            return
+        connection.outbox.append([[memoryview(FRAME_HEADER.pack( \
+                                      len(message))), memoryview(message)], \
+                                  messageID, queuedAt, \
+                                  FRAME_HEADER.size + len(message)])
+        if not connection.writing:
+            # Try straight away, most writes fit in the socket buffer
+            self._flush(connection)
+
+    def _flush(self, connection):
+        """Sends as much of the outbox as the socket takes without
+        blocking, waiting for EVENT_WRITE for the rest"""
+        outbox = connection.outbox
+        while outbox:
+            buffers = []
+            for item in outbox:
+                buffers.extend(item[0])
+                if len(buffers) >= self.MAX_SEND_BUFFERS:
+                    break
+            try:
+                sent = connection.sock.sendmsg(buffers)
+            except BlockingIOError:
+                break
+            except IOError as e:
+                self._close(connection, e, "The connection was lost")
+                return
+            # Drop what was sent, the last frame may be partly sent
+            while sent:
+                views = outbox[0][0]
+                while views and sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                if views:
+                    views[0] = views[0][sent:]
+                    break
+                _, messageID, queuedAt, size = outbox.popleft()
+                _framesOut.inc()
+                _bytesOut.inc(size)
+                _writeToAck.observe(time.perf_counter() - queuedAt)
+                self._output(self.OUTPUT_WRITE_SUCCESS, \
+                             {'messageID': messageID, \
+                              'deviceID': connection.deviceID})
+        writing = bool(outbox)
+        if writing != connection.writing:
+            connection.writing = writing
+            self._selector.modify(connection.sock, selectors.EVENT_READ \
+                | (selectors.EVENT_WRITE if writing else 0), connection)
+
+    def _close(self, connection, e, comment):
+        """Forgets a connection, failing whatever it had left to send.
+        e is None when it was closed on purpose."""
+        del self._connections[connection.deviceID]
+        if self._lastHeard == connection.deviceID:
+            self._lastHeard = None
+        try:
+            self._selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            connection.sock.close()
+        except Exception as error:
+            self._outputError(error, "Failed to close remote socket")
+        for _, messageID, _, _ in connection.outbox:
+            self._outputWriteFailed(messageID, connection.deviceID, e, \
+                                    "Connection closed")
+        connection.outbox.clear()
+        if not self._connections:
+            self.state = self.STATE_NONE if self._mySock is None \
+                else self.STATE_CONNECTING
+        log.info("Device %d gone: %s", connection.deviceID, comment)
+        if e is None:
+            self._output(self.OUTPUT_DISCONNECTED, \
+                         {'comment': comment, \
+                          'deviceID': connection.deviceID})
+        else:
+            self._output(self.OUTPUT_CONNECTION_LOST, \
+                         {'comment': comment, 'error': e, \
+                          'deviceID': connection.deviceID})
+
+class _Connection():
+    """One connected device of a MultiplexService"""
+    __slots__ = ('deviceID', 'sock', 'remoteInfo', 'reader', 'outbox', \
+                 'writing')
+
+    def __init__(self, deviceID, sock, remoteInfo):
+        self.deviceID = deviceID
+        self.sock = sock
+        self.remoteInfo = remoteInfo
+        self.reader = FrameReader()
+        # [views, messageID, queuedAt, size] of every frame not yet sent
+        self.outbox = deque()
+        self.writing = False # registered for EVENT_WRITE
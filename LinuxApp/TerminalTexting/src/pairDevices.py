@@ -4,39 +4,312 @@ Created on Jan 16, 2019
 @author: jj
 '''
 
+from threading import Event, Lock, Thread
+import logging
+import os
+import re
 import subprocess
+import time
 
-def pair(macAddress):
-    subprocess.call(["bluetoothctl","power","on"])
-    subprocess.call(["bluetoothctl","discoverable","on"])
-    process = subprocess.Popen(["bluetoothctl", "devices"], \
-                               stdout=subprocess.PIPE)
-    pairedDevices = str(process.communicate())
-    if(pairedDevices.find(macAddress) == -1):
-        import signal
-        def handler(signum, frame):
-            print("Signal Timeout")
-            raise IOError("Couldn't find the device!")
-
-        def bluetoothScan():
-            proc = subprocess.Popen(["bluetoothctl","scan","on"], \
-                                    stdout=subprocess.PIPE)
-            while proc.poll() is None:
-                output = proc.stdout.readline()
-                if(output.find(macAddress) != -1):
-                    proc.terminate()
-                    signal.alarm(0)
-
-        signal.signal(signal.SIGALRM, handler)
-        signal.alarm(15)
+log = logging.getLogger(__name__)
 
+# Colours, cursor movement and prompts bluetoothctl writes around its
+# output even when it is not talking to a terminal
+_ESCAPES = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|\x01|\x02')
+_PROMPT = re.compile(r'^(\[[^\]]*\](# |> ))+')
+# Ends every command that is waiting, whatever it expects
+_NO_CONTROLLER = re.compile(r'No default controller available')
+_DEVICE = re.compile(r'^Device ((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}) ?(.*)$')
+
+class BluetoothCtl():
+    '''One long lived bluetoothctl session
+
+    Commands are written to bluetoothctl as soon as they are sent and
+    its output is read by a thread of its own. Every command waits for
+    the line that says it worked, or failed, so several commands can be
+    in flight at once and any thread can send them. A line goes to the
+    oldest command that is waiting for it.
+
+    path is the program to run, TERMINAL_TEXTING_BLUETOOTHCTL when it
+    is set, so a script that answers like bluetoothctl can stand in
+    for it.
+
+    Public Constants:
+    TIMEOUT - seconds a command waits for its answer by default
+
+    Public Methods:
+    send(String command, String expect, String fail)
+    command(String command, String expect, String fail, float timeout)
+    waitFor(String pattern, float timeout)
+    devices(float timeout)
+    setPower(bool on)
+    setDiscoverable(bool on)
+    scanFor(String macAddress, float timeout)
+    pair(String macAddress)
+    trust(String macAddress)
+    close()
+    '''
+
+    TIMEOUT = 10
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get("TERMINAL_TEXTING_BLUETOOTHCTL", \
+                                  "bluetoothctl")
+        self._lock = Lock()
+        self._waiters = []
+        self._listeners = []
+        self._closed = False
+        try:
+            self._process = subprocess.Popen([path], stdin=subprocess.PIPE, \
+                                             stdout=subprocess.PIPE, \
+                                             stderr=subprocess.STDOUT, \
+                                             text=True, bufsize=1)
+        except OSError as e:
+            raise BluetoothCtlError(f"Could not start {path}") from e
+        self._reader = Thread(target=self._read, name="bluetoothctl", \
+                              daemon=True)
+        self._reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, command, expect=None, fail=None):
+        """Writes command and returns a Reply for the line that matches
+        the regular expression expect, or fail
+
+        Does not wait, so commands can be pipelined. Without expect
+        nothing is waited for and None is returned.
+        """
+        reply = None
+        with self._lock:
+            if self._closed:
+                raise BluetoothCtlError("bluetoothctl is not running")
+            if expect is not None:
+                reply = Reply(command, expect, fail)
+                self._waiters.append(reply)
+            try:
+                self._process.stdin.write(command + "\n")
+                self._process.stdin.flush()
+            except (OSError, ValueError) as e:
+                if reply is not None:
+                    self._waiters.remove(reply)
+                raise BluetoothCtlError("bluetoothctl is not running") from e
+        log.debug("bluetoothctl < %s", command)
+        return reply
+
+    def command(self, command, expect, fail=None, timeout=TIMEOUT):
+        """Sends command and returns the line that matches expect"""
+        return self.send(command, expect, fail).result(timeout)
+
+    def waitFor(self, pattern, timeout=TIMEOUT):
+        """Returns the next line that matches pattern, without sending
+        anything"""
+        reply = Reply(None, pattern)
+        with self._lock:
+            if self._closed:
+                raise BluetoothCtlError("bluetoothctl is not running")
+            self._waiters.append(reply)
+        return reply.result(timeout)
+
+    def devices(self, timeout=TIMEOUT):
+        """Returns a dict of address to name of the devices bluetoothctl
+        knows about"""
+        found = {}
+        def listener(line):
+            match = _DEVICE.match(line)
+            if match:
+                found[match.group(1).upper()] = match.group(2)
+        with self._lock:
+            self._listeners.append(listener)
+        try:
+            self.send("devices")
+            # devices has no last line of its own, the answer to version
+            # comes after all of them
+            self.command("version", r'^Version ', timeout=timeout)
+        finally:
+            with self._lock:
+                self._listeners.remove(listener)
+        return found
+
+    def setPower(self, on=True):
+        state = "on" if on else "off"
+        return self.send(f"power {state}", \
+                         f'Changing power {state} succeeded', \
+                         f'Failed to set power {state}')
+
+    def setDiscoverable(self, on=True):
+        state = "on" if on else "off"
+        return self.send(f"discoverable {state}", \
+                         f'Changing discoverable {state} succeeded', \
+                         f'Failed to set discoverable {state}')
+
+    def scanFor(self, macAddress, timeout=TIMEOUT):
+        """Scans until macAddress is found, returns False if it was not
+        found within timeout"""
+        found = self.send("scan on", re.escape(macAddress.upper()), \
+                          r'Failed to start discovery')
+        try:
+            found.result(timeout)
+            return True
+        except BluetoothCtlTimeout:
+            return False
+        finally:
+            found.cancel()
+            try:
+                self.send("scan off")
+            except BluetoothCtlError:
+                pass
+
+    def pair(self, macAddress):
+        # Pairing a device twice is not a failure
+        return self.send(f"pair {macAddress}", \
+                         r'Pairing successful|AlreadyExists', \
+                         r'Failed to pair|not available')
+
+    def trust(self, macAddress):
+        return self.send(f"trust {macAddress}", \
+                         r'trust succeeded', \
+                         r'Failed to set trust|not available')
+
+    def close(self, timeout=2):
+        """Ends the session, commands still waiting fail"""
+        with self._lock:
+            self._closed = True
+            try:
+                self._process.stdin.write("quit\n")
+                self._process.stdin.close()
+            except (OSError, ValueError):
+                pass # Already gone
         try:
-            bluetoothScan()
-        except IOError:
-            return 0 # Could not find device
-
-        subprocess.call(["bluetoothctl","pair",macAddress])
-        subprocess.call(["bluetoothctl","trust",macAddress]) 
-    
-    subprocess.call(["bluetoothctl","discoverable","off"])
+            self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._reader.join(timeout)
+
+    def _read(self):
+        for line in self._process.stdout:
+            # A prompt is redrawn with a carriage return before the line
+            line = _ESCAPES.sub('', line.rstrip('\n')).split('\r')[-1]
+            line = _PROMPT.sub('', line).strip()
+            if not line:
+                continue
+            log.debug("bluetoothctl > %s", line)
+            with self._lock:
+                for listener in self._listeners:
+                    listener(line)
+                if _NO_CONTROLLER.search(line):
+                    waiting, self._waiters = self._waiters, []
+                    for reply in waiting:
+                        reply._finish(line, False)
+                    continue
+                self._waiters = [reply for reply in self._waiters \
+                                 if not reply._canceled]
+                for reply in self._waiters:
+                    matched = reply._match(line)
+                    if matched is not None:
+                        self._waiters.remove(reply)
+                        reply._finish(line, matched)
+                        break
+        with self._lock:
+            self._closed = True
+            waiting, self._waiters = self._waiters, []
+        for reply in waiting:
+            reply._finish(None, False)
+        self._process.stdout.close()
+
+class Reply():
+    '''The answer to a command sent to bluetoothctl
+
+    Public Methods:
+    result(float timeout)
+    cancel()
+    '''
+
+    def __init__(self, command, expect, fail=None):
+        self.command = command
+        self._expect = re.compile(expect)
+        self._fail = re.compile(fail) if fail else None
+        self._done = Event()
+        self._line = None
+        self._succeeded = False
+        self._canceled = False
+
+    def result(self, timeout=BluetoothCtl.TIMEOUT):
+        """Waits for the answer and returns its line
+
+        Raises BluetoothCtlTimeout if none came within timeout and
+        BluetoothCtlError if the command failed.
+        """
+        if not self._done.wait(timeout):
+            self.cancel()
+            raise BluetoothCtlTimeout(f"No answer to {self.command} " \
+                                      f"within {timeout}s")
+        if not self._succeeded:
+            if self._line is None:
+                raise BluetoothCtlError(f"bluetoothctl ended during " \
+                                        f"{self.command}")
+            raise BluetoothCtlError(self._line)
+        return self._line
+
+    def cancel(self):
+        """Stops waiting, a line that comes later is left for others"""
+        self._canceled = True
+
+    def _match(self, line):
+        """Returns True or False if line answers this command, None if
+        it does not"""
+        if self._fail is not None and self._fail.search(line):
+            return False
+        if self._expect.search(line):
+            return True
+        return None
+
+    def _finish(self, line, succeeded):
+        self._line = line
+        self._succeeded = succeeded
+        self._done.set()
+
+def pair(macAddress, timeout=15, path=None):
+    """Makes sure macAddress is paired and trusted, returns 1 if it is
+    and 0 if the device could not be found or paired
+
+    Uses one bluetoothctl session for all of it.
+    """
+    start = time.monotonic()
+    macAddress = macAddress.upper()
+    try:
+        with BluetoothCtl(path) as ctl:
+            power = ctl.setPower(True)
+            discoverable = ctl.setDiscoverable(True)
+            known = ctl.devices()
+            power.result()
+            discoverable.result()
+            try:
+                if macAddress not in known:
+                    if not ctl.scanFor(macAddress, timeout):
+                        log.warning("Could not find %s", macAddress)
+                        return 0 # Could not find device
+                    paired = ctl.pair(macAddress)
+                    trusted = ctl.trust(macAddress)
+                    paired.result(timeout)
+                    trusted.result()
+            finally:
+                ctl.setDiscoverable(False).result()
+    except BluetoothCtlError:
+        log.exception("Could not pair with %s", macAddress)
+        return 0
+    log.info("Paired with %s in %.2fs", macAddress, time.monotonic() - start)
     return 1 # Found and paired with the device
+
+class BluetoothCtlError(Exception):
+    """Raised when bluetoothctl fails a command or is not running"""
+    pass
+
+class BluetoothCtlTimeout(BluetoothCtlError):
+    """Raised when bluetoothctl does not answer a command in time"""
+    pass
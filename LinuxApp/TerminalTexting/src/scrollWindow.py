@@ -2,41 +2,222 @@
 @author: jj
 '''
 
+import curses
+from src import lineWrap
+
+DEFAULT_MAX_LINES = 100000
+
 class ScrollWindow():
-    '''Contains a curses window and methods to print to it.'''
+    '''Contains a curses window and methods to print to it.
+
+    Entries are kept in a LineRing and their display lines in another,
+    as (entry, line number) pairs, so everything printed can be paged
+    back through. Only the lines that are visible are drawn, so
+    redrawing costs one screen's worth of cells however long the history
+    is. Once a ring is full the oldest entries and lines are dropped.
+
+    Each entry wraps itself with lineWrap and caches the result per
+    width. After resize() only the newest entries are wrapped straight
+    away, older ones are wrapped as they are scrolled to.
+
+    While scrolled back, new entries do not move the view. Going to the
+    end resumes following new entries.
 
-    def __init__(self, win):
+    Changes are only drawn when noutrefresh() is called, so any number
+    of entries can be added for the cost of a single redraw. As with a
+    curses window, curses.doupdate() puts them on the terminal.
+    '''
+
+    def __init__(self, win, maxLines=DEFAULT_MAX_LINES):
         self.win = win
-        win.scrollok(True)
+        win.scrollok(False)
+        win.idlok(True)
         self.__maxY, self.__maxX = win.getmaxyx()
+        self._entries = LineRing(maxLines)
+        self._lines = LineRing(maxLines)
+        self._unwrapped = 0 # oldest entries without lines for this width
+        self._offset = 0 # lines scrolled back from the bottom
+        self._dirty = False
         self.win.refresh()
-        
+
     def addEntry(self, title, titleColor, message):
-        """Scrolls all text up and inserts a new enrty to the bottom
-        
+        """Adds a new entry below the others and shows it
+
         title - String containing the text to be printed as the title
         titleColor - curses colorPair object for the title String
         message - String for the base message
         """
-        self._printTitleLine(title, titleColor)
-        self._println(message)
-        self.win.refresh()
-    
-    def _printTitleLine(self, title, titleColor):
-        self.win.move(self.__maxY - 1, 1) # Move to start of last line
-        self.win.scroll()
-        self.win.addstr(title, titleColor)
-        
-    def _println(self, text):
-        lineLengthRemaining = self.__maxX - 4
-        
-        self.win.move(self.__maxY - 1, 1) # Move to start of last line
-        self.win.scroll()
-        
-        if len(text) <= lineLengthRemaining:
-            self.win.addstr(text)
-        else: # break the string up into printable sections
-            tmp = text[:lineLengthRemaining]
-            text = text[lineLengthRemaining:-1]
-            self.win.addstr(tmp)
-            self._println(text)
\ No newline at end of file
+        entry = _Entry(title, titleColor, message)
+        if len(self._entries) == self._entries.capacity and self._unwrapped:
+            self._unwrapped -= 1
+        self._entries.append(entry)
+        added = entry.lineCount(self._lineLength())
+        for lineNumber in range(added):
+            self._lines.append((entry, lineNumber))
+        if self._offset:
+            # Keep showing the same lines while scrolled back
+            self._offset = min(self._offset + added, self._maxOffset())
+        self._dirty = True
+
+    def resize(self, lines, columns):
+        """Resizes the window and re-wraps what is about to be seen"""
+        self.win.resize(lines, columns)
+        self.__maxY, self.__maxX = lines, columns
+        self._lines.clear()
+        self._unwrapped = len(self._entries)
+        self._offset = 0
+        self._wrapOlder(2 * self.__maxY)
+        self._dirty = True
+
+    def noutrefresh(self):
+        """Draws the visible lines if anything changed since last time"""
+        if self._dirty:
+            self._dirty = False
+            self._render()
+            self.win.noutrefresh()
+
+    def touch(self):
+        """Redraw everything on the next noutrefresh(), e.g. after
+        another window covered this one"""
+        self._dirty = True
+
+    def pageUp(self):
+        self._scrollTo(self._offset + self.__maxY - 1)
+
+    def pageDown(self):
+        self._scrollTo(self._offset - (self.__maxY - 1))
+
+    def home(self):
+        self._wrapOlder(self._lines.capacity)
+        self._scrollTo(self._maxOffset())
+
+    def end(self):
+        self._scrollTo(0)
+
+    def scrollKey(self, ch):
+        """Handles a navigation keystroke, returns False for other keys"""
+        action = {curses.KEY_PPAGE: self.pageUp,
+                  curses.KEY_NPAGE: self.pageDown,
+                  curses.KEY_HOME: self.home,
+                  curses.KEY_END: self.end}.get(ch)
+        if action is None:
+            return False
+        action()
+        return True
+
+    def _scrollTo(self, offset):
+        # Make sure there is a page of lines above the new view
+        self._wrapOlder(offset + 2 * self.__maxY - len(self._lines))
+        offset = max(0, min(offset, self._maxOffset()))
+        if offset != self._offset:
+            self._offset = offset
+            self._dirty = True
+
+    def _maxOffset(self):
+        return max(0, len(self._lines) - self.__maxY)
+
+    def _lineLength(self):
+        return self.__maxX - 4
+
+    def _wrapOlder(self, needed):
+        """Adds the lines of older entries in front of the others until
+        needed more lines have been added or every entry is wrapped"""
+        width = self._lineLength()
+        while needed > 0 and self._unwrapped:
+            self._unwrapped -= 1
+            entry = self._entries[self._unwrapped]
+            count = entry.lineCount(width)
+            for lineNumber in range(count - 1, -1, -1):
+                if not self._lines.appendleft((entry, lineNumber)):
+                    self._unwrapped = 0 # No room for anything older
+                    return
+            needed -= count
+
+    def _render(self):
+        """Draws the visible slice of the lines"""
+        self.win.erase()
+        width = self._lineLength()
+        bottom = len(self._lines) - self._offset
+        top = max(0, bottom - self.__maxY)
+        row = self.__maxY - (bottom - top)
+        for i in range(top, bottom):
+            entry, lineNumber = self._lines[i]
+            text, attr = entry.line(lineNumber, width)
+            try:
+                self.win.addstr(row, 1, text, attr)
+            except curses.error:
+                pass # Text ran past the edge of the window
+            row += 1
+
+class _Entry():
+    """One title and message, with its line breaks cached per width"""
+    __slots__ = ('title', 'titleColor', 'message', '_layouts')
+
+    def __init__(self, title, titleColor, message):
+        self.title = title
+        self.titleColor = titleColor
+        self.message = message
+        self._layouts = {}
+
+    def lineCount(self, width):
+        """Title line plus however many lines the message wraps to"""
+        return 1 + len(self._layout(width))
+
+    def line(self, lineNumber, width):
+        """Returns the (text, attr) of a display line"""
+        if lineNumber == 0:
+            return lineWrap.clip(self.title, width), self.titleColor
+        start, end = self._layout(width)[lineNumber - 1]
+        return self.message[start:end], curses.A_NORMAL
+
+    def _layout(self, width):
+        layout = self._layouts.get(width)
+        if layout is None:
+            if len(self._layouts) > 2:
+                self._layouts.clear()
+            layout = lineWrap.wrap(self.message, width)
+            self._layouts[width] = layout
+        return layout
+
+class LineRing():
+    '''Fixed capacity list, index 0 is the oldest item
+
+    Appending to a full ring drops the oldest item. Indexing is
+    constant time.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError("LineRing index out of range")
+        return self._items[(self._start + index) % self.capacity]
+
+    def append(self, item):
+        end = (self._start + self._count) % self.capacity
+        self._items[end] = item
+        if self._count == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._count += 1
+
+    def appendleft(self, item):
+        """Adds an item before the oldest, returns False when full"""
+        if self._count == self.capacity:
+            return False
+        self._start = (self._start - 1) % self.capacity
+        self._items[self._start] = item
+        self._count += 1
+        return True
+
+    def clear(self):
+        self._items = [None] * self.capacity
+        self._start = 0
+        self._count = 0
@@ -0,0 +1,147 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import struct
+
+# A SPECIAL frame is the SPECIAL type byte (0), an operation byte and
+# the operation's fields. Both ends ignore operations they don't know.
+SPECIAL = 0
+
+# Operations
+HELLO = 1 # version, features. Sent by the terminal when it connects,
+          # answered by phones that understand special frames.
+ACK = 2 # sequence. Every frame up to sequence has been received.
+SMS_RESULT = 3 # sequence, result. The phone tried to send the SMS of
+               # frame sequence, result 0 is success.
+SYNC_REQUEST = 4 # syncID, since, credit, phoneNumber. Asks the phone for
+                 # the messages after its message id since, of one
+                 # conversation or of every one when phoneNumber is empty.
+SYNC_PAGE = 5 # syncID, count, then count history records
+SYNC_END = 6 # syncID, watermark, result. No more pages, watermark is the
+             # id of the last message sent and result 0 means complete.
+SYNC_CREDIT = 7 # syncID, pages. The phone may send that many more pages.
+TRANSFER_STATUS = 8 # count, then count (transferID, nextChunk). Transfers
+                    # the terminal has part of, the phone carries on with
+                    # each from nextChunk. Sent on every connection, after
+                    # which transfers cut off by the last one that are not
+                    # listed start over, and for a chunk that was no use.
+MESSAGE_ACK = 9 # messageID. Every IDENTIFIED frame up to the one of
+                # messageID has been received, it may have been on an
+                # earlier connection. Sent in place of ACK for them.
+MESSAGE_RESULT = 10 # messageID, result. As SMS_RESULT for an IDENTIFIED
+                    # frame. The phone holds a result that could not be
+                    # sent until the next connection says HELLO.
+
+# Bits of the HELLO features
+FEATURE_ACKS = 1
+FEATURE_ZLIB = 2 # COMPRESSED frames, see compression.py
+FEATURE_SYNC = 4 # SYNC_REQUEST is answered
+FEATURE_CHUNKS = 8 # CHUNK frames are understood, see transfer.py
+FEATURE_IDS = 16 # IDENTIFIED frames are understood
+
+# An IDENTIFIED frame is this type byte, the 8 byte id of a message and
+# the frame the message would otherwise be sent as. A message keeps its
+# id when it is sent again on a later connection, so the phone can tell
+# it already has it and does not send the SMS twice. Ids are only
+# unique to one run of the terminal, the top 32 bits are drawn at random
+# for each.
+IDENTIFIED = 251
+MESSAGE_ID = struct.Struct('>Q')
+
+PROTOCOL_VERSION = 1
+
+# Sequence numbers count the frames the terminal sends on a connection,
+# starting at 1 and leaving out special frames. They only tell messages
+# apart on one connection, so once both HELLOs have FEATURE_IDS messages
+# are acknowledged and their results reported by messageID instead.
+_LAYOUTS = {
+    HELLO: struct.Struct('>BBBI'),
+    ACK: struct.Struct('>BBI'),
+    SMS_RESULT: struct.Struct('>BBIB'),
+    SYNC_REQUEST: struct.Struct('>BBIQH12s'),
+    SYNC_PAGE: struct.Struct('>BBIH'),
+    SYNC_END: struct.Struct('>BBIQB'),
+    SYNC_CREDIT: struct.Struct('>BBIH'),
+    TRANSFER_STATUS: struct.Struct('>BBH'),
+    MESSAGE_ACK: struct.Struct('>BBQ'),
+    MESSAGE_RESULT: struct.Struct('>BBQB'),
+    }
+
+# Every record of a SYNC_PAGE starts with the phone's id of the message,
+# its time in milliseconds and its direction (0 received, 1 sent),
+# followed by the body of a text message.
+RECORD_HEADER = struct.Struct('>QqB')
+PAGE_HEADER_SIZE = _LAYOUTS[SYNC_PAGE].size
+
+# Every entry of a TRANSFER_STATUS
+TRANSFER_ENTRY = struct.Struct('>II')
+STATUS_HEADER_SIZE = _LAYOUTS[TRANSFER_STATUS].size
+
+def hello(features):
+    return _LAYOUTS[HELLO].pack(SPECIAL, HELLO, PROTOCOL_VERSION, features)
+
+def ack(sequence):
+    return _LAYOUTS[ACK].pack(SPECIAL, ACK, sequence)
+
+def smsResult(sequence, result):
+    return _LAYOUTS[SMS_RESULT].pack(SPECIAL, SMS_RESULT, sequence, result)
+
+def messageAck(messageID):
+    return _LAYOUTS[MESSAGE_ACK].pack(SPECIAL, MESSAGE_ACK, messageID)
+
+def messageResult(messageID, result):
+    return _LAYOUTS[MESSAGE_RESULT].pack(SPECIAL, MESSAGE_RESULT, messageID, \
+                                         result)
+
+def syncRequest(syncID, since, credit, phoneNumber=None):
+    number = phoneNumber.encode() if phoneNumber else b''
+    return _LAYOUTS[SYNC_REQUEST].pack(SPECIAL, SYNC_REQUEST, syncID, since, \
+                                       credit, number)
+
+def syncCredit(syncID, pages):
+    return _LAYOUTS[SYNC_CREDIT].pack(SPECIAL, SYNC_CREDIT, syncID, pages)
+
+def syncPage(syncID, records):
+    """records is a list of encoded history records"""
+    return _LAYOUTS[SYNC_PAGE].pack(SPECIAL, SYNC_PAGE, syncID, \
+                                    len(records)) + b''.join(records)
+
+def syncEnd(syncID, watermark, result):
+    return _LAYOUTS[SYNC_END].pack(SPECIAL, SYNC_END, syncID, watermark, \
+                                   result)
+
+def transferStatus(pending):
+    """pending is a list of (transferID, nextChunk)"""
+    return _LAYOUTS[TRANSFER_STATUS].pack(SPECIAL, TRANSFER_STATUS, \
+                                          len(pending)) \
+        + b''.join(TRANSFER_ENTRY.pack(*entry) for entry in pending)
+
+def identify(messageID, payload):
+    """Returns payload as an IDENTIFIED frame"""
+    return bytes((IDENTIFIED,)) + MESSAGE_ID.pack(messageID) + payload
+
+def decode(buffer):
+    """Returns (operation, fields) of a special frame
+
+    fields is a tuple of the operation's fields, or None for an
+    operation that is not known. Longer frames than expected are
+    accepted so that fields can be added later.
+    """
+    if len(buffer) < 2 or buffer[0] != SPECIAL:
+        raise SpecialFrameError("Not a special frame")
+    operation = buffer[1]
+    layout = _LAYOUTS.get(operation)
+    if layout is None:
+        return operation, None
+    try:
+        return operation, layout.unpack_from(buffer)[2:]
+    except struct.error as e:
+        raise SpecialFrameError(f"Special frame {operation} is truncated") \
+            from e
+
+class SpecialFrameError(Exception):
+    """Raised when a special frame can not be decoded"""
+    pass
@@ -0,0 +1,60 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import curses
+import time
+from src import lineWrap
+
+class StatsOverlay():
+    '''Box of statistics drawn over the top right of another window
+
+    lines is a function returning the lines of text to show. While the
+    overlay is visible it is redrawn from lines() at most once every
+    refreshTime seconds and put back on top of the window under it on
+    every noutrefresh().
+    '''
+
+    def __init__(self, parent, lines, refreshTime=0.5):
+        self.parent = parent
+        self.lines = lines
+        self.refreshTime = refreshTime
+        self.visible = False
+        self._win = None
+        self._drawn = 0
+
+    def toggle(self):
+        """Shows or hides the overlay, returns True if now visible"""
+        self.visible = not self.visible
+        self._drawn = 0
+        if not self.visible:
+            self._win = None
+        return self.visible
+
+    def noutrefresh(self):
+        if not self.visible:
+            return
+        now = time.monotonic()
+        if now - self._drawn >= self.refreshTime:
+            self._drawn = now
+            self._draw()
+        # The window under it may have been redrawn over it
+        self._win.touchwin()
+        self._win.noutrefresh()
+
+    def _draw(self):
+        text = self.lines() or ["(nothing yet)"]
+        (top, left) = self.parent.getbegyx()
+        (maxY, maxX) = self.parent.getmaxyx()
+        height = min(len(text) + 2, maxY)
+        width = min(max(lineWrap.textWidth(line) for line in text) + 4, maxX)
+        self._win = curses.newwin(height, width, top, left + maxX - width)
+        self._win.erase()
+        self._win.border()
+        for row, line in enumerate(text[:height - 2]):
+            try:
+                self._win.addstr(row + 1, 2, lineWrap.clip(line, width - 4))
+            except curses.error:
+                pass
@@ -16,6 +16,10 @@ class Tbox(curses.textpad.Textbox):
     3.  Overrides do_command(ch) so that the functionality of the ctrl
         keystrokes are changed and that the input collection and
         display printing can happen on seperate threads.
+    4.  clear() and do_command(ch) only stage their changes with
+        noutrefresh(). The displayThread flushes them.
+    5.  insertText(text) types a whole run of characters with a single
+        noutrefresh(), for pastes and fast typing.
     '''
     
     OUTPUT_GATHER = "gatherComplete"
@@ -29,7 +33,7 @@ class Tbox(curses.textpad.Textbox):
     def clear(self):
         self.win.clear()
         self.win.move(0,0)
-        self.win.refresh()
+        self.win.noutrefresh()
     
     def gather(self):
         """Extends the subclass' method"""
@@ -42,6 +46,19 @@ class Tbox(curses.textpad.Textbox):
     def getInput(self):
         """Returned a keystroke"""
         return self.win.getch()
+    
+    def insertText(self, text):
+        """Types every printable character of text at the cursor"""
+        self._update_max_yx()
+        for ch in text:
+            ch = ord(ch)
+            if not curses.ascii.isprint(ch):
+                continue
+            (y, x) = self.win.getyx()
+            if y >= self.maxy and x >= self.maxx:
+                break # The box is full
+            self._insert_printable_char(ch)
+        self.win.noutrefresh()
         
     def do_command(self, ch):
         """Overrides the subclass' method
@@ -83,7 +100,7 @@ class Tbox(curses.textpad.Textbox):
                 self.win.move(y-1, x)
                 if x > self._end_of_line(y-1):
                     self.win.move(y-1, self._end_of_line(y-1))
-        self.win.refresh()
+        self.win.noutrefresh()
         
         
         
@@ -2,23 +2,44 @@
 @author: jj
 '''
 
+from src import lineWrap
+
 class TextBar():
     '''A class for a single line of text window
     
     win - a curses window object
     colorPair - a curses colorPair object
+    
+    update() only stages the change with noutrefresh() and does nothing
+    when the text is the same as what is shown. Text that does not fit
+    the window is cut off.
     '''
 
 
     def __init__(self, win, colorPair):
         self.win = win
         self.pair = colorPair
+        self.text = None
         self.win.bkgd(' ', self.pair)
         self.win.refresh()
         
     def update(self, text):
+        if text == self.text:
+            return
+        self.text = text
         self.win.attron(self.pair)
         self.win.erase()
-        self.win.addstr(text)
+        # The last cell is left empty, curses fails to write to it
+        self.win.addstr(lineWrap.clip(text, self.win.getmaxyx()[1] - 1))
         self.win.attroff(self.pair)
-        self.win.refresh()
\ No newline at end of file
+        self.win.noutrefresh()
+        
+    def resize(self, columns):
+        """Resizes the window and cuts the text off again to fit"""
+        self.win.resize(1, columns)
+        text, self.text = self.text, None
+        if text is None:
+            self.win.erase()
+            self.win.noutrefresh()
+        else:
+            self.update(text)
\ No newline at end of file
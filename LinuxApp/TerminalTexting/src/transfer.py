@@ -0,0 +1,260 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from collections import OrderedDict
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+# A payload too large for one frame is sent as CHUNK frames. Every chunk
+# is this type byte, the id of the transfer, the chunk's index, the size
+# of the whole payload and the CRC-32 of the chunk's data, followed by
+# CHUNK_SIZE bytes of the payload (the last one may be shorter). The
+# payload put back together is handled like any frame, type byte and
+# all. Only sent to a terminal whose HELLO has FEATURE_CHUNKS.
+CHUNK = 253
+CHUNK_HEADER = struct.Struct('>BIIQI')
+CHUNK_SIZE = 16 * 1024
+
+# Largest payload accepted
+MAX_TRANSFER_SIZE = 64 << 20
+# Most transfers put together at once, the oldest is dropped for more
+MAX_TRANSFERS = 8
+
+# A file from the phone, such as the image of an MMS. The phone number,
+# contact name, file name and mime type come first, each string after
+# its 1 byte length, and the rest of the payload is the file. Only ever
+# large enough to come as a transfer.
+ATTACHMENT = 252
+_PHONE_NUMBER = struct.Struct('>12s')
+_STRING_LENGTH = struct.Struct('>B')
+
+def chunkCount(size):
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+def chunks(transferID, payload, start=0):
+    """Generator that yields the CHUNK frames of payload, from the chunk
+    with index start on"""
+    view = memoryview(payload)
+    size = len(view)
+    for index in range(start, chunkCount(size)):
+        data = view[index * CHUNK_SIZE : (index + 1) * CHUNK_SIZE]
+        yield CHUNK_HEADER.pack(CHUNK, transferID, index, size, \
+                                zlib.crc32(data)) + data
+
+def attachment(phoneNumber, contactName, name, mimeType, data):
+    """Returns the payload of an ATTACHMENT, to be sent as chunks"""
+    output = bytes((ATTACHMENT,)) + _PHONE_NUMBER.pack(phoneNumber.encode())
+    for text in (contactName, name, mimeType):
+        encoded = text.encode()[:255]
+        output += _STRING_LENGTH.pack(len(encoded)) + encoded
+    return output + data
+
+class Reassembler():
+    '''Puts CHUNK frames back together into their payloads
+
+    The chunks of a transfer are written to a temporary file as they
+    arrive, so no payload is ever held in memory whole. They have to
+    come in order, a chunk that was seen already is ignored. What was
+    received survives a lost connection, pending() tells the phone
+    where to carry on.
+
+    Public Methods:
+    add(buffer)
+    pending()
+    resumes()
+    close()
+    '''
+
+    def __init__(self, directory=None, maxSize=MAX_TRANSFER_SIZE, \
+                 maxTransfers=MAX_TRANSFERS):
+        """Constructor
+
+        directory - where the temporary files go, the system's default
+                    when None
+        """
+        self.directory = directory
+        self.maxSize = maxSize
+        self.maxTransfers = maxTransfers
+        self._transfers = OrderedDict() # transferID -> IncomingTransfer
+
+    def add(self, buffer):
+        """Writes the chunk of a CHUNK frame to its transfer
+
+        Returns the IncomingTransfer when it was the last chunk, None
+        otherwise. The caller has to close() the transfer. Raises
+        TransferError for a chunk that can not be used, the transfer
+        then waits for it to be sent again from where resumes() says.
+        """
+        view = memoryview(buffer)
+        try:
+            _, transferID, index, size, checksum = \
+                CHUNK_HEADER.unpack_from(view)
+        except struct.error as e:
+            raise TransferError("Chunk header is truncated") from e
+        if size == 0 or size > self.maxSize:
+            raise TransferError(f"Transfer {transferID} of {size} bytes " \
+                                f"is not accepted")
+        transfer = self._transfers.get(transferID)
+        if transfer is not None and transfer.size != size:
+            # The phone forgot it and used its id again
+            self._drop(transferID)
+            transfer = None
+        if transfer is None:
+            transfer = IncomingTransfer(transferID, size, self.directory)
+            self._transfers[transferID] = transfer
+            while len(self._transfers) > self.maxTransfers:
+                self._drop(next(iter(self._transfers)))
+        self._transfers.move_to_end(transferID)
+        if index < transfer.nextChunk:
+            return None
+        data = view[CHUNK_HEADER.size:]
+        # Whatever is wrong, the phone has to send it again
+        transfer.failed = True
+        if index > transfer.nextChunk:
+            raise TransferError(f"Transfer {transferID} skipped from " \
+                                f"chunk {transfer.nextChunk} to {index}")
+        expected = min(CHUNK_SIZE, size - index * CHUNK_SIZE)
+        if len(data) != expected:
+            raise TransferError(f"Chunk {index} of transfer {transferID} " \
+                                f"has {len(data)} bytes, not {expected}")
+        if zlib.crc32(data) != checksum:
+            raise TransferError(f"Chunk {index} of transfer {transferID} " \
+                                f"is corrupt")
+        transfer.failed = False
+        transfer._write(data)
+        if transfer.nextChunk < transfer.chunks:
+            return None
+        del self._transfers[transferID]
+        return transfer
+
+    def __len__(self):
+        return len(self._transfers)
+
+    def pending(self):
+        """Returns a list of (transferID, nextChunk) of every transfer
+        that is not complete, for a TRANSFER_STATUS"""
+        for transfer in self._transfers.values():
+            transfer.askedFrom = transfer.nextChunk
+        return [(transferID, transfer.nextChunk) \
+                for transferID, transfer in self._transfers.items()]
+
+    def resumes(self):
+        """Returns a list of (transferID, nextChunk) of the transfers
+        that failed since the phone was last told where they are at"""
+        resumes = []
+        for transferID, transfer in self._transfers.items():
+            if transfer.failed and transfer.askedFrom != transfer.nextChunk:
+                transfer.askedFrom = transfer.nextChunk
+                resumes.append((transferID, transfer.nextChunk))
+        return resumes
+
+    def close(self):
+        """Drops every transfer that is not complete"""
+        for transferID in list(self._transfers):
+            self._drop(transferID)
+
+    def _drop(self, transferID):
+        self._transfers.pop(transferID).close()
+
+class IncomingTransfer():
+    '''The temporary file a transfer is put together in
+
+    Public Methods:
+    payload()
+    saveAttachment(String directory)
+    close()
+    '''
+
+    def __init__(self, transferID, size, directory=None):
+        self.transferID = transferID
+        self.size = size
+        self.chunks = chunkCount(size)
+        self.nextChunk = 0
+        self.askedFrom = None # nextChunk the phone was last told
+        self.failed = False # the last chunk could not be used
+        self.startedAt = time.perf_counter()
+        # Never has a name, so nothing is left behind after a crash
+        self._file = tempfile.TemporaryFile(prefix='transfer-', \
+                                            dir=directory)
+        self._map = None
+
+    def payload(self):
+        """Returns a memoryview of the payload, mapped from the file
+
+        It is only valid until close(). Pages are read in as they are
+        used, so handing it on does not read the whole file.
+        """
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), self.size, \
+                                  access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def saveAttachment(self, directory):
+        """Writes the file of an ATTACHMENT payload into directory
+
+        Returns (phoneNumber, contactName, name, mimeType, path). The
+        file is written straight out of the mapping, a name that is
+        taken already gets a number.
+        """
+        with self.payload() as view:
+            if view[0] != ATTACHMENT:
+                raise TransferError("Not an attachment")
+            try:
+                (phoneNumber,) = _PHONE_NUMBER.unpack_from(view, 1)
+                offset = 1 + _PHONE_NUMBER.size
+                strings = []
+                for _ in range(3):
+                    (length,) = _STRING_LENGTH.unpack_from(view, offset)
+                    offset += _STRING_LENGTH.size
+                    if offset + length > len(view):
+                        raise struct.error("String runs past the end")
+                    strings.append(str(view[offset:offset + length], \
+                                       'utf-8', 'replace'))
+                    offset += length
+            except struct.error as e:
+                raise TransferError("Attachment header is truncated") \
+                    from e
+            contactName, name, mimeType = strings
+            os.makedirs(directory, exist_ok=True)
+            out, path = _createFile(directory, name)
+            with out:
+                out.write(view[offset:])
+        return str(phoneNumber, 'utf-8', 'replace').rstrip('\0'), \
+            contactName, name, mimeType, path
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _write(self, data):
+        os.pwrite(self._file.fileno(), data, self.nextChunk * CHUNK_SIZE)
+        self.nextChunk += 1
+
+def _createFile(directory, name):
+    """Opens a new file for name in directory, returns (file, path)"""
+    # Nothing from the phone decides where the file goes
+    name = os.path.basename(name.replace('\\', '/')).lstrip('.') \
+        or "attachment"
+    stem, extension = os.path.splitext(name)
+    for number in range(1000):
+        candidate = name if number == 0 else f"{stem}-{number}{extension}"
+        path = os.path.join(directory, candidate)
+        try:
+            return open(path, 'xb'), path
+        except FileExistsError:
+            continue
+    raise TransferError(f"Could not find a free name for {name}")
+
+class TransferError(Exception):
+    """Raised when a chunk or a transferred payload can not be used"""
+    pass
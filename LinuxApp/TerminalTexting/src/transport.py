@@ -0,0 +1,347 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import logging
+import os
+import select
+import socket
+from src import metrics
+from src.deviceCache import DeviceCache
+
+try:
+    import bluetooth
+except ImportError: # Only needed for the RFCOMM transport
+    bluetooth = None
+
+log = logging.getLogger(__name__)
+
+_channelHits = metrics.counter("bluetooth.cache.channel_hits")
+_channelMisses = metrics.counter("bluetooth.cache.channel_misses")
+_serviceLookups = metrics.counter("bluetooth.cache.sdp_lookups")
+
+class Transport():
+    '''How a BluetoothService opens its sockets
+
+    The service only ever needs a listening socket, a way to accept a
+    connection on it and a way to connect to a remote device. Every
+    socket handed back supports recv/recv_into, sendall and close.
+    remoteInfo is always an (address, channel) tuple.
+
+    Public Methods:
+    knownDevices()
+    discover()
+    listen(int backlog)
+    advertise(socket sock, String serviceName, String uuid)
+    accept(socket sock)
+    connect(String address, String serviceName, String uuid)
+    nativeSocket(socket sock)
+    '''
+
+    def knownDevices(self):
+        """Returns a list of (address, name) of devices found before,
+        without searching"""
+        return []
+
+    def discover(self, found=None, stop=None):
+        """Returns a list of (address, name) of reachable devices
+
+        found(address, name) is called for every device as soon as it
+        is found, and again if its name comes later. The search ends
+        early once stop() returns True.
+        """
+        return []
+
+    def listen(self, backlog=1):
+        """Returns a bound socket that is listening for connections
+
+        backlog is how many connections may wait to be accepted.
+        """
+        raise NotImplementedError()
+
+    def advertise(self, sock, serviceName, uuid):
+        """Makes the listening socket findable by remote devices"""
+        pass
+
+    def accept(self, sock):
+        """Blocks for a connection, returns (socket, remoteInfo)"""
+        remoteSock, remoteInfo = sock.accept()
+        return remoteSock, self._remoteInfo(remoteInfo)
+
+    def connect(self, address, serviceName, uuid):
+        """Connects to a listening service, returns (socket, remoteInfo)"""
+        raise NotImplementedError()
+
+    def nativeSocket(self, sock):
+        """Returns sock as a standard library socket, for asyncio and
+        selectors"""
+        return sock
+
+    def _remoteInfo(self, info):
+        if isinstance(info, tuple):
+            return (str(info[0]), info[1])
+        return (str(info), 0)
+
+class RfcommTransport(Transport):
+    '''Bluetooth RFCOMM through pybluez, advertised and found with SDP
+
+    With a DeviceCache, the devices found and the channel each one's
+    service was found on are remembered between runs. A connect to a
+    device with a known channel goes straight to it and only falls back
+    to the SDP search, which takes seconds, if that fails.
+    
+    discover() reports devices from the inquiry as they answer it. A
+    device's name is asked for on one of NAME_LOOKUPS threads while the
+    inquiry carries on, unless the cache already knows it.
+    '''
+    
+    # Inquiry length in units of 1.28s, as for hcitool
+    INQUIRY_DURATION = 8
+    NAME_LOOKUPS = 3
+    NAME_TIMEOUT = 10
+
+    def __init__(self, cache=None):
+        if bluetooth is None:
+            raise TransportError("pybluez is required for the RFCOMM " \
+                                 "transport")
+        self.cache = cache
+
+    def knownDevices(self):
+        if self.cache is None:
+            return []
+        return self.cache.devices()
+
+    def discover(self, found=None, stop=None):
+        found = found or (lambda address, name: None)
+        stop = stop or (lambda: False)
+        devices = {} # address -> name, in the order they were found
+        lock = Lock()
+        lookups = ThreadPoolExecutor(self.NAME_LOOKUPS, \
+                                     thread_name_prefix="nameLookup")
+        
+        def report(address, name):
+            # Late names of a stopped search are only cached
+            if not stop():
+                found(address, name)
+        
+        def lookupName(address):
+            try:
+                name = bluetooth.lookup_name(address, \
+                                             timeout=self.NAME_TIMEOUT)
+            except Exception as e:
+                log.info("Name lookup of %s failed: %s", address, e)
+                return
+            if not name:
+                return
+            with lock:
+                devices[address] = name
+            if self.cache is not None:
+                self.cache.seen(address, name)
+                if stop():
+                    # Too late for the save at the end of the search
+                    self.cache.save()
+            report(address, name)
+        
+        def onFound(address, deviceClass):
+            with lock:
+                if address in devices:
+                    return
+                name = self.cache.name(address) if self.cache else None
+                devices[address] = name
+            if self.cache is not None:
+                self.cache.seen(address, deviceClass=deviceClass)
+            report(address, name)
+            if name is None:
+                lookups.submit(lookupName, address)
+        
+        discoverer = _Discoverer(onFound)
+        # The adapter's own cache is kept, it only has devices it saw
+        # recently
+        discoverer.find_devices(lookup_names=False, \
+                                duration=self.INQUIRY_DURATION, \
+                                flush_cache=False)
+        stopped = False
+        try:
+            while not discoverer.done:
+                if stop():
+                    stopped = True
+                    discoverer.cancel_inquiry()
+                    break
+                readable, _, _ = select.select([discoverer], [], [], 0.1)
+                if readable:
+                    discoverer.process_event()
+        finally:
+            # Names still being looked up are not waited for when stopped
+            lookups.shutdown(wait=not stopped, cancel_futures=stopped)
+            if self.cache is not None:
+                self.cache.save()
+        with lock:
+            return list(devices.items())
+
+    def listen(self, backlog=1):
+        sock = bluetooth.BluetoothSocket()
+        sock.bind(("", bluetooth.PORT_ANY))
+        sock.listen(backlog)
+        return sock
+
+    def advertise(self, sock, serviceName, uuid):
+        bluetooth.advertise_service( \
+            sock=sock, \
+            name=serviceName, \
+            service_id=uuid, \
+            service_classes=[uuid, bluetooth.SERIAL_PORT_CLASS], \
+            profiles=[bluetooth.SERIAL_PORT_PROFILE] \
+            )
+
+    def connect(self, address, serviceName, uuid):
+        try:
+            return self._connectService(address, serviceName, uuid)
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+
+    def _connectService(self, address, serviceName, uuid):
+        channel = self.cache.channel(address) if self.cache else None
+        if channel is not None:
+            try:
+                sock = self._connect((address, channel))
+            except Exception as e:
+                # The phone's service moved or is not running
+                _channelMisses.inc()
+                log.info("Cached channel %d of %s failed: %s", channel, \
+                         address, e)
+                self.cache.forgetChannel(address)
+            else:
+                _channelHits.inc()
+                self.cache.seen(address)
+                return sock, (address, channel)
+        _serviceLookups.inc()
+        foundServices = bluetooth.find_service(serviceName, uuid, address)
+        if len(foundServices) == 0:
+            raise TransportError("Didn't find any matching broadcasts")
+        match = foundServices[0]
+        remoteInfo = (match['host'], match['port'])
+        sock = self._connect(remoteInfo)
+        if self.cache is not None:
+            self.cache.setChannel(address, match['port'])
+        return sock, remoteInfo
+
+    def _connect(self, remoteInfo):
+        sock = bluetooth.BluetoothSocket()
+        try:
+            sock.connect(remoteInfo)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def nativeSocket(self, sock):
+        # The descriptor is duplicated so the pybluez object can go
+        nativeSock = socket.fromfd(sock.fileno(), socket.AF_BLUETOOTH, \
+                                   socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.close()
+        return nativeSock
+
+if bluetooth is not None:
+    class _Discoverer(bluetooth.DeviceDiscoverer):
+        """Passes every device of an inquiry to onFound(address,
+        deviceClass) as it is reported"""
+        
+        def __init__(self, onFound):
+            bluetooth.DeviceDiscoverer.__init__(self)
+            self.onFound = onFound
+            self.done = False
+        
+        def pre_inquiry(self):
+            self.done = False
+        
+        def device_discovered(self, address, deviceClass, *rest):
+            # rest is the rssi and name, depending on the pybluez version
+            self.onFound(address, deviceClass)
+        
+        def inquiry_complete(self):
+            self.done = True
+
+class TcpTransport(Transport):
+    '''Plain TCP, e.g. to a phone reached through an adb forward'''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def listen(self, backlog=1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(backlog)
+        return sock
+
+    def accept(self, sock):
+        remoteSock, remoteInfo = Transport.accept(self, sock)
+        remoteSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return remoteSock, remoteInfo
+
+    def connect(self, address, serviceName, uuid):
+        remoteInfo = (address or self.host, self.port)
+        sock = socket.create_connection(remoteInfo)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, remoteInfo
+
+class UnixTransport(Transport):
+    '''UNIX domain stream socket for local testing and benchmarking'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def listen(self, backlog=1):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        return sock
+
+    def accept(self, sock):
+        remoteSock, _ = sock.accept()
+        return remoteSock, (self.path, 0)
+
+    def connect(self, address, serviceName, uuid):
+        path = address or self.path
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except Exception:
+            sock.close()
+            raise
+        return sock, (path, 0)
+
+def makeTransport(config, cachePath=None):
+    """Returns the Transport described by a configuration string
+
+    rfcomm                 - bluetooth (default)
+    tcp:<host>:<port>      - TCP
+    unix:<path>            - UNIX domain socket
+
+    cachePath is the file bluetooth devices are remembered in, none
+    are when it is None.
+    """
+    if not config or config == "rfcomm":
+        return RfcommTransport(DeviceCache(cachePath) if cachePath else None)
+    kind, _, rest = config.partition(":")
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        try:
+            return TcpTransport(host or "127.0.0.1", int(port))
+        except ValueError:
+            raise TransportError(f"Invalid TCP port in '{config}'")
+    elif kind == "unix" and rest:
+        return UnixTransport(rest)
+    raise TransportError(f"Unknown transport '{config}'")
+
+class TransportError(Exception):
+    """Raised when a transport can not be created or used"""
+    pass
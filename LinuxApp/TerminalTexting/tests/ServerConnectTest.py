@@ -1,16 +1,20 @@
 
 from src import bluetoothManager
+from queue import Queue
 import logging
 
 macAddress = "C0:EE:FB:27:43:16"
 UUID = "56abddf0-d4d2-45c7-9b2b-7837582d436f"
+SERVICE_NAME = "TerminalTexting"
 
 def main():
     logging.basicConfig(filename='log.log', filemode='w', level=logging.DEBUG)
     logging.info("Logging started")
-    btman = bluetoothManager.BluetoothManager(UUID)
+    outputQueue = Queue()
+    btman = bluetoothManager.BluetoothManager(UUID, SERVICE_NAME, outputQueue)
     btman.connectAsServer()
-    btman.stop()
+    logging.info(outputQueue.get())
+    btman.join()
     logging.info("Done")
 
 if __name__ == '__main__':
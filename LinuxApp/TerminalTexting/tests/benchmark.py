@@ -0,0 +1,686 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+
+Benchmarks for the message pipeline. Run from the tests directory:
+
+    python3 benchmark.py [--quick] [--output results.json]
+
+Results are written as JSON. Every timing section reports percentiles
+so runs can be compared between revisions.
+'''
+
+import argparse
+import curses
+import json
+import os
+import pty
+import resource
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from queue import Queue
+from threading import Thread
+
+from src import bluetoothManager, compression, events, specialFrame, \
+    transfer
+from src.bluetoothManager import BluetoothManager, HistoryRecord, \
+    TextMessage
+from src.displayThread import DisplayThread
+from src.eventBus import EventBus
+from src.events import Event
+from src.frameReader import FrameReader, packFrame
+from src.messageStore import MessageStore
+from src.scrollWindow import ScrollWindow
+from src.tbox import Tbox
+from src.textBar import TextBar
+from src.transport import UnixTransport
+
+PHONE_NUMBER = "+14165550100"
+UUID = "56abddf0-d4d2-45c7-9b2b-7837582d436f"
+SERVICE_NAME = "TerminalTextingBenchmark"
+
+# Character sets used to build messages
+ALPHABETS = {
+    'ascii': "the quick brown fox jumps over the lazy dog ",
+    'latin': "àéîõü ça déjà vu naïve façade ",
+    'cjk': "你好世界今天天气很好我们去公园吧",
+    'emoji': "😀🎉👍🏽❤️🚀 ",
+    }
+SIZES = (16, 160, 1600, 16000)
+
+def percentiles(samples):
+    """Summary of a list of durations in seconds, reported in µs"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {'count': len(ordered),
+            'mean_us': sum(ordered) / len(ordered) * 1e6,
+            'p50_us': pick(0.50) * 1e6,
+            'p90_us': pick(0.90) * 1e6,
+            'p99_us': pick(0.99) * 1e6,
+            'max_us': ordered[-1] * 1e6}
+
+def makeText(alphabet, size):
+    text = ALPHABETS[alphabet]
+    return (text * (size // len(text) + 1))[:size]
+
+#-------------------------------Codec------------------------------------------
+
+def benchCodec(iterations):
+    """Encode and decode throughput for every size and alphabet"""
+    results = []
+    for alphabet in ALPHABETS:
+        for size in SIZES:
+            text = makeText(alphabet, size)
+            frame = bluetoothManager.getBytes(PHONE_NUMBER, text)
+            count = max(10, iterations * 16 // size)
+            encodeTimes = []
+            for _ in range(count):
+                start = time.perf_counter()
+                bluetoothManager.getBytes(PHONE_NUMBER, text)
+                encodeTimes.append(time.perf_counter() - start)
+            decodeTimes = []
+            for _ in range(count):
+                start = time.perf_counter()
+                TextMessage.decode(frame, 1)
+                decodeTimes.append(time.perf_counter() - start)
+            buffer = packFrame(frame) * count
+            start = time.perf_counter()
+            decoded = sum(1 for _ in bluetoothManager.decodeMany(buffer))
+            elapsed = time.perf_counter() - start
+            results.append({'alphabet': alphabet,
+                            'characters': size,
+                            'frame_bytes': len(frame),
+                            'encode': percentiles(encodeTimes),
+                            'decode': percentiles(decodeTimes),
+                            'decode_many_msgs_per_s': decoded / elapsed,
+                            'decode_many_mb_per_s':
+                                len(buffer) / elapsed / 1e6})
+    return results
+
+#-------------------------------Compression------------------------------------
+
+# A typical conversation, for the sizes of real messages
+CONVERSATION = ("hey are you still coming to dinner tonight? ",
+                "running late, be there in 10 minutes ",
+                "sounds good, let me know what time works for you ",
+                "did you get my message about the meeting tomorrow? ",
+                "thanks so much! see you soon ")
+# Bytes per second of an RFCOMM link to an older phone
+LINK_RATE = 50000
+
+def benchCompression(iterations, linkRate=LINK_RATE):
+    """Bytes on the wire and the time to send a message over a link of
+    linkRate bytes per second, with and without compression. The time
+    with compression includes deflating and inflating it."""
+    results = []
+    alphabets = dict(ALPHABETS, sms="".join(CONVERSATION))
+    for alphabet, characters in alphabets.items():
+        for size in SIZES:
+            text = (characters * (size // len(characters) + 1))[:size]
+            payload = bluetoothManager.getBytes(PHONE_NUMBER, text)
+            frame = compression.deflate(payload)
+            count = max(10, iterations * 16 // size)
+            deflateTimes = []
+            for _ in range(count):
+                start = time.perf_counter()
+                compression.deflate(payload)
+                deflateTimes.append(time.perf_counter() - start)
+            inflateTimes = []
+            for _ in range(count if frame else 0):
+                start = time.perf_counter()
+                compression.inflate(frame)
+                inflateTimes.append(time.perf_counter() - start)
+            wireBytes = len(frame) if frame else len(payload)
+            plainTime = len(payload) / linkRate
+            # Deflating is paid even when it turns out not to pay
+            wireTime = wireBytes / linkRate \
+                + sum(deflateTimes) / count \
+                + (sum(inflateTimes) / count if frame else 0)
+            results.append({'alphabet': alphabet,
+                            'characters': size,
+                            'plain_bytes': len(payload),
+                            'wire_bytes': wireBytes,
+                            'compressed': frame is not None,
+                            'bytes_saved_percent':
+                                100 * (1 - wireBytes / len(payload)),
+                            'deflate': percentiles(deflateTimes),
+                            'inflate': percentiles(inflateTimes),
+                            'plain_ms': plainTime * 1e3,
+                            'wire_ms': wireTime * 1e3,
+                            'time_saved_percent':
+                                100 * (1 - wireTime / plainTime)})
+    return results
+
+#-------------------------------Event Bus--------------------------------------
+
+def benchEventBus(backlog, rounds=50):
+    """Time for a keystroke to be handled while a backlog of received
+    texts is waiting, as UserInterface drains the EventBus"""
+    bus = EventBus()
+    handled = {}
+    def consume():
+        while True:
+            for kind, args in bus.getBatch():
+                if kind == events.KEYBOARD_INPUT:
+                    handled[args] = time.perf_counter()
+                elif kind is None:
+                    return
+                else:
+                    time.sleep(0.00002) # Roughly what a text costs the UI
+    consumer = Thread(target=consume)
+    consumer.start()
+    text = Event(events.RECEIVED_TEXT_MESSAGE, {})
+    latency = []
+    for i in range(rounds):
+        for _ in range(backlog):
+            bus.put(text)
+        start = time.perf_counter()
+        bus.put(Event(events.KEYBOARD_INPUT, i))
+        _waitFor(handled, i)
+        latency.append(handled[i] - start)
+        while not bus.empty():
+            time.sleep(0.001)
+    bus.put((None, None))
+    consumer.join()
+    return {'backlog': backlog, 'key_latency': percentiles(latency)}
+
+#-------------------------------Send Window------------------------------------
+
+def benchSendWindow(count, latency, windows=(1, 8, 32)):
+    """Messages per second to a phone that acknowledges every frame
+    latency seconds after it arrives, for a few window sizes"""
+    results = {'latency_ms': latency * 1e3}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'window.sock')
+        for window in windows:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            outputQueue = Queue()
+            manager = BluetoothManager(UUID, SERVICE_NAME, outputQueue,
+                                       UnixTransport(path))
+            manager.SEND_WINDOW = window
+            manager.connectAsClient(path)
+            phone, _ = server.accept()
+            Thread(target=_ackingPhone, args=(phone, latency),
+                   daemon=True).start()
+            # The phone's HELLO turns acknowledgements on
+            while outputQueue.get(timeout=5).kind != events.NOTE:
+                pass
+            message = bluetoothManager.getBytes(PHONE_NUMBER, "window")
+            start = time.perf_counter()
+            for _ in range(count):
+                manager.write(message)
+            delivered = 0
+            while delivered < count:
+                event = outputQueue.get(timeout=30)
+                if event.kind == events.WRITE_SUCCESS:
+                    delivered += 1
+            results[f'window_{window}_msgs_per_s'] = \
+                count / (time.perf_counter() - start)
+            manager.join()
+            phone.close()
+            server.close()
+            os.unlink(path)
+    return results
+
+def _ackingPhone(sock, latency):
+    """Answers HELLO and acknowledges every text frame after a delay,
+    without holding up reading"""
+    reader = FrameReader()
+    sequence = 0
+    def send(payload):
+        try:
+            sock.sendall(packFrame(payload))
+        except OSError:
+            pass
+    while True:
+        try:
+            if reader.recvFrom(sock) == 0:
+                return
+        except OSError:
+            return
+        for frame in reader.frames():
+            if frame[0] == specialFrame.SPECIAL:
+                send(specialFrame.hello(specialFrame.FEATURE_ACKS))
+                continue
+            sequence += 1
+            threading.Timer(latency, send,
+                            (specialFrame.ack(sequence),)).start()
+
+#-------------------------------History Sync-----------------------------------
+
+def benchHistorySync(count, pageSize=200):
+    """Time to sync count messages from a phone into an empty store,
+    through compressed pages and credits as a real phone sends them"""
+    history = [HistoryRecord(i + 1, 1.7e9 + i * 60, i % 2,
+                             TextMessage(PHONE_NUMBER, "Contact",
+                                 CONVERSATION[i % len(CONVERSATION)])).encode()
+               for i in range(count)]
+    pages = [history[i:i + pageSize] for i in range(0, count, pageSize)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sync.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        store = MessageStore(os.path.join(directory, 'history.db'))
+        outputQueue = Queue()
+        manager = BluetoothManager(UUID, SERVICE_NAME, outputQueue,
+                                   UnixTransport(path))
+        manager.connectAsClient(path)
+        phone, _ = server.accept()
+        Thread(target=_historyPhone, args=(phone, pages),
+               daemon=True).start()
+        start = None
+        received = 0
+        while True:
+            event = outputQueue.get(timeout=30)
+            if event.kind == events.HISTORY_AVAILABLE:
+                start = time.perf_counter()
+                manager.syncHistory(store.watermark(''))
+            elif event.kind == events.HISTORY_PAGE:
+                received += len(event.args['records'])
+                store.addHistory(event.args['records'], '',
+                                 event.args['watermark'],
+                                 lambda syncID=event.args['syncID']:
+                                     manager.syncCredit(syncID))
+            elif event.kind == events.HISTORY_SYNCED:
+                break
+        store.flush()
+        elapsed = time.perf_counter() - start
+        manager.join()
+        store.join()
+        phone.close()
+        server.close()
+    return {'messages': received,
+            'pages': len(pages),
+            'seconds': elapsed,
+            'msgs_per_s': received / elapsed}
+
+def _historyPhone(sock, pages):
+    """Answers HELLO and streams pages of history for a SYNC_REQUEST,
+    no faster than credits come back"""
+    reader = FrameReader()
+    credit = threading.Semaphore(0)
+    def send(payload):
+        sock.sendall(packFrame(compression.deflate(payload) or payload))
+    def stream(syncID):
+        for page in pages:
+            credit.acquire()
+            send(specialFrame.syncPage(syncID, page))
+        # Message ids in the benchmark count up from 1
+        send(specialFrame.syncEnd(syncID, sum(map(len, pages)), 0))
+    while True:
+        try:
+            if reader.recvFrom(sock) == 0:
+                return
+        except OSError:
+            return
+        for frame in reader.frames():
+            operation, fields = specialFrame.decode(frame)
+            if operation == specialFrame.HELLO:
+                send(specialFrame.hello(specialFrame.FEATURE_ZLIB |
+                                        specialFrame.FEATURE_SYNC))
+            elif operation == specialFrame.SYNC_REQUEST:
+                for _ in range(fields[2]):
+                    credit.release()
+                Thread(target=stream, args=(fields[0],),
+                       daemon=True).start()
+            elif operation == specialFrame.SYNC_CREDIT:
+                for _ in range(fields[1]):
+                    credit.release()
+
+#-------------------------------Transfers--------------------------------------
+
+def benchTransfer(size, linkRate=2e6, texts=50):
+    """Time to receive an attachment of size bytes to disk over a link
+    of linkRate bytes per second, and how long texts the phone gets
+    during it wait behind its chunks"""
+    data = os.urandom(size)
+    payload = transfer.attachment(PHONE_NUMBER, "Contact", "image.jpg",
+                                  "image/jpeg", data)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'transfer.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        outputQueue = Queue()
+        manager = BluetoothManager(UUID, SERVICE_NAME, outputQueue,
+                                   UnixTransport(path),
+                                   os.path.join(directory, 'attachments'))
+        manager.connectAsClient(path)
+        phone, _ = server.accept()
+        start = time.perf_counter()
+        Thread(target=_transferPhone,
+               args=(phone, payload, linkRate, texts),
+               daemon=True).start()
+        latencies = []
+        elapsed = None
+        while elapsed is None or len(latencies) < texts:
+            event = outputQueue.get(timeout=60)
+            if event.kind == events.RECEIVED_TEXT_MESSAGE:
+                queuedAt = float(event.args['message'].message)
+                latencies.append(event.args['receivedAt'] - queuedAt)
+            elif event.kind == events.ATTACHMENT_RECEIVED:
+                elapsed = time.perf_counter() - start
+                with open(event.args['path'], 'rb') as saved:
+                    if saved.read() != data:
+                        raise RuntimeError("Attachment does not match")
+        manager.join()
+        phone.close()
+        server.close()
+    return {'bytes': size,
+            'chunks': transfer.chunkCount(len(payload)),
+            'link_rate': linkRate,
+            'seconds': elapsed,
+            'bytes_per_s': size / elapsed,
+            'chunk_time_ms': transfer.CHUNK_SIZE / linkRate * 1e3,
+            'text_wait': percentiles(latencies)}
+
+def _transferPhone(sock, payload, linkRate, texts):
+    """Answers HELLO and sends payload as a transfer, no faster than
+    linkRate. Texts come up all through it and go between its chunks,
+    as the phone's sender does it."""
+    reader = FrameReader()
+    while True:
+        reader.recvFrom(sock)
+        if any(specialFrame.decode(frame)[0] == specialFrame.HELLO
+               for frame in reader.frames()):
+            break
+    sock.sendall(packFrame(specialFrame.hello(specialFrame.FEATURE_CHUNKS)))
+    waiting = Queue()
+    def textsArrive():
+        interval = len(payload) / linkRate / texts
+        for _ in range(texts):
+            time.sleep(interval)
+            waiting.put(time.perf_counter())
+    def send(frame):
+        sock.sendall(frame)
+        time.sleep(len(frame) / linkRate)
+    Thread(target=textsArrive, daemon=True).start()
+    sent = 0
+    for chunk in transfer.chunks(1, payload):
+        send(packFrame(chunk))
+        while not waiting.empty():
+            send(_textFrame(0, repr(waiting.get())))
+            sent += 1
+    while sent < texts:
+        send(_textFrame(0, repr(waiting.get())))
+        sent += 1
+
+#-------------------------------Curses-----------------------------------------
+
+class _Screen():
+    """The same window layout as the application, without borders"""
+    def __init__(self, stdscr):
+        curses.start_color()
+        curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLACK)
+        curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_WHITE)
+        self.color = curses.color_pair(1)
+        (maxY, maxX) = stdscr.getmaxyx()
+        displayHeight = maxY - 6
+        self.dis = ScrollWindow(curses.newwin(displayHeight, maxX - 2, 1, 1))
+        self.info = TextBar(curses.newwin(1, maxX, displayHeight + 2, 0),
+                            self.color)
+        self.tbox = Tbox(curses.newwin(2, maxX - 2, displayHeight + 3, 1),
+                         Queue())
+        self.opt = TextBar(curses.newwin(1, maxX, maxY - 1, 0),
+                           curses.color_pair(2))
+
+def benchRender(stdscr, count):
+    """Cost of the individual window updates, each flushed on its own,
+    and of a burst of entries flushed as a single frame"""
+    screen = _Screen(stdscr)
+    results = {}
+    for alphabet in ('ascii', 'cjk'):
+        for size in (40, 400):
+            text = makeText(alphabet, size)
+            times = []
+            for i in range(count):
+                start = time.perf_counter()
+                screen.dis.addEntry(f"Contact {i}", screen.color, text)
+                screen.dis.noutrefresh()
+                curses.doupdate()
+                times.append(time.perf_counter() - start)
+            results[f'scroll_add_entry_{alphabet}_{size}'] = \
+                percentiles(times)
+    times = []
+    for _ in range(10):
+        start = time.perf_counter()
+        for i in range(200):
+            screen.dis.addEntry(f"Contact {i}", screen.color,
+                                makeText('ascii', 120))
+        screen.dis.noutrefresh()
+        curses.doupdate()
+        times.append(time.perf_counter() - start)
+    results['scroll_200_entries_one_frame'] = percentiles(times)
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        screen.info.update(f"Status {i}")
+        curses.doupdate()
+        times.append(time.perf_counter() - start)
+    results['text_bar_update'] = percentiles(times)
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        screen.tbox.do_command(ord('a') + i % 26)
+        curses.doupdate()
+        times.append(time.perf_counter() - start)
+    results['tbox_keystroke'] = percentiles(times)
+    times = []
+    paste = makeText('ascii', 1000)
+    for _ in range(20):
+        screen.tbox.clear()
+        start = time.perf_counter()
+        screen.tbox.insertText(paste)
+        curses.doupdate()
+        times.append(time.perf_counter() - start)
+    results['tbox_paste_1000'] = percentiles(times)
+    return results
+
+def benchEndToEnd(stdscr, count, socketPath, flood=10000):
+    """Latency from a frame arriving in _listen until the entry it
+    makes is flushed to the terminal
+
+    The frames go through the BluetoothManager, the shared inputQueue,
+    the DisplayThread and into the ScrollWindow, as in the application.
+    """
+    screen = _Screen(stdscr)
+    rendered = {}
+    added = []
+    addEntry = screen.dis.addEntry
+    def timedAddEntry(title, titleColor, message):
+        addEntry(title, titleColor, message)
+        added.append(int(title))
+    screen.dis.addEntry = timedAddEntry
+    doupdate = curses.doupdate
+    def timedDoupdate():
+        doupdate()
+        now = time.perf_counter()
+        while added:
+            rendered[added.pop()] = now
+    curses.doupdate = timedDoupdate
+
+    inputQueue = EventBus()
+    displayThread = DisplayThread(screen.dis, screen.info, screen.tbox,
+                                  screen.opt)
+    manager = BluetoothManager(UUID, SERVICE_NAME, inputQueue,
+                               UnixTransport(socketPath))
+    def dispatch():
+        # What UserInterface does for a received text
+        while True:
+            for outType, args in inputQueue.getBatch():
+                if outType == BluetoothManager.OUTPUT_RECEIVED_TEXT_MESSAGE:
+                    message = args['message']
+                    displayThread.printToDisplay(message.contactName,
+                                                 screen.color,
+                                                 message.message)
+                elif outType is None:
+                    return
+    dispatcher = Thread(target=dispatch)
+    dispatcher.start()
+    manager.connectAsServer()
+    phone = _connect(socketPath)
+
+    frames = [_textFrame(i, makeText('ascii', 120)) for i in range(count)]
+    sent = {}
+    # One at a time, to measure latency without queueing. The pause
+    # keeps each message out of the previous display frame.
+    for i, frame in enumerate(frames):
+        time.sleep(displayThread.frameTime)
+        sent[i] = time.perf_counter()
+        phone.sendall(frame)
+        _waitFor(rendered, i)
+    latency = [rendered[i] - sent[i] for i in range(count)]
+
+    # Everything at once, to measure throughput under a burst
+    rendered.clear()
+    start = time.perf_counter()
+    phone.sendall(b''.join(frames))
+    _waitFor(rendered, count - 1)
+    burst = time.perf_counter() - start
+
+    # A sustained flood, the queues should stay within their bounds
+    # and memory should not grow with the number of messages
+    rendered.clear()
+    text = makeText('ascii', 120)
+    floodFrames = b''.join(_textFrame(i, text) for i in range(flood))
+    rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    sender = Thread(target=phone.sendall, args=(floodFrames,))
+    sender.start()
+    _waitFor(rendered, flood - 1, timeout=120)
+    floodSeconds = time.perf_counter() - start
+    sender.join()
+    rssGrowth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rssBefore
+
+    phone.close()
+    inputQueue.put((None, None))
+    dispatcher.join()
+    manager.join()
+    displayThread.join()
+    return {'latency': percentiles(latency),
+            'burst_messages': count,
+            'burst_seconds': burst,
+            'burst_msgs_per_s': count / burst,
+            'flood_messages': flood,
+            'flood_msgs_per_s': flood / floodSeconds,
+            'flood_max_rss_growth_kb': rssGrowth,
+            'flood_event_bus_high_water': inputQueue.highWater,
+            'flood_display_queue_high_water':
+                displayThread.input.highWater}
+
+def _textFrame(index, text):
+    message = text.encode()
+    name = str(index).encode()
+    body = bytes((bluetoothManager.TEXT_MESSAGE,)) + PHONE_NUMBER.encode() \
+        + bytes((len(name),)) + name \
+        + len(message).to_bytes(4, 'big', signed=True) + message
+    return packFrame(body)
+
+def _connect(path):
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            return sock
+        except OSError:
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+def _waitFor(rendered, index, timeout=30):
+    deadline = time.monotonic() + timeout
+    while index not in rendered:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Message {index} was never rendered")
+        time.sleep(0.0001)
+
+def runInPty(func, *args, rows=40, columns=120):
+    """Runs func(stdscr, *args) under curses in a pseudo-terminal
+
+    Returns the function's result along with the number of bytes the
+    application wrote to the terminal.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.json') as resultFile:
+        pid, fd = pty.fork()
+        if pid == 0:
+            os.environ['TERM'] = 'xterm-256color'
+            os.environ['LINES'] = str(rows)
+            os.environ['COLUMNS'] = str(columns)
+            try:
+                result = curses.wrapper(func, *args)
+            except Exception:
+                result = {'error': traceback.format_exc()}
+            try:
+                with open(resultFile.name, 'w') as out:
+                    json.dump(result, out)
+            finally:
+                os._exit(0)
+        written = 0
+        while True:
+            ready, _, _ = select.select([fd], [], [], 1)
+            if ready:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError:
+                    break
+                if not data:
+                    break
+                written += len(data)
+            elif os.waitpid(pid, os.WNOHANG) != (0, 0):
+                break
+        os.close(fd)
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+        with open(resultFile.name) as result:
+            text = result.read()
+        if not text:
+            raise RuntimeError(f"{func.__name__} failed in the pty")
+        return {'result': json.loads(text), 'terminal_bytes': written}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', help="file to write the JSON to")
+    parser.add_argument('--quick', action='store_true',
+                        help="fewer iterations, for a smoke test")
+    args = parser.parse_args()
+    iterations = 200 if args.quick else 2000
+    results = {'python': sys.version.split()[0],
+               'timestamp': time.time(),
+               'codec': benchCodec(iterations),
+               'compression': benchCompression(iterations),
+               'event_bus': benchEventBus(10000, 20 if args.quick else 100),
+               'send_window': benchSendWindow(100 if args.quick else 1000,
+                                              0.01),
+               'history_sync': benchHistorySync(2000 if args.quick
+                                                else 50000),
+               'transfer': benchTransfer(1 << 20 if args.quick
+                                         else 8 << 20)}
+    results['render'] = runInPty(benchRender, iterations // 4)
+    with tempfile.TemporaryDirectory() as directory:
+        results['end_to_end'] = runInPty(benchEndToEnd, iterations // 4,
+                                         os.path.join(directory, 'bt.sock'))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
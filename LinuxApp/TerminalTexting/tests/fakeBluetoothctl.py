@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+'''
+Created on Oct 18, 2026
+
+@author: jj
+
+Stands in for bluetoothctl in the tests of src.pairDevices. Answers
+like bluetoothctl does, prompt and colours included, and is set up
+through the environment:
+
+FAKE_BLUETOOTHCTL_KNOWN - address=name,... of the devices it knows
+FAKE_BLUETOOTHCTL_FIND - address=name,... of the devices a scan finds
+FAKE_BLUETOOTHCTL_DELAY - seconds pair and info take to answer
+FAKE_BLUETOOTHCTL_SILENT - commands,... that are never answered
+FAKE_BLUETOOTHCTL_NO_CONTROLLER - set to answer every command with
+                                  "No default controller available"
+
+Commands are answered on threads of their own, so a slow one does not
+hold up the ones sent after it.
+'''
+
+from threading import Lock, Timer
+import os
+import sys
+
+PROMPT = "\x1b[0;94m[bluetooth]\x1b[0m# "
+NEW = "[\x1b[0;92mNEW\x1b[0m] "
+
+_lock = Lock()
+
+def say(line):
+    with _lock:
+        # bluetoothctl redraws its prompt in front of every line
+        sys.stdout.write("\r" + PROMPT + line + "\n")
+        sys.stdout.flush()
+
+def later(delay, *lines):
+    def sayAll():
+        for line in lines:
+            say(line)
+    Timer(delay, sayAll).start()
+
+def devices(name):
+    text = os.environ.get(name, "")
+    return dict(entry.split("=", 1) for entry in text.split(",") if entry)
+
+def main():
+    known = devices("FAKE_BLUETOOTHCTL_KNOWN")
+    find = devices("FAKE_BLUETOOTHCTL_FIND")
+    delay = float(os.environ.get("FAKE_BLUETOOTHCTL_DELAY", "0"))
+    silent = os.environ.get("FAKE_BLUETOOTHCTL_SILENT", "").split(",")
+    noController = bool(os.environ.get("FAKE_BLUETOOTHCTL_NO_CONTROLLER"))
+    say("Agent registered")
+    for line in sys.stdin:
+        command = line.split()
+        if not command:
+            continue
+        if command[0] in ("quit", "exit"):
+            break
+        if command[0] in silent:
+            continue
+        if noController:
+            say("No default controller available")
+        elif command[0] in ("power", "discoverable"):
+            say(f"Changing {command[0]} {command[1]} succeeded")
+        elif command[0] == "devices":
+            for address, name in known.items():
+                say(f"Device {address} {name}")
+        elif command[0] == "version":
+            say("Version 5.66")
+        elif command == ["scan", "on"]:
+            say("Discovery started")
+            later(0.1, *[f"{NEW}Device {address} {name}" \
+                         for address, name in find.items()])
+        elif command == ["scan", "off"]:
+            say("Discovery stopped")
+        elif command[0] == "pair":
+            address = command[1]
+            say(f"Attempting to pair with {address}")
+            if address in find or address in known:
+                later(delay, "Pairing successful")
+            else:
+                later(delay, f"Device {address} not available")
+        elif command[0] == "trust":
+            say(f"Changing {command[1]} trust succeeded")
+        elif command[0] == "info":
+            later(delay, f"Device {command[1]} (public)")
+        else:
+            say(f"Invalid command in menu main: {command[0]}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import asyncio
+import os
+import socket
+import tempfile
+import unittest
+from src import events
+from src.asyncBluetoothService import AsyncBluetoothService
+from src.bluetoothService import BluetoothWriteError
+from src.frameReader import FRAME_HEADER
+from src.transport import UnixTransport
+
+UUID = "56abddf0-d4d2-45c7-9b2b-7837582d436f"
+SERVICE_NAME = "TerminalTexting"
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class AsyncBluetoothServiceTest(unittest.IsolatedAsyncioTestCase):
+    '''Drives the service through a socket.socketpair()'''
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "service.sock")
+        self.outputQueue = asyncio.Queue()
+        self.service = AsyncBluetoothService(UUID, SERVICE_NAME, \
+                                             self.outputQueue, \
+                                             UnixTransport(self.path))
+
+    async def asyncTearDown(self):
+        self.service.close()
+        self.directory.cleanup()
+
+    async def nextOutput(self, kind):
+        """Returns the args of the next output of kind, skipping others"""
+        while True:
+            event = await asyncio.wait_for(self.outputQueue.get(), 5)
+            if event.kind == kind:
+                return event.args
+
+    def connectPair(self):
+        mine, remote = socket.socketpair()
+        self.addCleanup(remote.close)
+        self.service.connectWithSocket(mine, ("phone", 1))
+        return remote
+
+    async def testReceivesFrames(self):
+        remote = self.connectPair()
+        await self.nextOutput(events.CONNECTION_MADE)
+        remote.sendall(frame(b'\xffone') + frame(b'\xfftwo'))
+        first = await self.nextOutput(events.BLUETOOTH_MESSAGE)
+        second = await self.nextOutput(events.BLUETOOTH_MESSAGE)
+        self.assertEqual(first['message'], b'\xffone')
+        self.assertEqual(second['message'], b'\xfftwo')
+
+    async def testFrameThatCanNotBeHandled(self):
+        handle = self.service._outputBluetoothMessage
+        def outputBluetoothMessage(buffer):
+            if bytes(buffer) == b'\xffbad':
+                raise ValueError("bad frame")
+            handle(buffer)
+        self.service._outputBluetoothMessage = outputBluetoothMessage
+        remote = self.connectPair()
+        await self.nextOutput(events.CONNECTION_MADE)
+        remote.sendall(frame(b'\xffbad'))
+        args = await self.nextOutput(events.ERROR)
+        self.assertIsInstance(args['error'], ValueError)
+        remote.sendall(frame(b'\xffgood'))
+        args = await self.nextOutput(events.BLUETOOTH_MESSAGE)
+        self.assertEqual(args['message'], b'\xffgood')
+        self.assertEqual(self.service.state, self.service.STATE_CONNECTED)
+
+    async def testWrite(self):
+        remote = self.connectPair()
+        messageID = self.service.write(b'\xffhello')
+        args = await self.nextOutput(events.WRITE_SUCCESS)
+        self.assertEqual(args['messageID'], messageID)
+        remote.settimeout(5)
+        self.assertEqual(remote.recv(100), frame(b'\xffhello'))
+
+    async def testWriteWhenNotConnected(self):
+        with self.assertRaises(BluetoothWriteError):
+            self.service.write(b'\xffhello')
+
+    async def testRemoteCloses(self):
+        remote = self.connectPair()
+        remote.close()
+        await self.nextOutput(events.CONNECTION_LOST)
+        self.assertEqual(self.service.state, self.service.STATE_NONE)
+
+    async def testDisconnect(self):
+        self.connectPair()
+        self.service.disconnect()
+        await self.nextOutput(events.DISCONNECTED)
+        self.assertEqual(self.service.state, self.service.STATE_NONE)
+        with self.assertRaises(BluetoothWriteError):
+            self.service.write(b'\xffhello')
+
+    async def testDisconnectFailsWriteInFlight(self):
+        # Nothing is read on the other end, so a write this large is
+        # still being sent when the connection is closed
+        self.connectPair()
+        messageID = self.service.write(b'\xff' * (8 << 20))
+        await asyncio.sleep(0.1)
+        self.service.disconnect()
+        args = await self.nextOutput(events.WRITE_FAILED)
+        self.assertEqual(args['messageID'], messageID)
+
+    async def testServerConnect(self):
+        self.service.connectAsServer()
+        await self.nextOutput(events.NOTE)
+        loop = asyncio.get_running_loop()
+        remote = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(remote.close)
+        await loop.run_in_executor(None, remote.connect, self.path)
+        await self.nextOutput(events.CONNECTION_MADE)
+        remote.sendall(frame(b'\xffhi'))
+        args = await self.nextOutput(events.BLUETOOTH_MESSAGE)
+        self.assertEqual(args['message'], b'\xffhi')
+
+    async def testDisconnectWhileAwaitingConnection(self):
+        self.service.connectAsServer()
+        await self.nextOutput(events.NOTE)
+        self.service.disconnect()
+        await self.nextOutput(events.DISCONNECTED)
+        self.assertEqual(self.service.state, self.service.STATE_NONE)
+        # The accept() in the executor was woken and nothing listens
+        remote = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(remote.close)
+        with self.assertRaises(OSError):
+            remote.connect(self.path)
+        await asyncio.sleep(0.1)
+        self.assertTrue(self.outputQueue.empty())
+
+    async def testConnectAgainAfterDisconnect(self):
+        self.service.connectAsServer()
+        await self.nextOutput(events.NOTE)
+        self.service.disconnect()
+        await self.nextOutput(events.DISCONNECTED)
+        remote = self.connectPair()
+        await self.nextOutput(events.CONNECTION_MADE)
+        remote.sendall(frame(b'\xffagain'))
+        args = await self.nextOutput(events.BLUETOOTH_MESSAGE)
+        self.assertEqual(args['message'], b'\xffagain')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from queue import Empty, Queue
+from threading import Thread
+import os
+import socket
+import tempfile
+import unittest
+from src import compression, events, specialFrame
+from src.bluetoothManager import BluetoothManager, HistoryRecord, \
+                                 TextMessage, getBytes
+from src.compression import COMPRESSED
+from src.frameReader import FrameReader, packFrame
+from src.transport import UnixTransport
+
+UUID = "56abddf0-d4d2-45c7-9b2b-7837582d436f"
+SERVICE_NAME = "TerminalTexting"
+NUMBER = "+14165550100"
+LONG_TEXT = "are you coming to dinner tonight? let me know what time " \
+            "works, I can pick you up on my way home"
+
+class Phone():
+    '''The other end of the connection, driven by the test
+
+    Every frame the manager sends is put on frames.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(5)
+        self.frames = Queue()
+        self._thread = Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        reader = FrameReader()
+        while True:
+            try:
+                if not reader.recvFrom(self.sock):
+                    return
+            except OSError:
+                return
+            for frame in reader.frames():
+                self.frames.put(bytes(frame))
+
+    def send(self, payload):
+        self.sock.sendall(packFrame(payload))
+
+    def nextFrame(self, timeout=5):
+        """Returns the next frame that is not a special frame"""
+        while True:
+            frame = self.frames.get(timeout=timeout)
+            if frame[0] != specialFrame.SPECIAL:
+                return frame
+
+    def nextSpecial(self, operation, timeout=5):
+        while True:
+            frame = self.frames.get(timeout=timeout)
+            if frame[0] == specialFrame.SPECIAL \
+                    and frame[1] == operation:
+                return specialFrame.decode(frame)[1]
+
+class BluetoothManagerTest(unittest.TestCase):
+    '''Connects a BluetoothManager to a Phone over a unix socket'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "phone.sock")
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.server.settimeout(5)
+        self.outputQueue = Queue()
+        self.outputs = [] # every output taken off the queue
+        self.manager = BluetoothManager(UUID, SERVICE_NAME, \
+                                        self.outputQueue, \
+                                        UnixTransport(self.path), \
+                                        self.directory.name)
+        self.addCleanup(self.manager.join, 5)
+
+    def nextOutput(self, kind):
+        """Returns the args of the next output of kind, skipping others"""
+        while True:
+            event = self.outputQueue.get(timeout=5)
+            self.outputs.append(event)
+            if event.kind == kind:
+                return event.args
+
+    def connect(self, features):
+        """Connects to a Phone that answers the HELLO with features"""
+        self.manager.connectAsClient(self.path)
+        return self.accept(features)
+
+    def accept(self, features):
+        """Accepts the next connection of the manager as a Phone"""
+        sock, _ = self.server.accept()
+        self.addCleanup(sock.close)
+        phone = Phone(sock)
+        self.assertEqual(phone.nextSpecial(specialFrame.HELLO)[1] \
+                         & specialFrame.FEATURE_ZLIB, \
+                         specialFrame.FEATURE_ZLIB)
+        phone.send(specialFrame.hello(features))
+        # Frames are handled in order, so once this text is out the
+        # HELLO has been
+        phone.send(getBytes(NUMBER, "ready"))
+        self.nextOutput(events.RECEIVED_TEXT_MESSAGE)
+        return phone
+
+    def drop(self, phone):
+        """Cuts the connection, which the manager makes again"""
+        phone.sock.shutdown(socket.SHUT_RDWR)
+        self.nextOutput(events.RECONNECTING)
+
+    def write(self, text):
+        return self.manager.write(getBytes(NUMBER, text))
+
+class AckTest(BluetoothManagerTest):
+
+    def testDeliveredAfterAck(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        messageID = self.write("hello")
+        phone.nextFrame()
+        phone.send(specialFrame.ack(1))
+        args = self.nextOutput(events.WRITE_SUCCESS)
+        self.assertEqual(args['messageID'], messageID)
+        self.assertTrue(args['delivered'])
+
+    def testSmsResult(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        sent = self.write("one")
+        failed = self.write("two")
+        phone.nextFrame()
+        phone.nextFrame()
+        phone.send(specialFrame.ack(2))
+        phone.send(specialFrame.smsResult(2, 1))
+        phone.send(specialFrame.smsResult(1, 0))
+        statuses = {}
+        while len(statuses) < 2:
+            args = self.nextOutput(events.MESSAGE_STATUS)
+            if args['status'] != self.manager.MESSAGE_ON_WIRE:
+                statuses[args['messageID']] = args['status']
+        self.assertEqual(statuses, {sent: self.manager.MESSAGE_SMS_SENT, \
+                                    failed: self.manager.MESSAGE_SMS_FAILED})
+
+    def testSmsResultOfUnknownMessage(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        phone.send(specialFrame.smsResult(9, 0))
+        phone.send(getBytes(NUMBER, "after"))
+        self.nextOutput(events.RECEIVED_TEXT_MESSAGE)
+        statuses = []
+        while not self.outputQueue.empty():
+            event = self.outputQueue.get()
+            if event.kind == events.MESSAGE_STATUS:
+                statuses.append(event.args['status'])
+        self.assertNotIn(self.manager.MESSAGE_SMS_SENT, statuses)
+
+    def testSendWindow(self):
+        self.manager.SEND_WINDOW = 1
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        self.write("one")
+        self.write("two")
+        phone.nextFrame()
+        # The second waits for the first to be acknowledged
+        with self.assertRaises(Empty):
+            phone.nextFrame(0.3)
+        phone.send(specialFrame.ack(1))
+        self.assertIn(b"two", phone.nextFrame())
+
+    def testWithoutAcks(self):
+        phone = self.connect(0)
+        messageID = self.write("hello")
+        phone.nextFrame()
+        args = self.nextOutput(events.WRITE_SUCCESS)
+        self.assertEqual(args['messageID'], messageID)
+        self.assertFalse(args['delivered'])
+
+class ReconnectTest(BluetoothManagerTest):
+
+    def testSentAgainWithSameID(self):
+        features = specialFrame.FEATURE_ACKS | specialFrame.FEATURE_IDS
+        phone = self.connect(features)
+        self.write("hello")
+        frame = phone.nextFrame()
+        self.assertEqual(frame[0], specialFrame.IDENTIFIED)
+        self.assertEqual(frame[9:], getBytes(NUMBER, "hello"))
+        # Dropped before the ACK came back
+        self.drop(phone)
+        phone = self.accept(features)
+        self.assertEqual(phone.nextFrame(), frame)
+
+    def testUnidentifiedNotSentAgain(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        messageID = self.write("hello")
+        self.assertEqual(phone.nextFrame(), getBytes(NUMBER, "hello"))
+        self.drop(phone)
+        phone = self.accept(specialFrame.FEATURE_ACKS)
+        self.assertIn({'messageID': messageID, \
+                       'status': self.manager.MESSAGE_UNKNOWN}, \
+                      [event.args for event in self.outputs \
+                       if event.kind == events.MESSAGE_STATUS])
+        with self.assertRaises(Empty):
+            phone.nextFrame(0.3)
+
+    def testNotSentYetIsSentAgain(self):
+        self.manager.SEND_WINDOW = 1
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        self.write("one")
+        self.write("two")
+        phone.nextFrame()
+        self.drop(phone)
+        phone = self.accept(specialFrame.FEATURE_ACKS)
+        # Only the one that never went out
+        self.assertEqual(phone.nextFrame(), getBytes(NUMBER, "two"))
+
+class MessageIDTest(BluetoothManagerTest):
+
+    features = specialFrame.FEATURE_ACKS | specialFrame.FEATURE_IDS
+
+    def sendOne(self, phone):
+        """Writes a message, returns its messageID and id on the wire"""
+        messageID = self.write("hello")
+        frame = phone.nextFrame()
+        (wireID,) = specialFrame.MESSAGE_ID.unpack_from(frame, 1)
+        return messageID, wireID
+
+    def nextStatus(self):
+        while True:
+            args = self.nextOutput(events.MESSAGE_STATUS)
+            if args['status'] != self.manager.MESSAGE_ON_WIRE:
+                return args
+
+    def testAckAndResult(self):
+        phone = self.connect(self.features)
+        messageID, wireID = self.sendOne(phone)
+        phone.send(specialFrame.messageAck(wireID))
+        args = self.nextOutput(events.WRITE_SUCCESS)
+        self.assertEqual(args['messageID'], messageID)
+        self.assertTrue(args['delivered'])
+        phone.send(specialFrame.messageResult(wireID, 0))
+        self.assertEqual(self.nextStatus(), \
+                         {'messageID': messageID, \
+                          'status': self.manager.MESSAGE_SMS_SENT})
+
+    def testResultOnNextConnection(self):
+        phone = self.connect(self.features)
+        messageID, wireID = self.sendOne(phone)
+        phone.send(specialFrame.messageAck(wireID))
+        self.nextOutput(events.WRITE_SUCCESS)
+        self.drop(phone)
+        phone = self.accept(self.features)
+        # Held by the phone while disconnected
+        phone.send(specialFrame.messageResult(wireID, 1))
+        self.assertEqual(self.nextStatus(), \
+                         {'messageID': messageID, \
+                          'status': self.manager.MESSAGE_SMS_FAILED})
+
+    def testIDsOfAnotherRun(self):
+        phone = self.connect(self.features)
+        _, wireID = self.sendOne(phone)
+        phone.send(specialFrame.messageAck(wireID ^ 1 << 40))
+        phone.send(specialFrame.messageResult(wireID ^ 1 << 40, 0))
+        phone.send(getBytes(NUMBER, "after"))
+        self.nextOutput(events.RECEIVED_TEXT_MESSAGE)
+        self.assertNotIn(events.WRITE_SUCCESS, \
+                         [event.kind for event in self.outputs])
+
+    def testSequenceResultUnknownAfterReconnect(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        messageID = self.write("hello")
+        phone.nextFrame()
+        phone.send(specialFrame.ack(1))
+        self.nextOutput(events.WRITE_SUCCESS)
+        self.drop(phone)
+        self.accept(specialFrame.FEATURE_ACKS)
+        self.assertIn({'messageID': messageID, \
+                       'status': self.manager.MESSAGE_SMS_UNKNOWN}, \
+                      [event.args for event in self.outputs \
+                       if event.kind == events.MESSAGE_STATUS])
+
+class CompressionTest(BluetoothManagerTest):
+
+    def testCompressedWhenNegotiated(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS \
+                             | specialFrame.FEATURE_ZLIB)
+        self.write("short")
+        self.write(LONG_TEXT)
+        # Too short to be worth it
+        self.assertEqual(phone.nextFrame(), getBytes(NUMBER, "short"))
+        frame = phone.nextFrame()
+        self.assertEqual(frame[0], COMPRESSED)
+        self.assertEqual(compression.inflate(frame), \
+                         getBytes(NUMBER, LONG_TEXT))
+
+    def testNotCompressedWithoutZlib(self):
+        phone = self.connect(specialFrame.FEATURE_ACKS)
+        self.write(LONG_TEXT)
+        self.assertEqual(phone.nextFrame(), getBytes(NUMBER, LONG_TEXT))
+
+    def testNotCompressedAfterReconnect(self):
+        phone = self.connect(specialFrame.FEATURE_ZLIB)
+        # Made again by the manager itself
+        self.drop(phone)
+        phone = self.accept(0)
+        self.write(LONG_TEXT)
+        self.assertEqual(phone.nextFrame(), getBytes(NUMBER, LONG_TEXT))
+
+    def testReceivesCompressed(self):
+        # Always understood, whatever the HELLO said
+        phone = self.connect(0)
+        phone.send(compression.deflate(getBytes(NUMBER, LONG_TEXT, "Bob")))
+        message = self.nextOutput(events.RECEIVED_TEXT_MESSAGE)['message']
+        self.assertEqual((message.phoneNumber, message.contactName, \
+                          message.message), (NUMBER, "Bob", LONG_TEXT))
+
+    def testCorruptCompressed(self):
+        phone = self.connect(0)
+        frame = compression.deflate(getBytes(NUMBER, LONG_TEXT))
+        phone.send(frame[:-4])
+        self.assertIsNotNone(self.nextOutput(events.ERROR)['error'])
+        # The connection carries on
+        phone.send(getBytes(NUMBER, "after"))
+        message = self.nextOutput(events.RECEIVED_TEXT_MESSAGE)['message']
+        self.assertEqual(message.message, "after")
+
+class SyncTest(BluetoothManagerTest):
+
+    def page(self, syncID, first, count):
+        return specialFrame.syncPage(syncID, \
+            [HistoryRecord(phoneID, 1.7e9, 0, \
+                           TextMessage(NUMBER, "Bob", "text")).encode() \
+             for phoneID in range(first, first + count)])
+
+    def testSync(self):
+        phone = self.connect(specialFrame.FEATURE_SYNC)
+        syncID = self.manager.syncHistory(0)
+        phone.nextSpecial(specialFrame.SYNC_REQUEST)
+        phone.send(self.page(syncID, 1, 3))
+        phone.send(specialFrame.syncEnd(syncID, 3, 0))
+        args = self.nextOutput(events.HISTORY_PAGE)
+        self.assertEqual([record.phoneID for record in args['records']], \
+                         [1, 2, 3])
+        self.assertEqual(self.nextOutput(events.HISTORY_SYNCED), \
+                         {'syncID': syncID, 'watermark': 3, \
+                          'complete': True})
+
+    def testCorruptPageEndsSync(self):
+        phone = self.connect(specialFrame.FEATURE_SYNC)
+        syncID = self.manager.syncHistory(0)
+        phone.nextSpecial(specialFrame.SYNC_REQUEST)
+        phone.send(self.page(syncID, 1, 3))
+        phone.send(self.page(syncID, 4, 3)[:-1])
+        phone.send(self.page(syncID, 7, 3))
+        phone.send(specialFrame.syncEnd(syncID, 9, 0))
+        phone.send(getBytes(NUMBER, "after"))
+        self.nextOutput(events.RECEIVED_TEXT_MESSAGE)
+        pages = [event.args['watermark'] for event in self.outputs \
+                 if event.kind == events.HISTORY_PAGE]
+        synced = [event.args for event in self.outputs \
+                  if event.kind == events.HISTORY_SYNCED]
+        # Nothing moves the watermark past the page that was lost
+        self.assertEqual(pages, [3])
+        self.assertEqual(synced, [{'syncID': syncID, 'watermark': 3, \
+                                   'complete': False}])
+        self.assertIn(events.ERROR, [event.kind for event in self.outputs])
+        # and the phone was not given credit for it
+        with self.assertRaises(Empty):
+            phone.nextSpecial(specialFrame.SYNC_CREDIT, 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import unittest
+import zlib
+from src import compression, specialFrame
+from src.bluetoothManager import HistoryRecord, TextMessage, \
+                                 TextMessageError, decodeMany, getBytes
+from src.compression import COMPRESSED, CompressionError
+from src.frameReader import packFrame
+from src.specialFrame import SpecialFrameError
+
+NUMBER = "+14165550100"
+LONG_TEXT = "sounds good, see you tomorrow at the station. " \
+            "I'll call you when I'm on my way, running a bit late"
+
+class TextMessageTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        payload = getBytes(NUMBER, "hello ☺", "Bob")
+        message, end = TextMessage.decode(payload, 1)
+        self.assertEqual((message.phoneNumber, message.contactName, \
+                          message.message), (NUMBER, "Bob", "hello ☺"))
+        self.assertEqual(end, len(payload))
+
+    def testLongContactNameIsCut(self):
+        message, _ = TextMessage.decode(getBytes(NUMBER, "hi", "a" * 300), 1)
+        self.assertEqual(message.contactName, "a" * 255)
+
+    def testTruncated(self):
+        payload = getBytes(NUMBER, "hello", "Bob")
+        for end in (5, 17, len(payload) - 1):
+            with self.assertRaises(TextMessageError):
+                TextMessage.decode(payload[:end], 1)
+
+    def testNegativeLength(self):
+        payload = bytearray(getBytes(NUMBER, "hello", "Bob"))
+        payload[-9:-5] = (-1).to_bytes(4, 'big', signed=True)
+        with self.assertRaises(TextMessageError):
+            TextMessage.decode(payload, 1)
+
+    def testDecodeMany(self):
+        buffer = packFrame(getBytes(NUMBER, "one")) \
+            + packFrame(specialFrame.ack(1)) \
+            + packFrame(getBytes(NUMBER, "two"))
+        self.assertEqual([message.message for message in decodeMany(buffer)], \
+                         ["one", "two"])
+
+    def testDecodeManyPartialFrame(self):
+        buffer = packFrame(getBytes(NUMBER, "one"))
+        with self.assertRaises(TextMessageError):
+            list(decodeMany(buffer[:-1]))
+
+    def testHistoryPage(self):
+        records = [HistoryRecord(phoneID, 1.7e9 + phoneID, phoneID % 2, \
+                                 TextMessage(NUMBER, "Bob", f"{phoneID}")) \
+                   for phoneID in range(1, 4)]
+        page = specialFrame.syncPage(7, [record.encode() \
+                                         for record in records])
+        operation, (syncID, count) = specialFrame.decode(page)
+        self.assertEqual((operation, syncID, count), \
+                         (specialFrame.SYNC_PAGE, 7, 3))
+        decoded = list(HistoryRecord.decodePage(page, count))
+        self.assertEqual([(record.phoneID, record.timestamp, \
+                           record.direction, record.message.message) \
+                          for record in decoded], \
+                         [(record.phoneID, record.timestamp, \
+                           record.direction, record.message.message) \
+                          for record in records])
+        with self.assertRaises(TextMessageError):
+            list(HistoryRecord.decodePage(page[:-1], count))
+
+class CompressionTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        payload = getBytes(NUMBER, LONG_TEXT)
+        frame = compression.deflate(payload)
+        self.assertEqual(frame[0], COMPRESSED)
+        self.assertLess(len(frame), len(payload))
+        self.assertEqual(compression.inflate(frame), payload)
+
+    def testWithoutDictionary(self):
+        payload = getBytes(NUMBER, "abc" * 100)
+        frame = compression.deflate(payload, 0)
+        self.assertEqual(frame[1], 0)
+        self.assertEqual(compression.inflate(memoryview(frame)), payload)
+
+    def testShortPayloadIsNotCompressed(self):
+        self.assertIsNone(compression.deflate(getBytes(NUMBER, "hi")))
+
+    def testIncompressiblePayloadIsNotCompressed(self):
+        payload = bytes((255,)) + bytes(range(256)) * 2
+        self.assertIsNone(compression.deflate(zlib.compress(payload)))
+
+    def testNotCompressed(self):
+        with self.assertRaises(CompressionError):
+            compression.inflate(getBytes(NUMBER, LONG_TEXT))
+        with self.assertRaises(CompressionError):
+            compression.inflate(bytes((COMPRESSED,)))
+
+    def testUnknownDictionary(self):
+        frame = bytearray(compression.deflate(getBytes(NUMBER, LONG_TEXT)))
+        frame[1] = 200
+        with self.assertRaises(CompressionError):
+            compression.inflate(frame)
+
+    def testCorrupt(self):
+        frame = compression.deflate(getBytes(NUMBER, LONG_TEXT))
+        with self.assertRaises(CompressionError):
+            compression.inflate(frame[:2] + b'\xff' * (len(frame) - 2))
+
+    def testTruncated(self):
+        frame = compression.deflate(getBytes(NUMBER, LONG_TEXT))
+        with self.assertRaises(CompressionError):
+            compression.inflate(frame[:-4])
+
+    def testTooLarge(self):
+        frame = compression.deflate(b'\xff' + bytes(10000))
+        with self.assertRaises(CompressionError):
+            compression.inflate(frame, maxSize=1000)
+        self.assertEqual(len(compression.inflate(frame, maxSize=10001)), \
+                         10001)
+
+class SpecialFrameTest(unittest.TestCase):
+
+    def testRoundTrips(self):
+        frames = [
+            (specialFrame.hello(specialFrame.FEATURE_ZLIB), \
+             specialFrame.HELLO, \
+             (specialFrame.PROTOCOL_VERSION, specialFrame.FEATURE_ZLIB)),
+            (specialFrame.ack(70000), specialFrame.ACK, (70000,)),
+            (specialFrame.smsResult(3, 1), specialFrame.SMS_RESULT, (3, 1)),
+            (specialFrame.syncRequest(2, 1 << 40, 4, NUMBER), \
+             specialFrame.SYNC_REQUEST, (2, 1 << 40, 4, NUMBER.encode())),
+            (specialFrame.syncCredit(2, 1), specialFrame.SYNC_CREDIT, \
+             (2, 1)),
+            (specialFrame.syncEnd(2, 99, 0), specialFrame.SYNC_END, \
+             (2, 99, 0)),
+            (specialFrame.transferStatus([(5, 6), (7, 8)]), \
+             specialFrame.TRANSFER_STATUS, (2,)),
+            ]
+        for frame, operation, fields in frames:
+            with self.subTest(operation=operation):
+                self.assertEqual(specialFrame.decode(frame), \
+                                 (operation, fields))
+
+    def testUnknownOperation(self):
+        self.assertEqual(specialFrame.decode(bytes((0, 200, 1, 2))), \
+                         (200, None))
+
+    def testLongerFrameIsAccepted(self):
+        self.assertEqual(specialFrame.decode(specialFrame.ack(5) + b'new'), \
+                         (specialFrame.ACK, (5,)))
+
+    def testTruncated(self):
+        with self.assertRaises(SpecialFrameError):
+            specialFrame.decode(specialFrame.smsResult(3, 1)[:-1])
+
+    def testNotSpecial(self):
+        for buffer in (b'', b'\x00', getBytes(NUMBER, "hi")):
+            with self.assertRaises(SpecialFrameError):
+                specialFrame.decode(buffer)
+
+if __name__ == '__main__':
+    unittest.main()
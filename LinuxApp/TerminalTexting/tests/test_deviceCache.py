@@ -0,0 +1,101 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from threading import Thread
+import json
+import os
+import tempfile
+import time
+import unittest
+from src.deviceCache import DeviceCache
+
+PHONE = "C0:EE:FB:27:43:16"
+
+class DeviceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache", "devices.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path) as source:
+            return json.load(source)
+
+    def testSeenOnlyChangesMemory(self):
+        cache = DeviceCache(self.path)
+        cache.seen(PHONE, "Phone", 0x5a020c)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(cache.devices(), [(PHONE, "Phone")])
+
+    def testSave(self):
+        cache = DeviceCache(self.path)
+        cache.seen(PHONE, "Phone")
+        cache.setChannel(PHONE, 4)
+        cache.save()
+        self.assertEqual(self.read()[PHONE]['channel'], 4)
+        again = DeviceCache(self.path)
+        self.assertEqual(again.name(PHONE), "Phone")
+        self.assertEqual(again.channel(PHONE), 4)
+
+    def testSaveWithoutChanges(self):
+        cache = DeviceCache(self.path)
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
+        cache.seen(PHONE)
+        cache.save()
+        # Nothing changed since, so the file is left alone
+        os.utime(self.path, ns=(0, 0))
+        cache.save()
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 0)
+
+    def testForgetChannel(self):
+        cache = DeviceCache(self.path)
+        cache.setChannel(PHONE, 4)
+        cache.save()
+        cache.forgetChannel(PHONE)
+        cache.save()
+        self.assertIsNone(DeviceCache(self.path).channel(PHONE))
+
+    def testOldDevicesAreDropped(self):
+        cache = DeviceCache(self.path, ttl=60)
+        cache.seen(PHONE, "Phone")
+        cache.seen("00:11:22:33:44:55", "Old")
+        cache._devices["00:11:22:33:44:55"]['lastSeen'] = time.time() - 120
+        self.assertEqual(cache.devices(), [(PHONE, "Phone")])
+        self.assertIsNone(cache.name("00:11:22:33:44:55"))
+        cache.save()
+        self.assertEqual(list(self.read()), [PHONE])
+
+    def testUnreadableFile(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as out:
+            out.write("{not json")
+        self.assertEqual(DeviceCache(self.path).devices(), [])
+
+    def testSeenFromManyThreads(self):
+        cache = DeviceCache(self.path)
+        addresses = ["00:00:00:00:%02X:%02X" % (i, j) \
+                     for i in range(8) for j in range(50)]
+
+        def record(part):
+            for address in part:
+                cache.seen(address, address)
+                cache.save()
+
+        threads = [Thread(target=record, args=(addresses[i::8],)) \
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.save()
+        self.assertEqual(sorted(self.read()), sorted(addresses))
+
+if __name__ == '__main__':
+    unittest.main()
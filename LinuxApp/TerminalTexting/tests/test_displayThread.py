@@ -0,0 +1,66 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from threading import Event, Thread
+from unittest import mock
+import time
+import unittest
+from src import displayThread
+from src.displayThread import DisplayThread
+from src.metrics import Registry
+
+class DisplayThreadTest(unittest.TestCase):
+    '''Runs a DisplayThread over mock windows, counting the terminal
+    updates instead of making them'''
+
+    MAX_FPS = 50
+
+    def setUp(self):
+        self.updates = []
+        patcher = mock.patch.object(displayThread.curses, 'doupdate', \
+                                    lambda: self.updates.append( \
+                                        time.monotonic()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tbox = mock.MagicMock()
+        self.display = DisplayThread(mock.MagicMock(), mock.MagicMock(), \
+                                     self.tbox, mock.MagicMock(), \
+                                     maxFps=self.MAX_FPS, maxQueue=64, \
+                                     registry=Registry())
+        self.addCleanup(self.display.join, 5)
+
+    def testRequestsShareFrames(self):
+        for ch in range(200):
+            self.display.tBoxCommand(ch)
+        self.display.join(5)
+        self.assertEqual(self.tbox.do_command.call_count, 200)
+        self.assertLess(len(self.updates), 20)
+
+    def testFloodStillRenders(self):
+        # Every request takes a while, so they come faster than they are
+        # applied and the queue is never empty
+        self.tbox.do_command.side_effect = lambda ch: time.sleep(0.001)
+        flooding = Event()
+        flooding.set()
+
+        def flood():
+            while flooding.is_set():
+                self.display.tBoxCommand(ord('a'))
+
+        flooder = Thread(target=flood)
+        flooder.start()
+        time.sleep(0.1)
+        start = len(self.updates)
+        time.sleep(1)
+        frames = len(self.updates) - start
+        flooding.clear()
+        flooder.join()
+        self.assertGreater(self.display.input.qsize(), 0)
+        self.assertGreaterEqual(frames, self.MAX_FPS // 2)
+        self.assertLessEqual(frames, self.MAX_FPS * 3 // 2)
+
+if __name__ == '__main__':
+    unittest.main()
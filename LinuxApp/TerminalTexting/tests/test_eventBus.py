@@ -0,0 +1,49 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from queue import Full
+from threading import Thread
+import unittest
+from src import events
+from src.boundedQueue import BLOCK, DROP
+from src.eventBus import EventBus, PRIORITY_HIGH
+from src.events import Event
+
+class EventBusTest(unittest.TestCase):
+    '''Fills the high level of a small EventBus with keystrokes'''
+
+    LIMITS = ((2, DROP), (2, DROP), (4, BLOCK))
+
+    def setUp(self):
+        self.bus = EventBus(limits=self.LIMITS)
+        for ch in b'ab':
+            self.assertTrue(self.bus.put(Event(events.KEYBOARD_INPUT, ch)))
+
+    def testKeystrokesDropped(self):
+        self.assertFalse(self.bus.put(Event(events.KEYBOARD_INPUT, 99)))
+        self.assertEqual(self.bus.dropped[PRIORITY_HIGH], 1)
+        self.assertEqual([self.bus.get().args for _ in range(2)], \
+                         [ord('a'), ord('b')])
+
+    def testConnectionStateNeverDropped(self):
+        lost = Event(events.CONNECTION_LOST, {'comment': "gone"})
+        with self.assertRaises(Full):
+            self.bus.put(lost, block=False)
+        putter = Thread(target=self.bus.put, args=(lost,))
+        putter.start()
+        putter.join(0.2)
+        self.assertTrue(putter.is_alive(), "put() should wait for room")
+        received = [self.bus.get(timeout=5) for _ in range(3)]
+        putter.join(5)
+        self.assertEqual(received[-1], lost)
+        self.assertEqual(self.bus.dropped[PRIORITY_HIGH], 0)
+
+    def testDroppedOnceClosed(self):
+        self.bus.close()
+        self.assertFalse(self.bus.put(Event(events.DISCONNECTED, {})))
+
+if __name__ == '__main__':
+    unittest.main()
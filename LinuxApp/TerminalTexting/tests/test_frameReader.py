@@ -0,0 +1,126 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import socket
+import unittest
+from src.frameReader import FRAME_HEADER, FrameReader, FramingError, \
+                            packFrame
+
+class RecvOnly():
+    """A socket wrapper without recv_into(), like pybluez"""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def recv(self, size):
+        return self._sock.recv(size)
+
+class FrameReaderTest(unittest.TestCase):
+
+    def frames(self, reader):
+        return [bytes(frame) for frame in reader.frames()]
+
+    def testSplitsFrames(self):
+        reader = FrameReader()
+        reader.feed(packFrame(b'\xffone') + packFrame(b'\xfftwo'))
+        self.assertEqual(self.frames(reader), [b'\xffone', b'\xfftwo'])
+        self.assertEqual(self.frames(reader), [])
+
+    def testKeepsPartialFrame(self):
+        reader = FrameReader()
+        data = packFrame(b'\xffone') + packFrame(b'\xfftwo')
+        reader.feed(data[:10])
+        self.assertEqual(self.frames(reader), [b'\xffone'])
+        reader.feed(data[10:])
+        self.assertEqual(self.frames(reader), [b'\xfftwo'])
+
+    def testByteAtATime(self):
+        reader = FrameReader(size=8)
+        payloads = [b'\xff' + bytes([i]) * i for i in range(1, 20)]
+        received = []
+        for byte in b''.join(packFrame(payload) for payload in payloads):
+            reader.feed(bytes((byte,)))
+            received += self.frames(reader)
+        self.assertEqual(received, payloads)
+
+    def testGrowsForLargeFrame(self):
+        reader = FrameReader(size=16)
+        payload = b'\xff' + bytes(range(256)) * 64
+        data = packFrame(payload)
+        for start in range(0, len(data), 1000):
+            reader.feed(data[start:start + 1000])
+        self.assertEqual(self.frames(reader), [payload])
+
+    def testFramesStayValidUntilNextRead(self):
+        reader = FrameReader(size=16)
+        reader.feed(packFrame(b'\xffkept'))
+        (frame,) = reader.frames()
+        # Growing the buffer must not move bytes under the frame
+        reader.feed(packFrame(b'\xff' * 100))
+        self.assertEqual(bytes(frame), b'\xffkept')
+
+    def testZeroLengthFrame(self):
+        reader = FrameReader()
+        reader.feed(packFrame(b'\xffone') + FRAME_HEADER.pack(0))
+        frames = reader.frames()
+        self.assertEqual(bytes(next(frames)), b'\xffone')
+        with self.assertRaises(FramingError):
+            next(frames)
+
+    def testOversizedFrame(self):
+        reader = FrameReader(maxFrameSize=64)
+        reader.feed(FRAME_HEADER.pack(65))
+        # Refused from the header alone, before any of it is read
+        with self.assertRaises(FramingError):
+            self.frames(reader)
+
+    def testLargestFrame(self):
+        reader = FrameReader(size=16, maxFrameSize=64)
+        payload = b'\xff' * 64
+        reader.feed(packFrame(payload))
+        self.assertEqual(self.frames(reader), [payload])
+
+    def testFramingErrorIsIOError(self):
+        self.assertTrue(issubclass(FramingError, IOError))
+
+    def testRecvFrom(self):
+        mine, remote = socket.socketpair()
+        self.addCleanup(mine.close)
+        self.addCleanup(remote.close)
+        mine.settimeout(5)
+        reader = FrameReader(size=8)
+        payload = b'\xff' + b'x' * 100
+        remote.sendall(packFrame(payload))
+        received = []
+        while not received:
+            self.assertGreater(reader.recvFrom(mine), 0)
+            received += self.frames(reader)
+        self.assertEqual(received, [payload])
+        remote.close()
+        self.assertEqual(reader.recvFrom(mine), 0)
+
+    def testRecvFromWithoutRecvInto(self):
+        mine, remote = socket.socketpair()
+        self.addCleanup(mine.close)
+        self.addCleanup(remote.close)
+        mine.settimeout(5)
+        reader = FrameReader()
+        remote.sendall(packFrame(b'\xffone') + packFrame(b'\xfftwo'))
+        received = []
+        while len(received) < 2:
+            reader.recvFrom(RecvOnly(mine))
+            received += self.frames(reader)
+        self.assertEqual(received, [b'\xffone', b'\xfftwo'])
+
+    def testWritableAndCommit(self):
+        reader = FrameReader()
+        data = packFrame(b'\xffone')
+        reader.writable()[:len(data)] = data
+        reader.commit(len(data))
+        self.assertEqual(self.frames(reader), [b'\xffone'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+import os
+import tempfile
+import unittest
+from src.bluetoothManager import HistoryRecord, TextMessage
+from src.messageStore import MessageStore
+
+NUMBER = "+14165550100"
+
+def page(first, count, text="message"):
+    return [HistoryRecord(phoneID, 1.7e9 + phoneID, 0, \
+                          TextMessage(NUMBER, "Bob", text)) \
+            for phoneID in range(first, first + count)]
+
+class Callbacks():
+    """Counts the done and failed calls of addHistory()"""
+
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+
+    def onDone(self):
+        self.done += 1
+
+    def onFailed(self):
+        self.failed += 1
+
+class MessageStoreHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = MessageStore(os.path.join(self.directory.name, \
+                                               "messages.db"))
+
+    def tearDown(self):
+        self.store.join()
+        self.directory.cleanup()
+
+    def addPage(self, records, watermark):
+        callbacks = Callbacks()
+        self.store.addHistory(records, '', watermark, callbacks.onDone, \
+                              callbacks.onFailed)
+        self.assertTrue(self.store.flush(5))
+        return callbacks
+
+    def testCommittedPage(self):
+        callbacks = self.addPage(page(1, 10), 10)
+        self.assertEqual((callbacks.done, callbacks.failed), (1, 0))
+        self.assertEqual(self.store.watermark(''), 10)
+        self.assertEqual(len(self.store.lastMessages(NUMBER, 100)), 10)
+
+    def testFailedPageIsNotDone(self):
+        self.addPage(page(1, 10), 10)
+        # sqlite3 can not bind an object, so the page is rolled back
+        callbacks = self.addPage(page(11, 10, object()), 20)
+        self.assertEqual((callbacks.done, callbacks.failed), (0, 1))
+        self.assertEqual(self.store.watermark(''), 10)
+
+    def testPagesAfterAFailureAreNotStored(self):
+        self.addPage(page(1, 10), 10)
+        self.addPage(page(11, 10, object()), 20)
+        callbacks = self.addPage(page(21, 10), 30)
+        self.assertEqual((callbacks.done, callbacks.failed), (0, 1))
+        # Storing it would have left 11 to 20 below the watermark
+        self.assertEqual(self.store.watermark(''), 10)
+        self.assertEqual(len(self.store.lastMessages(NUMBER, 100)), 10)
+
+    def testRetryHistory(self):
+        self.addPage(page(1, 10), 10)
+        self.addPage(page(11, 10, object()), 20)
+        self.store.retryHistory('')
+        callbacks = self.addPage(page(11, 20), 30)
+        self.assertEqual((callbacks.done, callbacks.failed), (1, 0))
+        self.assertEqual(self.store.watermark(''), 30)
+        self.assertEqual(len(self.store.lastMessages(NUMBER, 100)), 30)
+
+    def testOtherScopesAreStored(self):
+        self.addPage(page(1, 10, object()), 10)
+        callbacks = Callbacks()
+        self.store.addHistory(page(11, 10), NUMBER, 20, callbacks.onDone, \
+                              callbacks.onFailed)
+        self.assertTrue(self.store.flush(5))
+        self.assertEqual(callbacks.done, 1)
+        self.assertEqual(self.store.watermark(NUMBER), 20)
+
+    def testFailedBatchStillFlushesAndStops(self):
+        self.store.addHistory(page(1, 10, object()), '', 10)
+        self.assertTrue(self.store.flush(5))
+        self.store.join(5)
+        self.assertFalse(self.store.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+'''
+Created on Oct 18, 2026
+
+@author: jj
+'''
+
+from threading import Thread
+from unittest import mock
+import os
+import re
+import time
+import unittest
+from src import pairDevices
+from src.pairDevices import BluetoothCtl, BluetoothCtlError, \
+                            BluetoothCtlTimeout
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                    "fakeBluetoothctl.py")
+PHONE = "C0:EE:FB:27:43:16"
+LAPTOP = "AA:BB:CC:DD:EE:FF"
+
+class FakeTestCase(unittest.TestCase):
+    '''Runs the fake bluetoothctl with the environment of the test'''
+
+    environment = {}
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, self.environment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self):
+        ctl = BluetoothCtl(FAKE)
+        self.addCleanup(ctl.close)
+        return ctl
+
+class BluetoothCtlTest(FakeTestCase):
+
+    environment = {"FAKE_BLUETOOTHCTL_KNOWN": f"{LAPTOP}=Laptop",
+                   "FAKE_BLUETOOTHCTL_FIND": f"{PHONE}=Phone",
+                   "FAKE_BLUETOOTHCTL_DELAY": "0.5",
+                   "FAKE_BLUETOOTHCTL_SILENT": "silent"}
+
+    def testCommand(self):
+        ctl = self.start()
+        # The prompt and colours are not part of the answer
+        self.assertEqual(ctl.setPower(True).result(), \
+                         "Changing power on succeeded")
+
+    def testDevices(self):
+        ctl = self.start()
+        self.assertEqual(ctl.devices(), {LAPTOP: "Laptop"})
+
+    def testFailure(self):
+        ctl = self.start()
+        with self.assertRaises(BluetoothCtlError) as caught:
+            ctl.pair("00:11:22:33:44:55").result()
+        self.assertIn("not available", str(caught.exception))
+
+    def testPipelining(self):
+        ctl = self.start()
+        start = time.monotonic()
+        paired = ctl.pair(PHONE)
+        trusted = ctl.trust(PHONE)
+        # Answered while the pair sent before it still waits
+        trusted.result()
+        self.assertLess(time.monotonic() - start, 0.4)
+        paired.result()
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+    def testTimeout(self):
+        ctl = self.start()
+        start = time.monotonic()
+        with self.assertRaises(BluetoothCtlTimeout):
+            ctl.command("silent", r'never', timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1)
+        with self.assertRaises(BluetoothCtlTimeout):
+            ctl.command("info " + PHONE, re.escape(PHONE), timeout=0.1)
+        # The answers that come too late go to no one
+        self.assertEqual(ctl.command("version", r'^Version '), \
+                         "Version 5.66")
+
+    def testTimeoutIsPerCommand(self):
+        ctl = self.start()
+        slow = ctl.send("info " + PHONE, re.escape(PHONE))
+        with self.assertRaises(BluetoothCtlTimeout):
+            slow.result(0.1)
+        self.assertEqual(ctl.setPower(False).result(0.3), \
+                         "Changing power off succeeded")
+
+    def testWaitFor(self):
+        ctl = self.start()
+        ctl.send("scan on")
+        self.assertIn(PHONE, ctl.waitFor(re.escape(PHONE), 5))
+
+    def testScanFor(self):
+        ctl = self.start()
+        self.assertTrue(ctl.scanFor(PHONE, 5))
+        self.assertFalse(ctl.scanFor("00:11:22:33:44:55", 0.3))
+
+    def testThreads(self):
+        ctl = self.start()
+        addresses = ["00:00:00:00:00:%02X" % i for i in range(16)]
+        answers = {}
+        errors = []
+
+        def info(address):
+            try:
+                answers[address] = ctl.command("info " + address, \
+                                               re.escape(address))
+            except BluetoothCtlError as e:
+                errors.append(e)
+
+        start = time.monotonic()
+        threads = [Thread(target=info, args=(address,)) \
+                   for address in addresses]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(answers, {address: f"Device {address} (public)" \
+                                   for address in addresses})
+        # All of them in flight at once, not one after the other
+        self.assertLess(time.monotonic() - start, 0.5 * len(addresses) / 2)
+
+    def testClose(self):
+        ctl = self.start()
+        waiting = ctl.send("silent", r'never')
+        ctl.close()
+        with self.assertRaises(BluetoothCtlError) as caught:
+            waiting.result(1)
+        self.assertNotIsInstance(caught.exception, BluetoothCtlTimeout)
+        with self.assertRaises(BluetoothCtlError):
+            ctl.send("version", r'^Version ')
+
+    def testMissingProgram(self):
+        with self.assertRaises(BluetoothCtlError):
+            BluetoothCtl(os.path.join(os.path.dirname(FAKE), "missing"))
+
+class NoControllerTest(FakeTestCase):
+
+    environment = {"FAKE_BLUETOOTHCTL_NO_CONTROLLER": "1"}
+
+    def testFailsEveryWaitingCommand(self):
+        ctl = self.start()
+        power = ctl.setPower(True)
+        discoverable = ctl.setDiscoverable(True)
+        for reply in (power, discoverable):
+            with self.assertRaises(BluetoothCtlError) as caught:
+                reply.result(1)
+            self.assertNotIsInstance(caught.exception, BluetoothCtlTimeout)
+            self.assertIn("No default controller", str(caught.exception))
+
+    def testPair(self):
+        self.assertEqual(pairDevices.pair(PHONE, 1, FAKE), 0)
+
+class PairTest(FakeTestCase):
+
+    environment = {"FAKE_BLUETOOTHCTL_KNOWN": f"{LAPTOP}=Laptop",
+                   "FAKE_BLUETOOTHCTL_FIND": f"{PHONE}=Phone"}
+
+    def testPairFound(self):
+        self.assertEqual(pairDevices.pair(PHONE.lower(), 5, FAKE), 1)
+
+    def testAlreadyKnown(self):
+        self.assertEqual(pairDevices.pair(LAPTOP, 5, FAKE), 1)
+
+    def testNotFound(self):
+        self.assertEqual(pairDevices.pair("00:11:22:33:44:55", 0.3, FAKE), 0)
+
+    def testPathFromEnvironment(self):
+        with mock.patch.dict(os.environ, \
+                             {"TERMINAL_TEXTING_BLUETOOTHCTL": FAKE}):
+            self.assertEqual(pairDevices.pair(PHONE, 5), 1)
+
+if __name__ == '__main__':
+    unittest.main()